@@ -1,4 +1,8 @@
-from src.main import start
+import multiprocessing
+
+from src.__main__ import main
 
 if __name__ == "__main__":
-    start()
+    # Report rendering spawns worker processes; needed for frozen builds
+    multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,307 @@
+"""
+Streams received instances into the per-patient output archive.
+
+Without streaming every instance is written to ``TEMP/<mrn>/...``, re-read
+and DEFLATEd into ``OUTPUT/<mrn>.zip`` by `zip_and_remove_directory`, and
+then deleted. With an `ArchiveManager` attached to the SCP, instances the
+report never opens (MR, PT, ...) skip TEMP: they are buffered into large
+batches and appended to the archive by a background writer while retrieval
+continues. CT, usually most of the bytes, is streamed too: the report only
+shows it as coronal and sagittal projections, so TEMP receives a header-only
+stub carrying the slice's projection rows (see `ct_projection`), which
+`finalize` leaves out. The small objects `PDF_Parser` reads (plans, records,
+doses and structure sets) are written to TEMP only, and `finalize` appends
+them with the PDF, writes the archive index (central directory) and removes
+the working set, so every instance is written once.
+Members are compressed in parallel by `OutputPackager`, and the finished
+archive carries the same checksum manifest as a packaged directory.
+"""
+
+import os
+import shutil
+import threading
+import zipfile
+from pathlib import Path
+from queue import Queue
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from ._globals import OUTPUT_DIRECTORY
+from .logger_setup import archive_logger
+from .OutputPackager import MANIFEST_NAME, OutputPackager, compress_member, manifest_bytes, write_precompressed
+
+# Modalities PDF_Parser reads while building the report: the plan, its
+# records and doses, and the structure set linking the plan to its CT
+WORKSPACE_MODALITIES = ("RTPLAN", "RTRECORD", "RTDOSE", "RTSTRUCT")
+# Modalities streamed with a header-only projection stub left in TEMP
+STUB_MODALITIES = ("CT",)
+
+
+class _PatientArchive:
+    """An open output archive for one MRN."""
+
+    def __init__(self, zip_path: Path, compression: int, packager: OutputPackager):
+        self.zip_path = zip_path
+        # Guards the names and the batch being filled by the store handlers
+        self.lock = threading.Lock()
+        # Held by whoever writes to `zipf`
+        self.write_lock = threading.Lock()
+        self.zipf = zipfile.ZipFile(zip_path, "w", compression)
+        self.packager = packager
+        self.names = set()
+        self.digests: Dict[str, str] = {}
+        self.batch: List[Tuple[str, bytes]] = []
+        self.batch_bytes = 0
+        self.error: Optional[BaseException] = None
+
+    def take_batch_locked(self) -> List[Tuple[str, bytes]]:
+        batch = self.batch
+        self.batch = []
+        self.batch_bytes = 0
+        return batch
+
+
+class ArchiveManager:
+    """
+    Append received DICOM instances to ``OUTPUT/<mrn>.zip`` as they arrive.
+
+    Parameters
+    ----------
+    output_dir : Path, optional
+        Directory receiving ``<mrn>.zip``, by default OUTPUT_DIRECTORY.
+    workspace_modalities : Iterable[str], optional
+        Modalities written to TEMP for the report instead of being streamed;
+        they are added to the archive at `finalize`.
+    stub_modalities : Iterable[str], optional
+        Streamed modalities that also leave a header-only stub in TEMP for
+        the report. Stubs share the member name of the streamed instance,
+        so `finalize` does not append them.
+    batch_bytes : int, optional
+        Encoded bytes buffered per patient before the batch is handed to the
+        writer, by default 64 MB. 0 hands over every instance immediately.
+    compression : int, optional
+        zipfile compression method for members zipfile writes itself,
+        by default ``zipfile.ZIP_DEFLATED``.
+    packager : OutputPackager, optional
+        Compresses batches in parallel, by default a zip `OutputPackager`.
+    max_queued_batches : int, optional
+        Batches waiting for the writer before `add` blocks, by default 2.
+        Together with `batch_bytes` this bounds the memory held for
+        streaming to about ``(max_queued_batches + 2) * batch_bytes``.
+    """
+
+    def __init__(
+        self,
+        output_dir: Path = OUTPUT_DIRECTORY,
+        workspace_modalities: Iterable[str] = WORKSPACE_MODALITIES,
+        stub_modalities: Iterable[str] = STUB_MODALITIES,
+        batch_bytes: int = 64 * 1024**2,
+        compression: int = zipfile.ZIP_DEFLATED,
+        packager: Optional[OutputPackager] = None,
+        max_queued_batches: int = 2,
+    ):
+        self.output_dir = Path(output_dir)
+        self.workspace_modalities = set(workspace_modalities)
+        self.stub_modalities = set(stub_modalities)
+        self.batch_bytes = batch_bytes
+        self.compression = compression
+        self.packager = packager or OutputPackager("zip")
+        self._lock = threading.Lock()
+        self._archives: Dict[str, _PatientArchive] = {}
+        # Encoded bytes received but not yet written to an archive
+        self._pending_bytes = 0
+        self._queue: "Queue[Optional[Tuple[_PatientArchive, List[Tuple[str, bytes]]]]]" = Queue(
+            maxsize=max(1, max_queued_batches)
+        )
+        self._writer = threading.Thread(target=self._write_batches, name="ArchiveWriter", daemon=True)
+        self._writer.start()
+
+    @staticmethod
+    def arcname(ds) -> str:
+        """Archive member name, matching the TEMP layout relative to the MRN."""
+        return "/".join(
+            (ds.StudyInstanceUID, ds.Modality, ds.SeriesInstanceUID, f"{ds.SOPInstanceUID}.dcm")
+        )
+
+    def keep_in_workspace(self, ds) -> bool:
+        """True if the instance is written to TEMP for the report instead of streamed."""
+        return getattr(ds, "Modality", None) in self.workspace_modalities
+
+    def keep_stub(self, ds) -> bool:
+        """True if a streamed instance also leaves a header-only stub in TEMP."""
+        return getattr(ds, "Modality", None) in self.stub_modalities
+
+    def has(self, mrn: str) -> bool:
+        """True if an archive is open for `mrn`."""
+        with self._lock:
+            return str(mrn) in self._archives
+
+    def capacity_bytes(self) -> int:
+        """Bytes `add` can accept ahead of the writer before it blocks."""
+        return (self._queue.maxsize + 1) * max(self.batch_bytes, 1)
+
+    def pending_bytes(self) -> int:
+        """Encoded bytes accepted by `add` that are not written to disk yet."""
+        with self._lock:
+            return self._pending_bytes
+
+    def _archive(self, mrn: str) -> _PatientArchive:
+        with self._lock:
+            archive = self._archives.get(mrn)
+            if archive is None:
+                self.output_dir.mkdir(parents=True, exist_ok=True)
+                zip_path = self.output_dir / f"{mrn}.zip"
+                archive = self._archives[mrn] = _PatientArchive(zip_path, self.compression, self.packager)
+                archive_logger.info(f"Streaming instances into {zip_path}")
+            return archive
+
+    def _write_batches(self):
+        """Writer thread: compress and append queued batches in order."""
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                archive, batch = item
+                if archive.error is None:
+                    try:
+                        with archive.write_lock:
+                            archive.digests.update(archive.packager.write_zip_members(archive.zipf, batch))
+                    except Exception as e:
+                        archive.error = e
+                        archive_logger.error(f"Could not write to {archive.zip_path}: {e}", exc_info=True)
+                with self._lock:
+                    self._pending_bytes -= sum(len(data) for _, data in batch)
+            finally:
+                self._queue.task_done()
+
+    def _submit(self, archive: _PatientArchive, batch: List[Tuple[str, bytes]]):
+        if batch:
+            # Blocks while the writer is `max_queued_batches` behind
+            self._queue.put((archive, batch))
+
+    def add(self, ds, data: bytes) -> bool:
+        """
+        Queue an encoded instance for the patient's archive.
+
+        Parameters
+        ----------
+        ds : pydicom.Dataset
+            The received dataset (used for its UIDs).
+        data : bytes
+            The instance encoded as a DICOM Part 10 file.
+
+        Returns
+        -------
+        bool
+            False if the instance was already archived.
+        """
+        archive = self._archive(str(ds.PatientID))
+        arcname = self.arcname(ds)
+        full = None
+        with archive.lock:
+            if arcname in archive.names:
+                return False
+            archive.names.add(arcname)
+            archive.batch.append((arcname, data))
+            archive.batch_bytes += len(data)
+            if archive.batch_bytes >= self.batch_bytes:
+                full = archive.take_batch_locked()
+        with self._lock:
+            self._pending_bytes += len(data)
+        # Compression and disk writes happen on the writer thread
+        self._submit(archive, full)
+        return True
+
+    def flush(self, mrn: Optional[str] = None):
+        """Write buffered instances for `mrn` (or every patient) and wait for the writer."""
+        with self._lock:
+            if mrn is None:
+                archives = list(self._archives.values())
+            else:
+                archives = [self._archives[mrn]] if mrn in self._archives else []
+        for archive in archives:
+            with archive.lock:
+                batch = archive.take_batch_locked()
+            self._submit(archive, batch)
+        self._queue.join()
+
+    def finalize(self, mrn: str, directory_path) -> Path:
+        """
+        Complete the archive for `mrn` and remove its TEMP working set.
+
+        Every file under `directory_path` that was not streamed (the report's
+        working set, the PDF) is appended, followed by the checksum manifest;
+        then the central directory is written and the directory is deleted.
+
+        Returns
+        -------
+        Path
+            The finished archive.
+        """
+        mrn = str(mrn)
+        archive = self._archive(mrn)
+        self.flush(mrn)
+        with archive.lock, archive.write_lock:
+            if archive.error is not None:
+                raise OSError(f"Streaming into {archive.zip_path} failed: {archive.error}")
+            pending = []
+            for root, _, files in os.walk(directory_path):
+                for file in files:
+                    full_path = os.path.join(root, file)
+                    arcname = Path(os.path.relpath(full_path, directory_path)).as_posix()
+                    if arcname not in archive.names:
+                        pending.append((full_path, arcname))
+                        archive.names.add(arcname)
+            archive.digests.update(archive.packager.write_zip_files(archive.zipf, pending))
+            write_precompressed(archive.zipf, *compress_member(MANIFEST_NAME, manifest_bytes(archive.digests))[:2])
+            archive.zipf.close()
+            added = len(pending)
+        with self._lock:
+            self._archives.pop(mrn, None)
+        shutil.rmtree(directory_path, ignore_errors=True)
+        archive_logger.info(
+            f"Finalized archive {archive.zip_path}: {len(archive.names)} members, "
+            f"{added} appended from the working set."
+        )
+        return archive.zip_path
+
+    def discard(self, mrn: str):
+        """
+        Abandon the archive of `mrn` after a failed run.
+
+        Its buffered batch is dropped, batches still queued are skipped by
+        the writer, and the partial ``<mrn>.zip`` is closed and deleted, so
+        no incomplete package is delivered.
+        """
+        mrn = str(mrn)
+        with self._lock:
+            archive = self._archives.pop(mrn, None)
+        if archive is None:
+            return
+        with archive.lock:
+            batch = archive.take_batch_locked()
+            if archive.error is None:
+                archive.error = RuntimeError("archive discarded")
+        with self._lock:
+            self._pending_bytes -= sum(len(data) for _, data in batch)
+        with archive.write_lock:
+            archive.zipf.close()
+        try:
+            archive.zip_path.unlink()
+        except OSError:
+            pass
+        archive_logger.warning(f"Discarded the partial archive {archive.zip_path}")
+
+    def close(self):
+        """Close every open archive without finalizing its working set, and stop the writer."""
+        self.flush()
+        with self._lock:
+            archives = list(self._archives.values())
+            self._archives.clear()
+        for archive in archives:
+            with archive.write_lock:
+                archive.zipf.close()
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        self.packager.close()
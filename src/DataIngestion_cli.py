@@ -1,6 +1,6 @@
 import argparse
 
-def argument_parser():
+def argument_parser(argv=None):
     parser = argparse.ArgumentParser(
         prog="RTHistory",
         description="""A software package developed for clinics to
@@ -25,4 +25,9 @@ def argument_parser():
     parser_config = subparsers.add_parser("config", help="Input AE info.")
     # parser_config.add_argument("config", help="Input AE info.")
 
-    return parser.parse_args()
+    # Long-running service taking MRNs from the JOBS directory
+    subparsers.add_parser("serve", help="Keep the SCP/SCU up and process queued MRNs")
+    parser_submit = subparsers.add_parser("submit", help="Queue an MRN for a running service")
+    parser_submit.add_argument("MRN", help="The MRN of the patient to process")
+
+    return parser.parse_args(argv)
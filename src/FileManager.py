@@ -1,18 +1,86 @@
 import os
+import shutil
+import threading
+from collections import defaultdict
 from pathlib import Path
 from ._globals import TEMP_DIRECTORY
 import glob
 
 class FileManager:
+    """
+    Owns the TEMP workspace layout ``<mrn>/<study>/<modality>/<series>/<sop>.dcm``.
+
+    An in-memory index of the tree (SOPInstanceUIDs per MRN/study/modality and
+    per series, plus the directories already created) is built with one
+    `os.scandir` pass at startup and kept current by `save_dicom` and
+    `record_dicom`, so existence checks and saves issue no redundant syscalls.
+
+    Parameters
+    ----------
+    base_dir : Path or str, optional
+        Root of the workspace, by default TEMP_DIRECTORY.
+    build_index : bool, optional
+        Scan `base_dir` on construction, by default True.
+    instance_cache : InstanceCache, optional
+        Persistent cross-run cache that every saved instance is added to,
+        and that cache hits are linked back from, by default None.
+    """
+
+    def __init__(self, base_dir=TEMP_DIRECTORY, build_index=True, instance_cache=None):
+        self.base_dir = Path(base_dir)
+        self.instance_cache = instance_cache
+        self._lock = threading.Lock()
+        # (mrn, study, modality) -> SOPInstanceUIDs in any series
+        self._instances = defaultdict(set)
+        # (mrn, study, modality, series) -> SOPInstanceUIDs
+        self._series = defaultdict(set)
+        self._created_dirs = set()
+        if build_index:
+            self.build_index()
+
     def _build_path(self, mrn, study_uid, modality, series_uid=None, instance_uid=None):
-        path = Path(TEMP_DIRECTORY) / mrn / study_uid / modality
+        path = Path(self.base_dir) / mrn / study_uid / modality
         if series_uid:
             path /= series_uid
         if instance_uid:
             path /= instance_uid
         return path
 
+    @staticmethod
+    def _subdirs(path):
+        try:
+            with os.scandir(path) as it:
+                return [entry for entry in it if entry.is_dir()]
+        except OSError:
+            return []
 
+    def build_index(self):
+        """(Re)build the index with a single scandir pass over the workspace."""
+        instances = defaultdict(set)
+        series = defaultdict(set)
+        created = set()
+        for mrn in self._subdirs(self.base_dir):
+            created.add(mrn.path)
+            for study in self._subdirs(mrn.path):
+                created.add(study.path)
+                for modality in self._subdirs(study.path):
+                    created.add(modality.path)
+                    for series_dir in self._subdirs(modality.path):
+                        created.add(series_dir.path)
+                        key = (mrn.name, study.name, modality.name)
+                        try:
+                            with os.scandir(series_dir.path) as it:
+                                for entry in it:
+                                    if entry.name.endswith(".dcm") and entry.is_file():
+                                        sop = entry.name[: -len(".dcm")]
+                                        instances[key].add(sop)
+                                        series[key + (series_dir.name,)].add(sop)
+                        except OSError:
+                            continue
+        with self._lock:
+            self._instances = instances
+            self._series = series
+            self._created_dirs = created
 
     def query_uid(self, mrn, modality, study_uid, instance_uid, series_uid=None, base_dir=TEMP_DIRECTORY):
         """
@@ -32,12 +100,25 @@ class FileManager:
             SeriesInstanceUID. If provided, only check that series directory exists and has .dcm files.
         base_dir : Path or str, optional
             Root directory containing MRN folders. Defaults to TEMP_DIRECTORY.
+            Lookups under the indexed workspace are answered from the index;
+            any other root is searched on disk.
 
         Returns
         -------
         bool
             True if series or instance file exists, otherwise False.
         """
+        if Path(base_dir) != self.base_dir:
+            return self._query_uid_on_disk(
+                mrn, modality, study_uid, instance_uid, series_uid, base_dir
+            )
+        key = (str(mrn), str(study_uid), modality)
+        with self._lock:
+            if series_uid:
+                return bool(self._series.get(key + (str(series_uid),)))
+            return str(instance_uid) in self._instances.get(key, ())
+
+    def _query_uid_on_disk(self, mrn, modality, study_uid, instance_uid, series_uid, base_dir):
         base_dir = Path(base_dir)
         search_root = base_dir / str(mrn) / str(study_uid) / modality
 
@@ -56,18 +137,149 @@ class FileManager:
             matches = glob.glob(pattern, recursive=True)
             return len(matches) > 0
 
+    @staticmethod
+    def _uids(dicom):
+        return (
+            str(getattr(dicom, "PatientID", "UNKNOWN_PID")),
+            str(getattr(dicom, "StudyInstanceUID", "UNKNOWN_STUDY")),
+            str(getattr(dicom, "Modality", "UNKNOWN_MODALITY")),
+            str(getattr(dicom, "SeriesInstanceUID", "UNKNOWN_SERIES")),
+            str(dicom.SOPInstanceUID),
+        )
 
+    def dicom_path(self, dicom):
+        """Workspace path of `dicom` (it need not exist)."""
+        mrn, study_uid, modality, series_uid, sop_uid = self._uids(dicom)
+        return self._build_path(mrn, study_uid, modality, series_uid, f"{sop_uid}.dcm")
 
-    def save_dicom(self, dicom):
-        path = (
-            Path(TEMP_DIRECTORY)
-            / dicom.PatientID
-            / dicom.StudyInstanceUID
-            / dicom.Modality
-            / dicom.SeriesInstanceUID
-            / f"{dicom.SOPInstanceUID}.dcm"
-        )
-        path.parent.mkdir(parents=True, exist_ok=True)
-        dicom.save_as(str(path))
-        return path.exists()
+    def _ensure_dir(self, directory):
+        key = str(directory)
+        with self._lock:
+            if key in self._created_dirs:
+                return
+        directory.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self._created_dirs.add(key)
+
+    def _record(self, mrn, study_uid, modality, series_uid, sop_uid):
+        key = (mrn, study_uid, modality)
+        with self._lock:
+            self._instances[key].add(sop_uid)
+            self._series[key + (series_uid,)].add(sop_uid)
+
+    def record_dicom(self, dicom, data=None):
+        """
+        Index `dicom` as present without writing it (e.g. streamed to the archive).
+
+        If an instance cache is attached and the encoded `data` is given, the
+        instance is cached as well.
+        """
+        uids = self._uids(dicom)
+        self._record(*uids)
+        if data is not None and self.instance_cache is not None:
+            self.instance_cache.put_bytes(data, *uids)
+
+    def series_sops(self, mrn, study_uid, modality, series_uid):
+        """SOPInstanceUIDs indexed for one series."""
+        with self._lock:
+            return set(self._series.get((str(mrn), str(study_uid), modality, str(series_uid)), ()))
+
+    def link_cached(self, sop_uid):
+        """
+        Hardlink (or copy) a cached instance into the workspace and index it.
+
+        Returns
+        -------
+        Path or None
+            The workspace path, or None on a cache miss.
+        """
+        if self.instance_cache is None:
+            return None
+        entry = self.instance_cache.get(sop_uid)
+        if entry is None:
+            return None
+        uids = (entry["mrn"], entry["study_uid"], entry["modality"], entry["series_uid"], sop_uid)
+        path = self._build_path(*uids[:4], f"{sop_uid}.dcm")
+        self._ensure_dir(path.parent)
+        if not self.instance_cache.materialize(sop_uid, path):
+            return None
+        self._record(*uids)
+        return path
+
+    def save_dicom(self, dicom, data=None, write_like_original=True, cache=True):
+        """
+        Write `dicom` into the workspace and index it.
+
+        Parameters
+        ----------
+        dicom : pydicom.Dataset
+            The instance to save.
+        data : bytes, optional
+            The instance already encoded as a Part 10 file. Written as-is
+            instead of re-encoding `dicom`.
+        write_like_original : bool, optional
+            Passed to `Dataset.save_as` when `data` is not given.
+        cache : bool, optional
+            Also add the file to the instance cache, by default True. Off for
+            header-only stubs, which must never be restored as instances.
+
+        Returns
+        -------
+        bool
+            True once the file has been written.
+        """
+        uids = self._uids(dicom)
+        path = self._build_path(*uids[:4], f"{uids[4]}.dcm")
+        self._ensure_dir(path.parent)
+        # Write outside the patient tree, then rename, so concurrent readers
+        # (the report worker) never see a partial file
+        tmp = self.base_dir / ".incoming" / f"{uids[4]}.{threading.get_ident()}.part"
+        self._ensure_dir(tmp.parent)
+        if data is None:
+            dicom.save_as(str(tmp), write_like_original=write_like_original)
+        else:
+            with open(tmp, "wb") as f:
+                f.write(data)
+        os.replace(tmp, path)
+        self._record(*uids)
+        if cache and self.instance_cache is not None:
+            self.instance_cache.put_file(path, *uids)
+        return True
+
+    def discard_streamed(self, mrn, workspace_modalities):
+        """
+        Forget the instances of `mrn` that only existed in an abandoned archive.
+
+        Every modality not in `workspace_modalities` was streamed, so its
+        index entries and any header-only stubs under ``<mrn>`` are removed.
+        The workspace files are kept, so a rerun resumes from them and
+        retrieves the rest again.
+        """
+        mrn = str(mrn)
+        removed = []
+        for study in self._subdirs(self.base_dir / mrn):
+            for modality in self._subdirs(study.path):
+                if modality.name not in workspace_modalities:
+                    shutil.rmtree(modality.path, ignore_errors=True)
+                    removed.append(modality.path)
+        with self._lock:
+            for index in (self._instances, self._series):
+                for key in [k for k in index if k[0] == mrn and k[2] not in workspace_modalities]:
+                    del index[key]
+            self._created_dirs = {
+                d for d in self._created_dirs
+                if not any(d == r or d.startswith(r + os.sep) for r in removed)
+            }
 
+    def discard_patient(self, mrn):
+        """Forget everything indexed for `mrn` (after its TEMP folder is removed)."""
+        mrn = str(mrn)
+        prefix = str(self.base_dir / mrn)
+        with self._lock:
+            for index in (self._instances, self._series):
+                for key in [k for k in index if k[0] == mrn]:
+                    del index[key]
+            self._created_dirs = {
+                d for d in self._created_dirs
+                if d != prefix and not d.startswith(prefix + os.sep)
+            }
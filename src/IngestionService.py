@@ -0,0 +1,378 @@
+"""
+Long-running ingestion: one warm SCP and SCU serving a queue of MRNs.
+
+A CLI run imports the DICOM and report stacks, binds the SCP port and
+associates with the clinical server for every patient. `IngestionService`
+does that once: `open` builds the SCP (listening from then on), the SCU
+(keeping one association per remote AE open between requests), the archive,
+instance cache and packager, and `process` runs TaskManager and the report
+for one MRN on them. `main.start` processes a single MRN this way; `serve`
+takes MRNs from a job directory until stopped::
+
+    JOBS/incoming/     submitted jobs, processed oldest first
+    JOBS/processing/   the job being processed (requeued on restart)
+    JOBS/done/         finished jobs, with their result
+    JOBS/failed/       failed jobs, with the error
+
+A job is a JSON file ``{"mrn": ...}``; `submit_job` writes one atomically,
+so a half-written job is never picked up.
+"""
+
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+from . import tracing
+from ._globals import JOBS_DIRECTORY
+from .config import get_setting, load_config
+from .logger_setup import TaskManager_task_logger, core_logger, purge_logs
+
+JOB_STATES = ("incoming", "processing", "done", "failed")
+# Purge old log rows at most this often while serving
+PURGE_INTERVAL = 24 * 3600
+
+
+def job_directories(jobs_dir=JOBS_DIRECTORY) -> Dict[str, Path]:
+    """Create and return the directory of each job state."""
+    directories = {state: Path(jobs_dir) / state for state in JOB_STATES}
+    for directory in directories.values():
+        directory.mkdir(parents=True, exist_ok=True)
+    return directories
+
+
+def submit_job(mrn: str, jobs_dir=JOBS_DIRECTORY) -> Path:
+    """
+    Queue `mrn` for a running service.
+
+    Returns
+    -------
+    Path
+        The job file in ``incoming``.
+    """
+    incoming = job_directories(jobs_dir)["incoming"]
+    mrn = str(mrn).strip()
+    # Names sort by submission time, which is the processing order
+    name = f"{time.time_ns()}_{os.getpid()}_{''.join(c if c.isalnum() else '_' for c in mrn)}.json"
+    tmp = incoming / f".{name}.tmp"
+    tmp.write_text(json.dumps({"mrn": mrn, "submitted": time.time()}))
+    os.replace(tmp, incoming / name)
+    core_logger.info(f"Queued MRN {mrn} as job {name}")
+    return incoming / name
+
+
+class IngestionService:
+    """
+    SCP, SCU and storage components shared by every MRN processed.
+
+    Parameters
+    ----------
+    config : dict, optional
+        Loaded config.json, by default loaded here.
+    keep_alive : bool, optional
+        Keep the SCU's associations open between requests, by default True.
+        Configurable as SERVICE.KEEP_ALIVE.
+    jobs_dir : Path, optional
+        Root of the job queue used by `serve`, by default JOBS_DIRECTORY.
+    poll_interval : float, optional
+        Seconds between checks of an empty queue, by default 1.0.
+        Configurable as SERVICE.POLL_INTERVAL.
+    """
+
+    def __init__(
+        self,
+        config: Optional[Dict] = None,
+        keep_alive: Optional[bool] = None,
+        jobs_dir=JOBS_DIRECTORY,
+        poll_interval: Optional[float] = None,
+    ):
+        self.config = config if config is not None else load_config()
+        self.keep_alive = (
+            keep_alive if keep_alive is not None else get_setting(self.config, "SERVICE", "KEEP_ALIVE", True)
+        )
+        self.jobs_dir = Path(jobs_dir)
+        self.poll_interval = (
+            poll_interval if poll_interval is not None
+            else get_setting(self.config, "SERVICE", "POLL_INTERVAL", 1.0)
+        )
+        self.scu = None
+        self.scp = None
+        self.archive_manager = None
+        self.instance_cache = None
+        self.packager = None
+        self._stop = threading.Event()
+        self._last_purge = None
+
+    def open(self):
+        """Import the DICOM stack and build the shared components; the SCP starts listening."""
+        from .ArchiveManager import ArchiveManager
+        from .FileManager import FileManager
+        from .InstanceCache import InstanceCache
+        from .OutputPackager import OutputPackager
+        from .QueryRetrieveSCU_rosamllib import MySCU
+        from .StoreSCPRosamllib import MyStoreSCP
+
+        config = self.config
+
+        # --- Extract SCP / Clinical info ---
+        scp_cfg = config["SCP_SERVER"]
+        clinical_cfg = config["CLINICAL_SERVER"]
+
+        SCP_AETITLE = scp_cfg["AETITLE"]
+        SCP_HOST = scp_cfg["HOST"]
+        SCP_PORT = scp_cfg["PORT"]
+
+        CLINICAL_AETITLE = clinical_cfg["AETITLE"]
+        CLINICAL_HOST = clinical_cfg["HOST"]
+        CLINICAL_PORT = clinical_cfg["PORT"]
+
+        # --- Optional storage admission watermarks ---
+        scp_options = {}
+        for key, option in (
+            ("MAX_PENDING_WRITES", "max_pending_writes"),
+            ("MAX_PENDING_BYTES", "max_pending_bytes"),
+            ("MIN_FREE_BYTES", "min_free_bytes"),
+            ("RESUME_FREE_BYTES", "resume_free_bytes"),
+        ):
+            value = get_setting(config, "STORAGE", key)
+            if value is not None:
+                scp_options[option] = value
+
+        # --- Optional C-STORE hot-path logging (sampling and slow-store threshold) ---
+        for key, option in (
+            ("SAMPLE_EVERY", "hot_path_sample_every"),
+            ("SLOW_STORE_MS", "slow_store_ms"),
+        ):
+            value = get_setting(config, "LOGGING", key)
+            if value is not None:
+                scp_options[option] = value
+        hot_path_level = get_setting(config, "LOGGING", "HOT_PATH_LEVEL")
+        if hot_path_level is not None:
+            scp_options["hot_path_level"] = (
+                hot_path_level if isinstance(hot_path_level, int)
+                else logging.getLevelName(str(hot_path_level).upper())
+            )
+
+        # --- Optional streaming of received instances into OUTPUT/<mrn>.zip ---
+        if get_setting(config, "STORAGE", "STREAM_TO_ARCHIVE", False):
+            self.archive_manager = ArchiveManager(
+                batch_bytes=get_setting(config, "STORAGE", "ARCHIVE_BATCH_BYTES", 64 * 1024**2),
+                packager=OutputPackager("zip", workers=get_setting(config, "STORAGE", "PACKAGE_WORKERS")),
+            )
+
+        # --- Output package: zip (default), tar or tar.zst, with a checksum manifest ---
+        self.packager = OutputPackager(
+            get_setting(config, "STORAGE", "PACKAGE_FORMAT", "zip"),
+            workers=get_setting(config, "STORAGE", "PACKAGE_WORKERS"),
+        )
+
+        # --- Optional persistent cross-run instance cache ---
+        cache_max_bytes = get_setting(config, "STORAGE", "CACHE_MAX_BYTES", 0)
+        if cache_max_bytes:
+            self.instance_cache = InstanceCache(max_bytes=cache_max_bytes)
+        file_manager = FileManager(instance_cache=self.instance_cache)
+
+        # --- Initialize DICOM SCU and SCP ---
+        self.scu = MySCU(SCP_AETITLE, config=config, keep_alive=self.keep_alive)
+        self.scu.add_remote_ae(CLINICAL_AETITLE, CLINICAL_AETITLE, CLINICAL_HOST, CLINICAL_PORT)
+        self.scu.add_remote_ae(SCP_AETITLE, SCP_AETITLE, SCP_HOST, SCP_PORT)
+        self.scp = MyStoreSCP(
+            SCP_AETITLE,
+            SCP_HOST,
+            SCP_PORT,
+            archive_manager=self.archive_manager,
+            file_manager=file_manager,
+            **scp_options,
+        )
+        self.scp.start()
+
+    def report_options(self) -> Dict:
+        """`PdfParser_Rosamllib.run` options from the REPORT section."""
+        config = self.config
+        options = {
+            "render_backend": get_setting(config, "REPORT", "RENDER_BACKEND", "matplotlib"),
+            "incremental": get_setting(config, "REPORT", "INCREMENTAL", True),
+        }
+        # --- Optional report image encoding (format, print dpi, PDF size budget) and cache budgets ---
+        for key, option in (
+            ("IMAGE_FORMAT", "image_format"),
+            ("IMAGE_DPI", "image_dpi"),
+            ("PDF_MAX_BYTES", "pdf_max_bytes"),
+            ("JPEG_QUALITY", "jpeg_quality"),
+            ("PROJECTION_CACHE_MAX_BYTES", "projection_cache_max_bytes"),
+            ("REPORT_CACHE_MAX_BYTES", "report_cache_max_bytes"),
+            ("REPORT_CACHE_RETENTION_DAYS", "report_cache_retention_days"),
+        ):
+            value = get_setting(config, "REPORT", key)
+            if value is not None:
+                options[option] = value
+        return options
+
+    def process(self, mrn: str):
+        """
+        Retrieve everything for `mrn`, build its report and package its output.
+
+        After a success nothing of the patient is left behind for the next
+        job. After a failure only a partial archive is abandoned: ``TEMP/<mrn>``
+        keeps the files written so far, so a rerun resumes from them.
+        """
+        from .TaskManagerRosamllib import TaskManager
+
+        mrn = str(mrn)
+        config = self.config
+        report_options = self.report_options()
+        report_worker = None
+        succeeded = False
+        core_logger.info(f"Starting DataIngestion for MRN: {mrn}")
+
+        # --- Optional Chrome trace of the run (LOGS/traces/<mrn>_<time>.json) ---
+        if get_setting(config, "LOGGING", "TRACE", False):
+            tracing.start_trace(mrn)
+        try:
+            # --- Optional precomputation of each plan's report entry as it arrives ---
+            if report_options["incremental"] and get_setting(config, "REPORT", "PRECOMPUTE", True):
+                from .ReportWorker import ReportWorker
+
+                report_worker = ReportWorker(
+                    mrn,
+                    render_backend=report_options["render_backend"],
+                    projection_cache_max_bytes=report_options.get("projection_cache_max_bytes"),
+                )
+
+            # --- Run TaskManager ---
+            try:
+                tm = TaskManager(
+                    self.scu,
+                    self.scp,
+                    mrn=mrn,
+                    log_level_cli="INFO",
+                    dose_selection=get_setting(config, "RETRIEVAL", "DOSE_SELECTION", "PLAN"),
+                    on_plan_complete=report_worker.plan_complete if report_worker else None,
+                )
+                TaskManager.task_logger = TaskManager_task_logger  # assign SQLAlchemy logger
+                tm.run()
+            finally:
+                # The report reads what the worker precomputed
+                if report_worker is not None:
+                    report_worker.close()
+
+            # --- Run PDF parser ---
+            from .PdfParser_Rosamllib import run
+
+            with tracing.span("report", "pdf"):
+                run(mrn, archive_manager=self.archive_manager, packager=self.packager, **report_options)
+            succeeded = True
+            core_logger.info("DataIngestion complete.")
+        finally:
+            if succeeded:
+                # The archive is finalized and TEMP/<mrn> is gone
+                self.scp.file_manager.discard_patient(mrn)
+            elif self.archive_manager is not None:
+                self.archive_manager.discard(mrn)
+                # Streamed instances went with the archive
+                self.scp.file_manager.discard_streamed(mrn, self.archive_manager.workspace_modalities)
+            tracing.stop_trace()
+
+    def purge_logs(self, force: bool = False):
+        """Apply LOGGING.RETENTION_DAYS, at most once per `PURGE_INTERVAL` unless `force`."""
+        retention_days = get_setting(self.config, "LOGGING", "RETENTION_DAYS")
+        now = time.monotonic()
+        if not retention_days:
+            return
+        if force or self._last_purge is None or now - self._last_purge >= PURGE_INTERVAL:
+            purge_logs(retention_days)
+            self._last_purge = now
+
+    def close(self):
+        """Stop the SCP and release the SCU's associations and the storage components."""
+        if self.scp is not None:
+            self.scp.stop()
+        if self.scu is not None:
+            self.scu.release_associations()
+        if self.archive_manager is not None:
+            self.archive_manager.close()
+        if self.packager is not None:
+            self.packager.close()
+        if self.instance_cache is not None:
+            self.instance_cache.close()
+
+    # --- Job queue ---
+
+    def stop(self, *signal_args):
+        """
+        Finish the current job, then return from `serve`.
+
+        As the signal handler, a second signal interrupts the current job.
+        """
+        if signal_args and self._stop.is_set():
+            raise KeyboardInterrupt
+        self._stop.set()
+
+    def _claim_next(self, directories) -> Optional[Path]:
+        for job in sorted(directories["incoming"].glob("*.json")):
+            claimed = directories["processing"] / job.name
+            try:
+                os.replace(job, claimed)
+            except OSError:
+                continue  # taken by another service on the same queue
+            return claimed
+        return None
+
+    def _finish(self, job: Path, state: str, result: Dict):
+        try:
+            data = json.loads(job.read_text())
+        except (OSError, ValueError):
+            data = {}
+        data.update(result)
+        target = self.jobs_dir / state / job.name
+        job.write_text(json.dumps(data))
+        os.replace(job, target)
+
+    def run_job(self, job: Path) -> bool:
+        """Process one claimed job and file it under ``done`` or ``failed``."""
+        t0 = time.perf_counter()
+        try:
+            mrn = str(json.loads(job.read_text())["mrn"]).strip()
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            core_logger.error(f"Unreadable job {job.name}: {e}")
+            self._finish(job, "failed", {"error": f"Unreadable job: {e}"})
+            return False
+        try:
+            self.process(mrn)
+        except (Exception, SystemExit) as e:
+            # The report exits when a plan's CT is missing; that fails this job only
+            core_logger.error(f"Job {job.name} for MRN {mrn} failed: {e!r}", exc_info=True)
+            self._finish(job, "failed", {"error": repr(e), "seconds": round(time.perf_counter() - t0, 2)})
+            return False
+        seconds = time.perf_counter() - t0
+        core_logger.info(f"Job {job.name} for MRN {mrn} finished in {seconds:.2f} seconds")
+        self._finish(job, "done", {"seconds": round(seconds, 2)})
+        return True
+
+    def serve(self):
+        """
+        Process queued MRNs until `stop` (SIGINT/SIGTERM) is called.
+
+        Jobs left in ``processing`` by an interrupted service are requeued.
+        The caller opens and closes the service.
+        """
+        directories = job_directories(self.jobs_dir)
+        for job in directories["processing"].glob("*.json"):
+            core_logger.warning(f"Requeuing interrupted job {job.name}")
+            os.replace(job, directories["incoming"] / job.name)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.stop)
+            signal.signal(signal.SIGTERM, self.stop)
+        core_logger.info(f"Ingestion service waiting for jobs in {directories['incoming']}")
+        while not self._stop.is_set():
+            self.purge_logs()
+            job = self._claim_next(directories)
+            if job is None:
+                self._stop.wait(self.poll_interval)
+                continue
+            self.run_job(job)
+        core_logger.info("Ingestion service stopped.")
@@ -0,0 +1,320 @@
+"""
+Persistent, size-bounded local cache of received DICOM instances.
+
+Every run zips and deletes its TEMP workspace, so a repeat request for the
+same patient would otherwise pull every CT, dose and record from the clinical
+PACS again. The cache keeps one copy of each instance under ``CACHE/``,
+addressed by SOPInstanceUID, and evicts least-recently-used instances once a
+byte budget is exceeded. Files enter and leave the workspace as hardlinks
+where the filesystem allows it, so caching costs no extra copy.
+"""
+
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from sqlalchemy import Column, Float, Integer, String, Text, create_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+from ._globals import CACHE_DIRECTORY
+from .logger_setup import core_logger
+
+Base = declarative_base()
+
+
+class CachedInstance(Base):
+    __tablename__ = "instances"
+    sop_uid = Column(String(64), primary_key=True)
+    mrn = Column(String(64))
+    study_uid = Column(String(64))
+    modality = Column(String(16))
+    series_uid = Column(String(64))
+    size = Column(Integer)
+    last_access = Column(Float, index=True)
+
+
+class CachedSeries(Base):
+    """Membership of series that were moved completely (series-level C-MOVE)."""
+
+    __tablename__ = "series"
+    series_uid = Column(String(64), primary_key=True)
+    sop_uids = Column(Text)
+
+
+def _link_or_copy(src, dst):
+    """Hardlink `src` to `dst`, copying when links are not possible."""
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class InstanceCache:
+    """
+    LRU cache of DICOM instances keyed by SOPInstanceUID.
+
+    Parameters
+    ----------
+    cache_dir : Path, optional
+        Cache root, by default CACHE_DIRECTORY.
+    max_bytes : int, optional
+        Byte budget; least-recently-used instances are evicted beyond it,
+        by default 50 GiB.
+    flush_every : int, optional
+        Number of index changes buffered before they are committed to
+        ``index.db``, by default 256.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIRECTORY, max_bytes: int = 50 * 1024**3, flush_every: int = 256):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._engine = create_engine(f"sqlite:///{self.cache_dir / 'index.db'}", echo=False)
+        Base.metadata.create_all(self._engine)
+        self._Session = sessionmaker(bind=self._engine)
+
+        # sop_uid -> metadata, least recently used first
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._series: Dict[str, List[str]] = {}
+        self._total_bytes = 0
+        self._dirty = set()
+        self._deleted = set()
+        self._dirty_series = set()
+        self._shards = set()
+        self._load()
+
+    def _load(self):
+        with self._Session() as session:
+            rows = session.query(CachedInstance).order_by(CachedInstance.last_access).all()
+            for row in rows:
+                self._entries[row.sop_uid] = {
+                    "mrn": row.mrn,
+                    "study_uid": row.study_uid,
+                    "modality": row.modality,
+                    "series_uid": row.series_uid,
+                    "size": row.size or 0,
+                    "last_access": row.last_access or 0.0,
+                }
+                self._total_bytes += row.size or 0
+            for row in session.query(CachedSeries).all():
+                self._series[row.series_uid] = json.loads(row.sop_uids)
+        self._remove_orphans()
+        core_logger.info(
+            f"Instance cache loaded: {len(self._entries)} instances, "
+            f"{self._total_bytes / 1e9:.2f} GB of {self.max_bytes / 1e9:.2f} GB."
+        )
+
+    def _remove_orphans(self):
+        """Delete cached files whose index rows were lost (e.g. after a crash)."""
+        for shard in os.scandir(self.cache_dir):
+            # Shards are named by the last two UID characters; longer names
+            # (projections/, reports/) belong to other caches
+            if not shard.is_dir() or len(shard.name) > 2:
+                continue
+            self._shards.add(shard.name)
+            with os.scandir(shard.path) as it:
+                for entry in it:
+                    if entry.name[: -len(".dcm")] not in self._entries:
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            pass
+
+    def path(self, sop_uid: str) -> Path:
+        """Location of the cached copy of `sop_uid` (it need not exist)."""
+        return self.cache_dir / sop_uid[-2:] / f"{sop_uid}.dcm"
+
+    def __contains__(self, sop_uid) -> bool:
+        with self._lock:
+            return sop_uid in self._entries
+
+    def get(self, sop_uid: str) -> Optional[Dict]:
+        """Return the metadata of a cached instance and mark it recently used."""
+        with self._lock:
+            entry = self._entries.get(sop_uid)
+            if entry is None:
+                return None
+            self._touch_locked(sop_uid)
+            return dict(entry)
+
+    def _touch_locked(self, sop_uid: str):
+        self._entries[sop_uid]["last_access"] = time.time()
+        self._entries.move_to_end(sop_uid)
+        self._dirty.add(sop_uid)
+
+    def put_file(self, src_path, mrn, study_uid, modality, series_uid, sop_uid) -> bool:
+        """
+        Add an instance already written to the workspace.
+
+        The cache entry is a hardlink to `src_path` when possible.
+
+        Returns
+        -------
+        bool
+            True if the instance was added, False if it was already cached.
+        """
+        with self._lock:
+            if sop_uid in self._entries:
+                self._touch_locked(sop_uid)
+                return False
+        target = self.path(sop_uid)
+        self._ensure_shard(target.parent)
+        _link_or_copy(src_path, target)
+        self._add(target, mrn, study_uid, modality, series_uid, sop_uid)
+        return True
+
+    def put_bytes(self, data: bytes, mrn, study_uid, modality, series_uid, sop_uid) -> bool:
+        """Add an instance that only exists in memory (e.g. streamed to the archive)."""
+        with self._lock:
+            if sop_uid in self._entries:
+                self._touch_locked(sop_uid)
+                return False
+        target = self.path(sop_uid)
+        self._ensure_shard(target.parent)
+        with open(target, "wb") as f:
+            f.write(data)
+        self._add(target, mrn, study_uid, modality, series_uid, sop_uid)
+        return True
+
+    def _ensure_shard(self, directory: Path):
+        if directory.name not in self._shards:
+            directory.mkdir(parents=True, exist_ok=True)
+            self._shards.add(directory.name)
+
+    def _add(self, target: Path, mrn, study_uid, modality, series_uid, sop_uid):
+        size = os.stat(target).st_size
+        with self._lock:
+            self._entries[sop_uid] = {
+                "mrn": mrn,
+                "study_uid": study_uid,
+                "modality": modality,
+                "series_uid": series_uid,
+                "size": size,
+                "last_access": time.time(),
+            }
+            self._total_bytes += size
+            self._dirty.add(sop_uid)
+            self._deleted.discard(sop_uid)
+            self._evict_locked()
+            pending = len(self._dirty) + len(self._deleted)
+        if pending >= self.flush_every:
+            self.flush()
+
+    def _evict_locked(self):
+        while self._total_bytes > self.max_bytes and self._entries:
+            sop_uid, entry = self._entries.popitem(last=False)
+            self._total_bytes -= entry["size"]
+            self._dirty.discard(sop_uid)
+            self._deleted.add(sop_uid)
+            try:
+                os.remove(self.path(sop_uid))
+            except OSError:
+                pass
+            series = self._series.pop(entry["series_uid"], None)
+            if series is not None:
+                self._dirty_series.add(entry["series_uid"])
+
+    def materialize(self, sop_uid: str, dest_path) -> bool:
+        """
+        Hardlink (or copy) a cached instance into the run workspace.
+
+        Returns
+        -------
+        bool
+            False if the instance is not cached or its file has gone missing.
+        """
+        if self.get(sop_uid) is None:
+            return False
+        dest_path = Path(dest_path)
+        dest_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            _link_or_copy(self.path(sop_uid), dest_path)
+        except FileNotFoundError:
+            self.discard(sop_uid)
+            return False
+        return True
+
+    def discard(self, sop_uid: str):
+        """Drop an instance from the cache."""
+        with self._lock:
+            entry = self._entries.pop(sop_uid, None)
+            if entry is None:
+                return
+            self._total_bytes -= entry["size"]
+            self._dirty.discard(sop_uid)
+            self._deleted.add(sop_uid)
+        try:
+            os.remove(self.path(sop_uid))
+        except OSError:
+            pass
+
+    def mark_series_complete(self, series_uid: str, sop_uids):
+        """Remember that `sop_uids` is the full membership of `series_uid`."""
+        with self._lock:
+            self._series[series_uid] = sorted(sop_uids)
+            self._dirty_series.add(series_uid)
+
+    def series_members(self, series_uid: str) -> Optional[List[str]]:
+        """
+        Return the SOPInstanceUIDs of a completely cached series.
+
+        Returns
+        -------
+        List[str] or None
+            None unless the series was moved completely before and every
+            member is still cached.
+        """
+        with self._lock:
+            members = self._series.get(series_uid)
+            if not members or any(sop not in self._entries for sop in members):
+                return None
+            return list(members)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "instances": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "series": len(self._series),
+            }
+
+    def flush(self):
+        """Commit buffered index changes to ``index.db``."""
+        with self._lock:
+            dirty = {sop: dict(self._entries[sop]) for sop in self._dirty if sop in self._entries}
+            deleted = list(self._deleted)
+            series = {uid: self._series.get(uid) for uid in self._dirty_series}
+            self._dirty.clear()
+            self._deleted.clear()
+            self._dirty_series.clear()
+        if not (dirty or deleted or series):
+            return
+        with self._Session() as session:
+            for sop_uid, entry in dirty.items():
+                session.merge(CachedInstance(sop_uid=sop_uid, **entry))
+            if deleted:
+                session.query(CachedInstance).filter(
+                    CachedInstance.sop_uid.in_(deleted)
+                ).delete(synchronize_session=False)
+            for series_uid, members in series.items():
+                if members is None:
+                    session.query(CachedSeries).filter(
+                        CachedSeries.series_uid == series_uid
+                    ).delete(synchronize_session=False)
+                else:
+                    session.merge(CachedSeries(series_uid=series_uid, sop_uids=json.dumps(members)))
+            session.commit()
+
+    def close(self):
+        self.flush()
+        self._engine.dispose()
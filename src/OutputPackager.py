@@ -0,0 +1,338 @@
+"""
+Packages a patient's output directory for delivery.
+
+Members are compressed in a thread pool (zlib releases the GIL), and each
+member is stored or deflated according to its content. DICOM with a
+compressed transfer syntax (JPEG, JPEG 2000, RLE, ...), the PDF and images
+are stored as-is, because deflating them costs the most CPU for the least
+gain. Anything that does not shrink is stored too. Every package carries a
+``MANIFEST.sha256`` (``sha256sum -c`` format) so the receiving clinic can
+verify each file. ``tar`` and ``tar.zst`` (needs the optional ``zstandard``
+package) are available as alternatives to ZIP.
+"""
+
+import hashlib
+import os
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pydicom.filereader import read_file_meta_info
+from pydicom.uid import UID
+
+from .logger_setup import archive_logger
+
+PACKAGE_FORMATS = ("zip", "tar", "tar.zst")
+MANIFEST_NAME = "MANIFEST.sha256"
+# Extensions whose content is already compressed
+STORED_EXTENSIONS = (".pdf", ".png", ".jpg", ".jpeg", ".gif", ".zip", ".gz", ".zst", ".npz")
+# Deflated output must be smaller than this share of the input to be kept
+MIN_DEFLATE_SAVING = 0.97
+# Members larger than this are streamed by zipfile instead of held in memory
+MAX_IN_MEMORY_BYTES = 32 * 1024**2
+# Bytes of input files read ahead of the archive writer, by default
+WINDOW_BYTES = 256 * 1024**2
+
+
+def _supports_precompressed_writes() -> bool:
+    """
+    True if `write_precompressed` can use this interpreter's ZipFile internals.
+
+    They are private, so only the versions the writer was checked against
+    (with `compress_member` round trips, zip64 sizes included) are trusted.
+    """
+    if not (3, 10) <= sys.version_info[:2] <= (3, 13):
+        return False
+    probe = zipfile.ZipFile(BytesIO(), "w")
+    try:
+        return all(
+            hasattr(probe, name)
+            for name in ("_lock", "_writecheck", "_didModify", "_writing", "fp", "filelist", "NameToInfo", "start_dir")
+        ) and hasattr(zipfile.ZipInfo, "FileHeader")
+    finally:
+        probe.close()
+
+
+# Otherwise members are compressed by `ZipFile.writestr`, under the archive lock
+PRECOMPRESSED_WRITES = _supports_precompressed_writes()
+
+
+def _is_compressed_dicom(path: str) -> bool:
+    try:
+        syntax = read_file_meta_info(path).get("TransferSyntaxUID")
+    except Exception:
+        return False
+    return syntax is not None and UID(syntax).is_compressed
+
+
+def store_as_is(arcname: str, path: Optional[str] = None) -> bool:
+    """True if the member should not be recompressed."""
+    name = arcname.lower()
+    if name.endswith(STORED_EXTENSIONS):
+        return True
+    return bool(path) and name.endswith(".dcm") and _is_compressed_dicom(path)
+
+
+def compress_member(arcname: str, data: bytes, store: bool = False, level: int = 6):
+    """
+    Prepare one ZIP member outside the archive lock.
+
+    Without `PRECOMPRESSED_WRITES` only the compression method is chosen and
+    the payload is `data`, left for `write_precompressed` to compress (at
+    zlib's default level).
+
+    Returns
+    -------
+    tuple
+        (ZipInfo with sizes and CRC filled in, payload bytes, SHA-256 hex of
+        `data`).
+    """
+    zinfo = zipfile.ZipInfo(arcname, date_time=time.localtime(time.time())[:6])
+    zinfo.external_attr = 0o600 << 16
+    zinfo.file_size = len(data)
+    zinfo.CRC = zlib.crc32(data)
+    payload = data
+    zinfo.compress_type = zipfile.ZIP_STORED
+    if not PRECOMPRESSED_WRITES:
+        if not store and data:
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+    elif not store and data:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        deflated = compressor.compress(data) + compressor.flush()
+        if len(deflated) < MIN_DEFLATE_SAVING * len(data):
+            payload = deflated
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.compress_size = len(payload)
+    return zinfo, payload, hashlib.sha256(data).hexdigest()
+
+
+def write_precompressed(zipf: zipfile.ZipFile, zinfo: zipfile.ZipInfo, payload: bytes):
+    """
+    Append a member prepared by `compress_member` to an archive open for writing.
+
+    This mirrors what `ZipFile.writestr` does after compressing, so the
+    central directory written on close includes the member. Without
+    `PRECOMPRESSED_WRITES` the member is written by `ZipFile.writestr`.
+    """
+    if not PRECOMPRESSED_WRITES:
+        zipf.writestr(zinfo, payload)
+        return
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+    with zipf._lock:
+        if zipf._writing:
+            raise ValueError("Can't write to ZIP archive while an open writing handle exists.")
+        zipf._writecheck(zinfo)
+        zipf._didModify = True
+        zinfo.header_offset = zipf.fp.tell()
+        zipf.fp.write(zinfo.FileHeader(zip64))
+        zipf.fp.write(payload)
+        zipf.filelist.append(zinfo)
+        zipf.NameToInfo[zinfo.filename] = zinfo
+        zipf.start_dir = zipf.fp.tell()
+
+
+def manifest_bytes(digests: Dict[str, str]) -> bytes:
+    """``sha256sum``-style manifest of `digests` (arcname -> hex)."""
+    return "".join(f"{digest}  {name}\n" for name, digest in sorted(digests.items())).encode()
+
+
+def _sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _walk(directory_path) -> List[Tuple[str, str]]:
+    """(path, arcname) of every file under `directory_path`, sorted."""
+    members = []
+    for root, _, files in os.walk(directory_path):
+        for file in files:
+            full_path = os.path.join(root, file)
+            members.append((full_path, Path(os.path.relpath(full_path, directory_path)).as_posix()))
+    return sorted(members, key=lambda m: m[1])
+
+
+class OutputPackager:
+    """
+    Parallel, format-aware packager for output directories.
+
+    Parameters
+    ----------
+    fmt : str, optional
+        One of `PACKAGE_FORMATS`, by default "zip". "tar.zst" falls back to
+        "zip" (with a warning) when ``zstandard`` is not installed.
+    workers : int, optional
+        Compression/hashing threads, by default the CPU count.
+    level : int, optional
+        DEFLATE (1-9) or zstd (1-22) level, by default 6 (zstd: 3 if unset).
+    window_bytes : int, optional
+        Bytes of files read and compressed ahead of the ZIP writer, by
+        default `WINDOW_BYTES`. Each holds its data and payload, so peak
+        memory is about twice this.
+    """
+
+    def __init__(
+        self,
+        fmt: str = "zip",
+        workers: Optional[int] = None,
+        level: Optional[int] = None,
+        window_bytes: int = WINDOW_BYTES,
+    ):
+        if fmt not in PACKAGE_FORMATS:
+            raise ValueError(f"Unknown package format {fmt!r}; expected one of {PACKAGE_FORMATS}.")
+        if fmt == "tar.zst":
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                archive_logger.warning("zstandard is not installed; packaging as zip instead of tar.zst.")
+                fmt = "zip"
+        self.fmt = fmt
+        self.workers = workers or os.cpu_count() or 1
+        self.level = level
+        self.window_bytes = window_bytes
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+
+    def _executor(self) -> ThreadPoolExecutor:
+        """The compression pool, started on first use and kept for later batches."""
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="OutputPackager")
+            return self._pool
+
+    def close(self):
+        """Stop the compression threads (they are restarted if the packager is used again)."""
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+
+    def output_path(self, output_base) -> Path:
+        """`output_base` with this format's extension."""
+        return Path(f"{output_base}.{self.fmt}")
+
+    def _prepare(self, path: str, arcname: str):
+        with open(path, "rb") as f:
+            data = f.read()
+        return compress_member(arcname, data, store_as_is(arcname, path), self.level or 6)
+
+    def write_zip_members(self, zipf: zipfile.ZipFile, members: Iterable[Tuple[str, bytes]]) -> Dict[str, str]:
+        """
+        Compress in-memory (arcname, data) members in parallel and append them.
+
+        Returns
+        -------
+        dict
+            arcname -> SHA-256 hex.
+        """
+        level = self.level or 6
+        prepared = self._executor().map(lambda m: compress_member(m[0], m[1], store_as_is(m[0]), level), members)
+        digests = {}
+        for zinfo, payload, digest in prepared:
+            write_precompressed(zipf, zinfo, payload)
+            digests[zinfo.filename] = digest
+        return digests
+
+    def write_zip_files(self, zipf: zipfile.ZipFile, members: List[Tuple[str, str]]) -> Dict[str, str]:
+        """
+        Append (path, arcname) files to `zipf`, compressing in parallel.
+
+        Files are read ahead of the writer until `window_bytes` are in
+        flight (at least one file); files over `MAX_IN_MEMORY_BYTES` are
+        streamed by zipfile itself.
+
+        Returns
+        -------
+        dict
+            arcname -> SHA-256 hex.
+        """
+        digests = {}
+        sizes = [os.path.getsize(p) for p, _ in members]
+        small = [(p, a, size) for (p, a), size in zip(members, sizes) if size <= MAX_IN_MEMORY_BYTES]
+        large = [(p, a) for (p, a), size in zip(members, sizes) if size > MAX_IN_MEMORY_BYTES]
+        pool = self._executor()
+        in_flight = deque()
+        held = 0
+
+        def write_next():
+            size, future = in_flight.popleft()
+            zinfo, payload, digest = future.result()
+            write_precompressed(zipf, zinfo, payload)
+            digests[zinfo.filename] = digest
+            return size
+
+        for path, arcname, size in small:
+            while in_flight and held + size > self.window_bytes:
+                held -= write_next()
+            in_flight.append((size, pool.submit(self._prepare, path, arcname)))
+            held += size
+        while in_flight:  # archive order = submission order
+            write_next()
+        for path, arcname in large:
+            compress = zipfile.ZIP_STORED if store_as_is(arcname, path) else zipfile.ZIP_DEFLATED
+            zipf.write(path, arcname, compress_type=compress)
+            digests[arcname] = _sha256_file(path)
+        return digests
+
+    def package(self, directory_path, output_base) -> Path:
+        """
+        Package every file under `directory_path` with a checksum manifest.
+
+        Parameters
+        ----------
+        directory_path : Path or str
+            Directory whose contents become the package root.
+        output_base : Path or str
+            Output path without extension (e.g. ``OUTPUT/<mrn>``).
+
+        Returns
+        -------
+        Path
+            The written package.
+        """
+        members = _walk(directory_path)
+        out_path = self.output_path(output_base)
+        t0 = time.perf_counter()
+        if self.fmt == "zip":
+            with zipfile.ZipFile(out_path, "w", zipfile.ZIP_DEFLATED) as zipf:
+                digests = self.write_zip_files(zipf, members)
+                write_precompressed(zipf, *compress_member(MANIFEST_NAME, manifest_bytes(digests))[:2])
+        else:
+            pool = self._executor()
+            digests = dict(zip((a for _, a in members), pool.map(_sha256_file, (p for p, _ in members))))
+            if self.fmt == "tar":
+                with tarfile.open(out_path, "w") as tar:
+                    self._write_tar(tar, members, digests)
+            else:
+                import zstandard
+
+                # zstd compresses with its own worker threads
+                compressor = zstandard.ZstdCompressor(level=self.level or 3, threads=self.workers)
+                with open(out_path, "wb") as raw, compressor.stream_writer(raw) as stream:
+                    with tarfile.open(fileobj=stream, mode="w|") as tar:
+                        self._write_tar(tar, members, digests)
+        archive_logger.info(
+            f"Packaged {len(members)} files into {out_path} "
+            f"({os.path.getsize(out_path) / 1e6:.1f} MB) in {time.perf_counter() - t0:.1f} s."
+        )
+        return out_path
+
+    @staticmethod
+    def _write_tar(tar: tarfile.TarFile, members, digests):
+        for path, arcname in members:
+            tar.add(path, arcname)
+        manifest = manifest_bytes(digests)
+        info = tarfile.TarInfo(MANIFEST_NAME)
+        info.size = len(manifest)
+        info.mtime = int(time.time())
+        tar.addfile(info, BytesIO(manifest))
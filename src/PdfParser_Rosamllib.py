@@ -1,7 +1,5 @@
 import os
-import pandas as pd
 import sys
-from tabulate import tabulate
 from reportlab.lib.units import inch
 from reportlab.lib.pagesizes import letter
 from reportlab.platypus import (
@@ -12,8 +10,8 @@ from reportlab.platypus import (
     Image,
     PageBreak,
 )
-from rosamllib.dicoms import RTDose
 from rosamllib.readers import DICOMLoader
+from pydicom import dcmread
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib import colors
 from ._globals import TEMP_DIRECTORY, OUTPUT_DIRECTORY
@@ -24,18 +22,35 @@ import numpy as np
 import SimpleITK as sitk
 import matplotlib
 
-from reportlab.pdfgen import canvas
 matplotlib.use("Agg")
-import matplotlib.pyplot as plt
 
-import zipfile
+from .OutputPackager import OutputPackager
 import shutil
 from .logger_setup import pdf_logger
+from . import tracing
+from . import PlanRenderer
+from . import report_images
+from .ProjectionCache import DEFAULT_MAX_BYTES as PROJECTION_CACHE_MAX_BYTES, ProjectionCache
+from .PlanIndex import PlanIndex
+from .ReportCache import DEFAULT_MAX_BYTES as REPORT_CACHE_MAX_BYTES, ReportCache
+from .record_summary import scan_record_summaries, summarize_plans
 
 class PDF_Parser:
     """ """
 
-    def __init__(self, mrn):
+    def __init__(
+        self,
+        mrn,
+        render_backend="matplotlib",
+        incremental=True,
+        image_format="png",
+        image_dpi=None,
+        pdf_max_bytes=None,
+        jpeg_quality=85,
+        projection_cache_max_bytes=PROJECTION_CACHE_MAX_BYTES,
+        report_cache_max_bytes=REPORT_CACHE_MAX_BYTES,
+        report_cache_retention_days=None,
+    ):
 
         self.mrn = mrn
         self.year = 0
@@ -54,122 +69,150 @@ class PDF_Parser:
             TEMP_DIRECTORY, os.path.join(self.mrn, "Radiotherapy_Treatment_History.pdf")
         )
         self.ct_list = []
-
+        self.beam_dose_uids = set()
+        self.record_summaries = scan_record_summaries([])
+        self.plan_summary = summarize_plans(self.record_summaries)
+        self.plan_stats = None
+        self.plan_renderer = PlanRenderer.PlanRenderer()
+        if render_backend not in PlanRenderer.RENDER_BACKENDS:
+            raise ValueError(
+                f"Unknown render backend {render_backend!r}; "
+                f"expected one of {PlanRenderer.RENDER_BACKENDS}."
+            )
+        self.render_backend = render_backend
+        self.projection_cache = ProjectionCache(max_bytes=projection_cache_max_bytes)
+        # Rendered plan PNGs by `ct_list` slot, encoded for the page by
+        # `embed_plan_images` (format, print dpi, PDF size budget)
+        self.plan_images = {}
+        if image_format not in report_images.IMAGE_FORMATS:
+            raise ValueError(
+                f"Unknown image format {image_format!r}; "
+                f"expected one of {report_images.IMAGE_FORMATS}."
+            )
+        self.image_format = image_format
+        self.image_dpi = image_dpi
+        self.pdf_max_bytes = pdf_max_bytes
+        self.jpeg_quality = jpeg_quality
+        # Fingerprints and results of the last report; with `incremental`
+        # they decide what is recomputed, otherwise only relative paths are used
+        self.incremental = incremental
+        self.report_cache = ReportCache(
+            mrn, max_bytes=report_cache_max_bytes, retention_days=report_cache_retention_days
+        )
 
     @staticmethod
-    def resamp(image: sitk.Image, new_spacing=(1.5, 1.5, 1.5), interpolator=sitk.sitkLinear):
-        """
-        Resample a SimpleITK image to isotropic spacing.
-        
-        Parameters
-        ----------
-        image : sitk.Image
-            Input SimpleITK image.
-        new_spacing : tuple of float
-            Desired voxel spacing (isotropic if all elements equal).
-        interpolator : sitk.InterpolatorEnum
-            Interpolation method (sitk.sitkLinear for CT, sitk.sitkNearestNeighbor for masks).
-        
-        Returns
-        -------
-        sitk.Image
-            Resampled image.
-        """
-        try:
-            # Original spacing and size
-            original_spacing = image.GetSpacing()
-            original_size = image.GetSize()
-
-            # Compute new size (preserve physical size of image)
-            new_size = [
-                int(round(osz * ospc / nspc))
-                for osz, ospc, nspc in zip(original_size, original_spacing, new_spacing)
-            ]
+    def report_image(data: bytes, aspect_ratio=(16, 18)) -> Image:
+        """Wrap an encoded plan image (PNG or JPEG) for the report."""
+        width, height = report_images.display_size(aspect_ratio)
+        return Image(io.BytesIO(data), width * inch, height * inch, hAlign="LEFT")
 
-            # Define resampler
-            resample = sitk.ResampleImageFilter()
-            resample.SetInterpolator(interpolator)
-            resample.SetOutputSpacing(new_spacing)
-            resample.SetSize(new_size)
-            resample.SetOutputDirection(image.GetDirection())
-            resample.SetOutputOrigin(image.GetOrigin())
-            resample.SetDefaultPixelValue(image.GetPixelIDValue())  # fill background if needed
-
-            return resample.Execute(image)
-        except Exception as e:
-            pdf_logger.error(f"Error during resampling: {e}")
-            raise
+    def embed_plan_images(self):
+        """
+        Encode the rendered plan images and place them in `ct_list`.
 
+        Images are resampled to `image_dpi` and encoded as `image_format`;
+        with `pdf_max_bytes` the resolution is lowered until the images fit
+        the budget left after the estimated size of the text.
+        """
+        slots = sorted(self.plan_images)
+        budget = None
+        if self.pdf_max_bytes:
+            budget = max(
+                1,
+                self.pdf_max_bytes
+                - report_images.PDF_BASE_BYTES
+                - report_images.PDF_BYTES_PER_PLAN * len(self.ct_list),
+            )
+        encoded, dpi = report_images.fit_images(
+            [self.plan_images[slot] for slot in slots],
+            fmt=self.image_format,
+            dpi=self.image_dpi,
+            budget_bytes=budget,
+            quality=self.jpeg_quality,
+        )
+        for slot, data in zip(slots, encoded):
+            self.ct_list[slot] = PDF_Parser.report_image(data)
+        pdf_logger.info(
+            f"Embedded {len(encoded)} plan images as {self.image_format} at {dpi:.0f} dpi "
+            f"({sum(map(len, encoded)) / 1e6:.2f} MB)."
+        )
 
     def create_image(
             self, ct, dose_image=None, aspect_ratio=(16, 18)
         ):
-
-
-        resamp_ct = PDF_Parser.resamp(ct)
-        ct_array = sitk.GetArrayFromImage(resamp_ct).astype(np.float16)
-
-        if dose_image:
-            res_dose = dose_image.resample_dose_to_image_grid(ct)
-            resampled_dose = PDF_Parser.resamp(res_dose)
-            resampled_dose = RTDose(resampled_dose)
-            resampled_dose.DoseGridScaling = dose_image.dose_grid_scaling
-            resampled_dose.DoseUnits = dose_image.DoseUnits
-            dose_array = resampled_dose.get_dose_array().astype(np.float32)
-            # res_dose = dose_image.resample_dose_to_image_grid(ct)
-            # dose_array = res_dose.get_dose_array() * 100
-            coronal_dose = np.sum(dose_array, axis=1)
-            sagittal_dose = np.sum(dose_array, axis=2)
-            corhalfmax = np.amax(coronal_dose) * 0.1
-            saghalfmax = np.amax(sagittal_dose) * 0.1
-
-        aspect_ratio_value = aspect_ratio[0] / aspect_ratio[1]
-        fig_width = 8  # Fixed width in inches
-        fig_height = fig_width / aspect_ratio_value
-        fig, (ax1, ax2) = plt.subplots(
-            2,
-            1,  # 2 rows, 1 column
-            figsize=(fig_width, fig_height),
-            gridspec_kw={"height_ratios": [1, 1]},
-        )
-        fig.tight_layout()
-        # apply windowing and leveling for the image
-        window_level = 50
-        window_width = 400
-        min_val = window_level - (window_width / 2)
-        max_val = window_level + (window_width / 2)
-        windowed_img = np.clip(ct_array, min_val, max_val)
-        coronal_img = np.sum(windowed_img, axis=1)
-        sagittal_img = np.sum(windowed_img, axis=2)
-
-        # Coronal (X–Z plane)
-        ax1.imshow(coronal_img, "gray",  origin="lower")
-        ax1.axis("off")
+        """Render one plan in-process from already loaded CT and dose images."""
+        ct_projection = PlanRenderer.project_ct(sitk.GetArrayViewFromImage(ct))
+        ct_extents = PlanRenderer.projection_extents(ct.GetOrigin(), ct.GetSpacing(), ct.GetSize())
+        dose_projection = dose_extents = None
         if dose_image:
-            ax1.imshow(
-                coronal_dose,
-                "jet",
-                alpha=0.25 * (coronal_dose > corhalfmax),
-                origin="lower",
+            dose_projection = PlanRenderer.project_dose(
+                sitk.GetArrayViewFromImage(dose_image), dose_image.dose_grid_scaling
             )
-
-        # Sagittal (Y–Z plane)
-        ax2.imshow(sagittal_img, "gray", origin='lower')
-        ax2.axis("off")
-        if dose_image:
-            ax2.imshow(
-                sagittal_dose,
-                "jet",
-                alpha=0.25 * (sagittal_dose > saghalfmax),
-                origin="lower",
+            dose_extents = PlanRenderer.projection_extents(
+                dose_image.GetOrigin(), dose_image.GetSpacing(), dose_image.GetSize()
             )
+        encode = (
+            PlanRenderer.composite_png if self.render_backend == "numpy" else PlanRenderer.render_png
+        )
+        png = encode(ct_projection, ct_extents, dose_projection, dose_extents, aspect_ratio)
+        return PDF_Parser.report_image(png, aspect_ratio)
 
-        plt.subplots_adjust(hspace=0)
-        buf = io.BytesIO()
-        fig.savefig(buf, format="png", dpi=300, bbox_inches="tight", pad_inches=0)
-        buf.seek(0)
-        return Image(
-            buf, fig_width * inch / 3.5, fig_height * inch / 3.5, hAlign="LEFT"
+    def render_plan_images(self, render_jobs):
+        """
+        Render the queued plans in parallel and put the images in `ct_list`.
+
+        Parameters
+        ----------
+        render_jobs : dict
+            Index into `self.ct_list` -> `PlanRenderer.render_plan` job. The
+            index keeps each image at its plan's treatment-date position.
+            Images are reused from the projection cache by (CT series, dose,
+            render parameters), and a cached CT projection spares the worker
+            reading the CT volume.
+        """
+        cache = self.projection_cache
+        params = PlanRenderer.render_params(backend=self.render_backend)
+        # Plans sharing CT and dose are rendered once; cached ones not at all
+        slots = {}
+        pending = {}
+        for index, job in render_jobs.items():
+            key = cache.key(job["ct_series_uid"], job["dose_uid"], params)
+            if job.pop("refresh", False) and key not in slots:
+                cache.discard(key)
+                cache.discard(cache.key(job["ct_series_uid"], None, PlanRenderer.ct_params()))
+            slots.setdefault(key, []).append(index)
+            if key in pending:
+                continue
+            hit = cache.get(key, need_png=True)
+            if hit is not None:
+                self.plan_images[index] = hit["png"]
+                continue
+            ct_hit = cache.get(cache.key(job["ct_series_uid"], None, PlanRenderer.ct_params()))
+            if ct_hit is not None:
+                job = dict(job, ct_arrays={name: ct_hit[name] for name in PlanRenderer.CT_ARRAYS})
+            pending[key] = dict(job, backend=self.render_backend)
+
+        results = self.plan_renderer.render(pending)
+        for key, (result, error) in results.items():
+            job = pending[key]
+            if error is not None:
+                pdf_logger.error(f"Rendering failed for plan {job['plan_uid']}: {error}")
+            else:
+                png = result.pop("png")
+                cache.put(key, png=png, **result)
+                if job.get("ct_arrays") is None:
+                    cache.put(
+                        cache.key(job["ct_series_uid"], None, PlanRenderer.ct_params()),
+                        **{name: result[name] for name in PlanRenderer.CT_ARRAYS},
+                    )
+            for index in slots[key]:
+                if error is not None:
+                    self.ct_list[index] = Paragraph("Could not render CT/dose projection.")
+                else:
+                    self.plan_images[index] = png
+        pdf_logger.info(
+            f"Rendered {len(pending)} of {len(render_jobs)} plan images "
+            f"({cache.hits} projection cache hits)."
         )
 
     def table_append(
@@ -182,13 +225,13 @@ class PDF_Parser:
             ]
         else:
             denominator_fraction = str(plan_row["NumberOfFractionsPlanned"])
-        fxcount = len(self.seen_fraction_numbers)
+        stats = self.plan_stats
+        fxcount = int(stats["fractions"])
         ratio = str(fxcount) + "/" + str(denominator_fraction)
         # Timeline is top of page
         self.timeline_list_year.append(str(self.study_year))
-        self.timeline_list_date.append(str(self.convert_date(self.records[0][1])))
+        self.timeline_list_date.append(str(self.convert_date(int(stats["first_date"]))))
         self.timeline_list_label.append(str(plan_row["RTPlanLabel"]))
-        target_dose_list = []
         # Collect all doses from plan_row
         doses = plan_row["PrescriptionDose"]
 
@@ -238,13 +281,12 @@ class PDF_Parser:
             [str(plan_row["NumberOfFractionsPlanned"])],
         ]
 
-        if self.records:
-            # print(self.records[:])
+        if stats["records"]:
             table_title.append(["Treatment Start:"])
             table_title.append(["Treatment End:"])
             table_title.append(["Fractions Delivered:"])
-            table_answers.append([self.convert_date(self.records[0][1])])
-            table_answers.append([self.convert_date(self.records[-1][1])])
+            table_answers.append([self.convert_date(int(stats["first_date"]))])
+            table_answers.append([self.convert_date(int(stats["last_date"]))])
             table_answers.append(
                 [
                     str(fxcount) + " / " + denominator_fraction,
@@ -301,31 +343,21 @@ class PDF_Parser:
         )
         return table
 
-    def parse_csv_for_plan(self, rtplans, loader):
-        pdf_logger.info("Parsing RTPLAN CSV data.")
-        plans = []
-        for indx, row in rtplans.iterrows():
-            try:
-                rtplan = loader.read_instance(row["SOPInstanceUID"])
-                inst = loader.get_instance(row["SOPInstanceUID"])
-                results_inst, _ = loader.advanced_query(
-                    "INSTANCE",
-                    dcm_filters={
-                        "Modality": "RTRECORD",
-                        "ReferencedRTPlanSequence[0].ReferencedSOPInstanceUID": inst.SOPInstanceUID,
-                        "TreatmentDate": "*",
-                    },
-                    return_instances=True,
-                )
-                treatment_date_list = [
-                    int(loader.read_instance(records.SOPInstanceUID).TreatmentDate)
-                    for records in results_inst
-                ]
-                plans.append((rtplan.SOPInstanceUID, min(treatment_date_list)))
-            except Exception as e:
-                pdf_logger.warning(f"Skipping invalid RTPLAN entry: {e}")
-        plans.sort(key=lambda x: float(x[1]))
-        return plans
+    def order_plans(self, plan_uids):
+        """
+        Treated plans as (SOPInstanceUID, first treatment date), oldest first.
+
+        Plans without a dated treatment record are left out.
+        """
+        pdf_logger.info("Ordering RTPLANs by first treatment date.")
+        summary = self.plan_summary
+        uids = [str(uid) for uid in plan_uids]
+        treated = summary.loc[summary.index.intersection(uids), "first_date"].dropna()
+        skipped = set(uids) - set(treated.index)
+        if skipped:
+            pdf_logger.warning(f"Skipping {len(skipped)} RTPLAN(s) without dated treatment records.")
+        treated = treated.sort_values(kind="stable")
+        return [(uid, int(date)) for uid, date in treated.items()]
 
     def convert_date(self, date_str):
         # Define a dictionary mapping month numbers to month names
@@ -361,22 +393,6 @@ class PDF_Parser:
 
         return converted_date
 
-    def record_loop(self, plan, loader: DICOMLoader):
-        pdf_logger.debug(f"Collecting RTRECORD instances for plan {plan.SOPInstanceUID}.")
-        self.records = []
-        plan_inst = loader.get_instance(plan.SOPInstanceUID)
-        ref_records = loader.get_referencing_nodes(plan_inst, "RTRECORD", "INSTANCE")
-        for record_inst in ref_records:
-            record = loader.read_instance(record_inst.SOPInstanceUID)
-            fraction_number = str(record.TreatmentSessionBeamSequence[0].CurrentFractionNumber)
-            if fraction_number not in ("0", "0.0"):
-                self.seen_fraction_numbers.add(fraction_number)
-            self.records.append(
-                [fraction_number, str(record.TreatmentDate), str(record.SOPInstanceUID)]
-            )
-
-
-
     def create_summary_table(self, content):
         max_widths = [110, 110, 200]
         # Create the table with fixed column widths
@@ -442,20 +458,291 @@ class PDF_Parser:
 
         return
 
-    def generate_pdf(self, mrn):
-        pdf_logger.info(f"Starting PDF generation for MRN={mrn}")
+    def report_params(self):
+        """Settings that change the report's content besides its input files."""
+        return {
+            "render": PlanRenderer.render_params(backend=self.render_backend),
+            "images": [self.image_format, self.image_dpi, self.pdf_max_bytes, self.jpeg_quality],
+        }
+
+    def plan_inputs(self, loader, sop):
+        """
+        Files a plan's report entry is computed from.
+
+        Returns
+        -------
+        tuple
+            (plan instance node, referenced CT series nodes, RTDOSE instance
+            nodes to render, paths of all of these files). The doses are the
+            first plan-level dose or, when the plan has only BEAM doses
+            (moved as a fallback by `TaskManager.select_doses`), all of
+            them, to be summed.
+        """
+        inst = loader.get_instance(sop)
+        referenced_ct = loader.get_referenced_nodes(inst, "CT", "SERIES", recursive=True)
+        doses = loader.get_referencing_items(inst, "RTDOSE", "INSTANCE")
+        referenced_dose = [dose for dose in doses if dose.SOPInstanceUID not in self.beam_dose_uids][:1]
+        if not referenced_dose:
+            referenced_dose = sorted(doses, key=lambda dose: str(dose.SOPInstanceUID))
+        paths = [inst.FilePath]
+        if referenced_ct:
+            paths.extend(referenced_ct[0].instance_paths)
+        paths.extend(dose.FilePath for dose in referenced_dose)
+        return inst, referenced_ct, referenced_dose, paths
+
+    def plan_entry(self, loader, sop, referenced_ct, referenced_dose):
+        """
+        Table values and image source of one plan.
+
+        Returns
+        -------
+        dict
+            ``row`` (plan label, prescription, planned fractions), ``note``
+            (text shown instead of an image, or None) and ``render`` (a
+            `PlanRenderer.render_plan` job with workspace-relative paths, or
+            None). Plain values only, so the entry can be kept in the
+            `ReportCache`.
+        """
+        plan = loader.read_instance(sop)
+        plan_row = {}
+        target_rx_dose = []
+        plan_row["RTPlanLabel"] = str(plan.RTPlanLabel)
+        for dose_ref in plan.DoseReferenceSequence:
+            if hasattr(dose_ref, "TargetPrescriptionDose"):
+                target_rx_dose.append(float(dose_ref.TargetPrescriptionDose))
+            elif hasattr(dose_ref, "OrganAtRiskMaximumDose"):
+                # Store as tuple (value, marker) so formatting later is cleaner
+                target_rx_dose.append((float(dose_ref.OrganAtRiskMaximumDose), "*"))
+
+        plan_row["PrescriptionDose"] = target_rx_dose
+        plan_row["NumberOfFractionsPlanned"] = str(plan.FractionGroupSequence[0].NumberOfFractionsPlanned)
+
+        notes = []
+        ct_skip = False
+        if hasattr(plan.BeamSequence[0], "TreatmentMachineName"):
+            if "ViewRay" in plan.BeamSequence[0].TreatmentMachineName:
+                notes.append("Planned in ViewRay. Manually exported.")
+                ct_skip = True
+            if "TomoTherapy" in plan.BeamSequence[0].TreatmentMachineName:
+                notes.append("Planned in TomoTherapy. Manually exported.")
+                ct_skip = True
+        if hasattr(plan.BeamSequence[0], "RadiationType"):
+            if "electron" in str(plan.BeamSequence[0].RadiationType).lower():
+                if not any(dose.SOPInstanceUID not in self.beam_dose_uids for dose in referenced_dose):
+                    notes.append("Plan dose scaled for electron beam. Manually exported.")
+                ct_skip = True
+        if hasattr(plan, "Manufacturer"):
+            if "siemens" in str(plan.Manufacturer).lower():
+                notes.append("Decommissioned machine. Maybe manually exportable.")
+                ct_skip = True
+        if hasattr(plan.BeamSequence[0], "Manufacturer"):
+            if "siemens" in str(plan.BeamSequence[0].Manufacturer).lower():
+                notes.append("Decommissioned machine. Maybe manually exportable.")
+                ct_skip = True
+
+        render = None
+        if not ct_skip:
+            if referenced_ct:
+                render = {
+                    "plan_uid": sop,
+                    "ct_series_uid": str(referenced_ct[0].SeriesInstanceUID),
+                    "ct_paths": [self.report_cache.relpath(p) for p in referenced_ct[0].instance_paths],
+                    # Summed BEAM doses are cached under their joined UIDs
+                    "dose_uid": "+".join(str(dose.SOPInstanceUID) for dose in referenced_dose) or None,
+                    "dose_paths": [self.report_cache.relpath(dose.FilePath) for dose in referenced_dose],
+                }
+            else:
+                print(
+                    f"Manually export files for \n{plan.SOPInstanceUID}"
+                )
+                pdf_logger.warning(f"Missing CT for plan {plan.SOPInstanceUID}")
+                sys.exit()
+        return {"row": plan_row, "note": notes[0] if notes else None, "render": render}
+
+    def collect_incremental(self):
+        """
+        Plans, header and entries from the report cache, reading only new records.
+
+        Returns None when a newly treated plan has no cached entry or the
+        RTPLAN the header is read from is not in the workspace.
+        """
+        report_cache = self.report_cache
+        with tracing.span("load", "pdf", incremental=True):
+            self.record_summaries = report_cache.record_summaries(report_cache.record_paths())
+            self.plan_summary = summarize_plans(self.record_summaries)
+        plans = self.order_plans(report_cache.state["rtplans"])
+        entries = {sop: report_cache.plan_entry(sop) for sop, _ in plans}
+        if any(entry is None for entry in entries.values()):
+            return None
+        header_path = report_cache.instance_path(report_cache.state["rtplans"][0])
+        if header_path is None:
+            return None
+        return plans, self.report_header(header_path), entries
+
+    def report_header(self, path):
+        """
+        Patient name and birth date for the report header, read from `path`.
+
+        Returns None if they cannot be read. The header is never cached.
+        """
         try:
-            loader = DICOMLoader(TEMP_DIRECTORY/mrn)
-            tags_to_index = ["TreatmentDate"]
-            loader.load()
-            results_inst, results_df = loader.advanced_query("INSTANCE", dcm_filters={"DoseSummationType":"BEAM"}, return_instances=True)
-            for dose_beam in results_inst:
-                file_path = dose_beam.FilePath
-                os.remove(file_path)
+            ds = dcmread(path, stop_before_pixels=True, specific_tags=["PatientName", "PatientBirthDate"])
+            return {
+                "name": str(ds.PatientName),
+                "birth_date": self.convert_date(ds.PatientBirthDate),
+            }
+        except Exception as e:
+            msg = f"Could not grab info for the pdf header {str(e)}"
+            print(msg)
+            return None
+
+    def load_index(self, mrn):
+        """
+        Load the workspace, find BEAM doses and summarise every record.
+
+        Returns
+        -------
+        DICOMLoader
+            The loaded workspace index.
+        """
+        with tracing.span("load", "pdf"):
             loader = DICOMLoader(TEMP_DIRECTORY/mrn)
             loader.load()
-            rtplans = loader.query("INSTANCE", Modality="RTPLAN")
-            
+            # BEAM doses are told apart in the single index instead of
+            # loading the tree a second time; only RTDOSE files are opened
+            # for the deep filter. A plan-level dose is preferred, and the
+            # BEAM doses are summed when a plan has nothing else.
+            results_inst, _ = loader.advanced_query(
+                "INSTANCE",
+                df_filters={"Modality": "RTDOSE"},
+                dcm_filters={"DoseSummationType": "BEAM"},
+                return_instances=True,
+            )
+            self.beam_dose_uids = {dose_beam.SOPInstanceUID for dose_beam in results_inst}
+            # Plan, fraction and date of every record, from partial reads
+            record_paths, _ = loader.advanced_query(
+                "INSTANCE", df_filters={"Modality": "RTRECORD"}, return_paths=True
+            )
+            if self.incremental:
+                self.record_summaries = self.report_cache.record_summaries(record_paths)
+            else:
+                self.record_summaries = scan_record_summaries(record_paths)
+            self.plan_summary = summarize_plans(self.record_summaries)
+        return loader
+
+    def cached_plan_entry(self, loader, sop):
+        """
+        The entry of `sop`, from the report cache if its inputs are unchanged.
+
+        Returns
+        -------
+        tuple
+            (entry, True if it came from the cache).
+        """
+        report_cache = self.report_cache
+        _, referenced_ct, referenced_dose, paths = self.plan_inputs(loader, sop)
+        fingerprint = report_cache.fingerprint(paths)
+        entry = report_cache.plan_entry(sop, fingerprint) if self.incremental else None
+        if entry is not None:
+            return entry, True
+        stale = report_cache.plan_entry(sop)
+        entry = self.plan_entry(loader, sop, referenced_ct, referenced_dose)
+        entry["fingerprint"] = fingerprint
+        if stale is not None and entry["render"] is not None:
+            # Same UIDs, different files: cached projections are stale
+            entry["render"]["refresh"] = True
+        return entry, False
+
+    def render_job(self, entry):
+        """The `PlanRenderer.render_plan` job of an entry, with absolute paths."""
+        render = entry["render"]
+        job = dict(
+            render,
+            ct_paths=[self.report_cache.abspath(p) for p in render["ct_paths"]],
+            dose_paths=[self.report_cache.abspath(p) for p in render["dose_paths"]],
+        )
+        # Only this render discards the stale projections
+        render.pop("refresh", None)
+        return job
+
+    def collect(self, mrn):
+        """
+        Load the workspace and compute the entries of plans whose inputs changed.
+
+        Returns
+        -------
+        tuple
+            (plans ordered by first treatment, header, plan UID -> entry,
+            UIDs of every RTPLAN in the workspace).
+        """
+        loader = self.load_index(mrn)
+        rtplans = loader.query("INSTANCE", Modality="RTPLAN")
+        header = self.report_header(loader.get_instance(rtplans["SOPInstanceUID"][0]).FilePath)
+
+        plans = self.order_plans(rtplans["SOPInstanceUID"])
+        entries = {}
+        reused = 0
+        for sop, _ in plans:
+            entries[sop], hit = self.cached_plan_entry(loader, sop)
+            reused += hit
+        if self.incremental:
+            pdf_logger.info(f"Reused {reused} of {len(plans)} plan entries from the report cache.")
+        return plans, header, entries, [str(uid) for uid in rtplans["SOPInstanceUID"]]
+
+    def precompute(self, plan_uids):
+        """
+        Compute and cache the entries and images of retrieved plans ahead of the report.
+
+        Called while other plans are still being moved; the final
+        `generate_pdf` then reuses the results through the report and
+        projection caches. Plans that cannot be computed yet are skipped.
+        Only the headers of the plans, their structure sets and the doses
+        are read (`PlanIndex`), not the whole workspace.
+        """
+        report_cache = self.report_cache
+        report_cache.scan(TEMP_DIRECTORY/self.mrn)
+        with tracing.span("load", "pdf", precompute=True):
+            loader = PlanIndex(report_cache)
+            self.beam_dose_uids = loader.load_doses()
+            # Records read now are not read again by the report
+            self.record_summaries = report_cache.record_summaries(loader.paths("RTRECORD"))
+        entries = {}
+        render_jobs = {}
+        for sop in plan_uids:
+            try:
+                entry, _ = self.cached_plan_entry(loader, sop)
+            except (Exception, SystemExit) as e:
+                # plan_entry exits on a plan without CT; the report will report it
+                pdf_logger.warning(f"Could not precompute plan {sop}: {e!r}")
+                continue
+            entries[sop] = entry
+            if entry["render"] is not None:
+                render_jobs[len(self.ct_list)] = self.render_job(entry)
+                self.ct_list.append(None)
+        with tracing.span("render", "pdf", plans=len(render_jobs), precompute=True):
+            self.render_plan_images(render_jobs)
+        report_cache.update(entries)
+        pdf_logger.info(f"Precomputed {len(entries)} of {len(plan_uids)} plan(s) for MRN={self.mrn}.")
+
+    def generate_pdf(self, mrn):
+        pdf_logger.info(f"Starting PDF generation for MRN={mrn}")
+        try:
+            report_cache = self.report_cache
+            report_cache.scan(TEMP_DIRECTORY/mrn)
+            params = self.report_params()
+            if self.incremental and report_cache.unchanged(params):
+                report_cache.restore_pdf(self.pdf_filename)
+                pdf_logger.info(f"Inputs unchanged; reused the previous report for MRN={mrn}")
+                return
+            collected = None
+            if self.incremental and report_cache.records_only(params):
+                collected = self.collect_incremental()
+                if collected is not None:
+                    plans, header, entries = collected
+                    rtplans = report_cache.state["rtplans"]
+            if collected is None:
+                plans, header, entries, rtplans = self.collect(mrn)
+
             content = []
             styles = getSampleStyleSheet()
             content.append(
@@ -465,128 +752,55 @@ class PDF_Parser:
             )
             content.append(Spacer(1, 12))
             doc = SimpleDocTemplate(self.pdf_filename, pagesize=letter)
-            patient_info = loader.read_instance(rtplans["SOPInstanceUID"][0])
             # y_coordinate = 800  # Initial y-coordinate for writing text
-            try:
+            if header is not None:
                 normal_style = styles["Normal"]
                 normal_style.maxWidth = 500  # Adjust the value as needed
-                
-                
                 content.append(
                     Paragraph(
-                        f"<b>Patient Name:</b> {patient_info.PatientName}",
+                        f"<b>Patient Name:</b> {header['name']}",
                         styles["Heading2"],
                     )
                 )
                 content.append(
                     Paragraph(
-                        f"<b>Date of Birth:</b> {self.convert_date(patient_info.PatientBirthDate)}",
+                        f"<b>Date of Birth:</b> {header['birth_date']}",
                         styles["Heading2"],
                     )
                 )
-            except Exception as e:
-                msg = f"Could not grab info for the pdf header {str(e)}"
-                print(msg)
             # content.append(Spacer(1, 12))
-            plans = self.parse_csv_for_plan(rtplans, loader)
+            render_jobs = {}
             for sop, _ in plans:
-                plan = loader.read_instance(sop)
-                inst = loader.get_instance(sop)
-                # print(f"Finding Stuff for {plan_row['SOPInstanceUID']}")
-                self.seen_fraction_numbers = set()  # Set to store seen fraction numbers
-                self.record_loop(plan, loader)
-
-                self.records.sort(key=lambda x: x[1])
-                if str(self.records[0][1])[0:4] != self.year:
-                    self.study_year = str(self.records[0][1])[0:4]
+                entry = entries[sop]
+                # First/last date and delivered fractions of this plan
+                self.plan_stats = self.plan_summary.loc[sop]
+                start_year = str(int(self.plan_stats["first_date"]))[0:4]
+                if start_year != self.year:
+                    self.study_year = start_year
                     self.year = self.study_year
                     content.append(Spacer(1, 12))
                 else:
                     self.study_year = ""
                     # Table is each section starting from page 2
-                plan_row = {}
-                target_rx_dose = []
-                plan_row["RTPlanLabel"] = plan.RTPlanLabel
-                for dose_ref in plan.DoseReferenceSequence:
-                    if hasattr(dose_ref, "TargetPrescriptionDose"):
-                        target_rx_dose.append(float(dose_ref.TargetPrescriptionDose))
-                    elif hasattr(dose_ref, "OrganAtRiskMaximumDose"):
-                        # Store as tuple (value, marker) so formatting later is cleaner
-                        target_rx_dose.append((float(dose_ref.OrganAtRiskMaximumDose), "*"))
-
-                plan_row["PrescriptionDose"] = target_rx_dose
-                plan_row["NumberOfFractionsPlanned"] = plan.FractionGroupSequence[0].NumberOfFractionsPlanned
                 # Make the lists for the tables
                 table_title, table_answers = self.table_append(
-                    plan_row,
+                    entry["row"],
                 )
                 self.table_title_list.append(table_title)
                 self.table_answers_list.append(table_answers)
 
-                # Find the correct RTStruct
-                referenced_ct = loader.get_referenced_nodes(inst, "CT", "SERIES", recursive=True)
-                referenced_dose = loader.get_referencing_items(inst, "RTDOSE", "INSTANCE")
-                ct_skip = False
-                if hasattr(plan.BeamSequence[0], "TreatmentMachineName"):
-                    if "ViewRay" in plan.BeamSequence[0].TreatmentMachineName:
-                        referenced_ct = []
-                        self.ct_list.append(
-                            Paragraph("Planned in ViewRay. Manually exported.")
-                        )
-                        ct_skip=True
-                    if "TomoTherapy" in plan.BeamSequence[0].TreatmentMachineName:
-                        referenced_ct = []
-                        self.ct_list.append(
-                            Paragraph("Planned in TomoTherapy. Manually exported.")
-                        )
-                        ct_skip=True
-                        
-                if hasattr(plan.BeamSequence[0], "RadiationType"):
-                    if "electron" in str(plan.BeamSequence[0].RadiationType).lower():
-                        if not referenced_dose:
-                            referenced_ct = []
-                            self.ct_list.append(
-                            Paragraph(
-                                "Plan dose scaled for electron beam. Manually exported."
-                            )
-                        )
-                        ct_skip=True
-                if hasattr(plan, "Manufacturer"):
-                    if "siemens" in str(plan.Manufacturer).lower():
-                        self.ct_list.append(
-                            Paragraph("Decommissioned machine. Maybe manually exportable.")
-                        )
-                        referenced_ct = []
-                        ct_skip=True
-                if hasattr(plan.BeamSequence[0], "Manufacturer"):
-                    if "siemens" in str(plan.BeamSequence[0].Manufacturer).lower():
-                        self.ct_list.append(
-                            Paragraph("Decommissioned machine. Maybe manually exportable.")
-                        )
-                        referenced_ct = []
-                        ct_skip=True
-                if not ct_skip:
-                    if referenced_ct:
-                        
-                        ct = loader.read_series(referenced_ct[0].SeriesInstanceUID)[0]
-                        if referenced_dose:
-                            dose = loader.read_instance(referenced_dose[0].SOPInstanceUID)
-                            
-                            self.ct_list.append(
-                                self.create_image(
-                                    ct,
-                                    dose_image = dose,
-                                )
-                            )
-                        else:
-                            self.ct_list.append(self.create_image(ct))
-                    else:
-                        
-                        print(
-                            f"Manually export files for \n{plan.SOPInstanceUID}"
-                        )
-                        pdf_logger.warning(f"Missing CT for plan {plan.SOPInstanceUID}")
-                        sys.exit()
+                if entry["render"] is not None:
+                    # Rendered after the loop in a process pool; the
+                    # slot keeps the plan's place in the report
+                    render_jobs[len(self.ct_list)] = self.render_job(entry)
+                    self.ct_list.append(None)
+                else:
+                    self.ct_list.append(Paragraph(entry["note"] or ""))
+
+            with tracing.span("render", "pdf", plans=len(render_jobs)):
+                self.render_plan_images(render_jobs)
+            with tracing.span("encode images", "pdf", format=self.image_format):
+                self.embed_plan_images()
 
             # Create the timeline table, add it to doc
             content.append(self.create_timeline_table())
@@ -606,8 +820,16 @@ class PDF_Parser:
             
 
             # Build the PDF
-            doc.build(content)
+            with tracing.span("build", "pdf"):
+                doc.build(content)
             # doc.build(content, onLaterPages=self.add_footer)
+            pdf_size = os.path.getsize(self.pdf_filename)
+            if self.pdf_max_bytes and pdf_size > self.pdf_max_bytes:
+                pdf_logger.warning(
+                    f"PDF is {pdf_size / 1e6:.2f} MB, over the {self.pdf_max_bytes / 1e6:.2f} MB budget."
+                )
+            if self.incremental:
+                report_cache.save(params, entries, rtplans, self.pdf_filename)
 
             # Save the PDF
             pdf_logger.info(f"PDF successfully created for MRN={mrn}")
@@ -617,29 +839,54 @@ class PDF_Parser:
             raise
 
 
-    def zip_and_remove_directory(self, directory_path, zip_file_path):
-        pdf_logger.debug(f"Zipping output directory: {directory_path}")
-        with zipfile.ZipFile(zip_file_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for root, dirs, files in os.walk(directory_path):
-                for file in files:
-                    zipf.write(
-                        os.path.join(root, file),
-                        os.path.relpath(os.path.join(root, file), directory_path),
-                    )
+    def zip_and_remove_directory(self, directory_path, output_base, packager=None):
+        """
+        Package `directory_path` as ``<output_base>.<format>`` and delete it.
+
+        Parameters
+        ----------
+        directory_path : str
+            The MRN's TEMP directory.
+        output_base : str
+            Package path without extension, e.g. ``OUTPUT/<mrn>``.
+        packager : OutputPackager, optional
+            By default a parallel zip packager.
+
+        Returns
+        -------
+        Path
+            The written package.
+        """
+        pdf_logger.debug(f"Packaging output directory: {directory_path}")
+        packager = packager or OutputPackager("zip")
+        package_path = packager.package(directory_path, output_base)
         shutil.rmtree(directory_path)
-        pdf_logger.info(f"Created zip archive: {zip_file_path}")
+        pdf_logger.info(f"Created {packager.fmt} archive: {package_path}")
+        return package_path
+
 
+def run(mrn, archive_manager=None, packager=None, **parser_options):
+    """
+    Generate the report for `mrn` and package the patient's output.
 
-def run(mrn):
+    `parser_options` are passed to `PDF_Parser` (render backend, incremental
+    regeneration, image settings).
+    """
     mrn = str(mrn)
     pdf_logger.info(f"Running PDF generator for MRN={mrn}")
-    pdf_parser = PDF_Parser(mrn)
+    pdf_parser = PDF_Parser(mrn, **parser_options)
     pdf_parser.generate_pdf(mrn)
     directory_to_zip = os.path.join(TEMP_DIRECTORY, mrn)
+    if archive_manager is not None and archive_manager.has(mrn):
+        # Instances were streamed on arrival; only the PDF and index remain
+        with tracing.span("zip", "pdf", streamed=True):
+            archive_manager.finalize(mrn, directory_to_zip)
+        return
     if not os.path.exists(OUTPUT_DIRECTORY):
         os.mkdir(OUTPUT_DIRECTORY)
-    zip_file_path = os.path.join(OUTPUT_DIRECTORY, mrn + ".zip")
-    pdf_parser.zip_and_remove_directory(directory_to_zip, zip_file_path)
+    output_base = os.path.join(OUTPUT_DIRECTORY, mrn)
+    with tracing.span("zip", "pdf", streamed=False):
+        pdf_parser.zip_and_remove_directory(directory_to_zip, output_base, packager)
 
 
 def main():
@@ -0,0 +1,139 @@
+"""
+Index of the plans in a patient workspace, read from headers only.
+
+`PDF_Parser.precompute` runs once per batch of completed plans while the
+rest of the patient is still being moved. Loading the whole workspace with
+`DICOMLoader` for every batch would read every file again each time, so
+precomputation uses this index instead. It locates files by the workspace
+layout (``<study>/<modality>/<series>/<SOPInstanceUID>.dcm``, see
+`FileManager`) from a `ReportCache` scan, and follows a plan's references by
+reading only the headers involved: the plan, its structure set and the
+RTDOSE files. It offers the subset of the `DICOMLoader` interface that
+`PDF_Parser.plan_inputs` and `PDF_Parser.plan_entry` use. A plan it cannot
+resolve is left to the final report, which loads the full index.
+"""
+
+import os
+from collections import namedtuple
+from typing import Dict, List, Optional
+
+from pydicom import dcmread
+
+from .logger_setup import pdf_logger
+
+Instance = namedtuple("Instance", ["SOPInstanceUID", "Modality", "SeriesInstanceUID", "FilePath"])
+Series = namedtuple("Series", ["SeriesInstanceUID", "Modality", "instance_paths"])
+
+DOSE_TAGS = ["SOPInstanceUID", "DoseSummationType", "ReferencedRTPlanSequence"]
+
+
+class PlanIndex:
+    """
+    Plan, CT and dose lookups over a scanned workspace.
+
+    Parameters
+    ----------
+    report_cache : ReportCache
+        Cache whose `ReportCache.scan` listed the workspace.
+    """
+
+    def __init__(self, report_cache):
+        self.instances: Dict[str, Instance] = {}
+        self.series: Dict[str, List[str]] = {}
+        for rel in sorted(report_cache.files):
+            parts = rel.split("/")
+            if len(parts) != 4 or not parts[3].endswith(".dcm"):
+                continue
+            _, modality, series_uid, name = parts
+            path = report_cache.abspath(rel)
+            sop_uid = name[: -len(".dcm")]
+            self.instances[sop_uid] = Instance(sop_uid, modality, series_uid, path)
+            self.series.setdefault(series_uid, []).append(path)
+        self._doses: Optional[List] = None
+        self.beam_dose_uids = set()
+
+    def paths(self, modality: str) -> List[str]:
+        """Paths of every instance of `modality`."""
+        return [inst.FilePath for inst in self.instances.values() if inst.Modality == modality]
+
+    def get_instance(self, sop_uid: str) -> Optional[Instance]:
+        return self.instances.get(str(sop_uid))
+
+    def read_instance(self, sop_uid: str):
+        """Header of an instance (pixel data is not read)."""
+        return dcmread(self.instances[str(sop_uid)].FilePath, stop_before_pixels=True)
+
+    def _series_node(self, series_uid: str) -> Optional[Series]:
+        paths = self.series.get(str(series_uid))
+        if not paths:
+            return None
+        modality = self.instances[os.path.basename(paths[0])[: -len(".dcm")]].Modality
+        return Series(str(series_uid), modality, list(paths))
+
+    def get_referenced_nodes(self, inst: Instance, modality="CT", level="SERIES", recursive=True) -> List[Series]:
+        """
+        Image series a plan is planned on, through its structure set.
+
+        Only the plan -> RTSTRUCT -> image series path is followed (what the
+        report needs); the arguments mirror `DICOMLoader.get_referenced_nodes`.
+        """
+        plan = dcmread(inst.FilePath, stop_before_pixels=True, specific_tags=["ReferencedStructureSetSequence"])
+        found = []
+        for item in getattr(plan, "ReferencedStructureSetSequence", None) or []:
+            struct = self.get_instance(getattr(item, "ReferencedSOPInstanceUID", ""))
+            if struct is None:
+                continue
+            ds = dcmread(
+                struct.FilePath, stop_before_pixels=True, specific_tags=["ReferencedFrameOfReferenceSequence"]
+            )
+            series_uids = []
+            contour_sops = []
+            for frame in getattr(ds, "ReferencedFrameOfReferenceSequence", None) or []:
+                for study in getattr(frame, "RTReferencedStudySequence", None) or []:
+                    for series in getattr(study, "RTReferencedSeriesSequence", None) or []:
+                        series_uids.append(str(series.SeriesInstanceUID))
+                        contour_sops.extend(
+                            str(image.ReferencedSOPInstanceUID)
+                            for image in getattr(series, "ContourImageSequence", None) or []
+                        )
+            # Image references stand in for a missing or renamed series UID
+            series_uids.extend(
+                self.instances[sop].SeriesInstanceUID for sop in contour_sops if sop in self.instances
+            )
+            for series_uid in dict.fromkeys(series_uids):
+                node = self._series_node(series_uid)
+                if node is not None and node.Modality == modality and node not in found:
+                    found.append(node)
+        return found
+
+    def _dose_headers(self):
+        """(instance, referenced plan UIDs) of every RTDOSE, read once."""
+        if self._doses is None:
+            self._doses = []
+            for path in self.paths("RTDOSE"):
+                try:
+                    ds = dcmread(path, stop_before_pixels=True, specific_tags=DOSE_TAGS)
+                except Exception as e:
+                    pdf_logger.warning(f"Could not read RTDOSE header {path}: {e}")
+                    continue
+                inst = self.instances.get(str(ds.SOPInstanceUID))
+                if inst is None:
+                    continue
+                summation = str(getattr(ds, "DoseSummationType", "")).upper()
+                plans = {
+                    str(item.ReferencedSOPInstanceUID)
+                    for item in getattr(ds, "ReferencedRTPlanSequence", None) or []
+                }
+                self._doses.append((inst, plans))
+                if summation == "BEAM":
+                    self.beam_dose_uids.add(inst.SOPInstanceUID)
+        return self._doses
+
+    def load_doses(self):
+        """Read the RTDOSE headers and fill `beam_dose_uids`."""
+        self._dose_headers()
+        return self.beam_dose_uids
+
+    def get_referencing_items(self, inst: Instance, modality="RTDOSE", level="INSTANCE") -> List[Instance]:
+        """RTDOSE instances whose ReferencedRTPlanSequence names the plan `inst`."""
+        return [dose for dose, plans in self._dose_headers() if inst.SOPInstanceUID in plans]
@@ -0,0 +1,674 @@
+"""
+Coronal/sagittal plan renderings for the treatment history report.
+
+Rendering one plan (streaming the CT series and reading the dose, projecting them and
+saving a 300 dpi figure) is CPU bound and independent of every other plan,
+so `PlanRenderer` farms the plans out to a process pool. Jobs are plain
+dicts of file paths and the worker functions here are module level, so both
+pickle cleanly; the workers read the files themselves and only the PNG and
+the 2-D projections travel back. Concurrency is capped by the memory the largest job needs, not
+just by the core count.
+"""
+
+import io
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from typing import Dict, Hashable, Optional, Sequence, Tuple
+
+import numpy as np
+import matplotlib
+
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from pydicom import dcmread
+
+from .ct_projection import WINDOW_LEVEL, WINDOW_WIDTH, same_window, stub_projection
+
+DPI = 300
+FIG_WIDTH = 8  # inches
+# Matplotlib figure, PNG encoder and interpreter overhead per worker
+WORKER_OVERHEAD_BYTES = 400 * 1024**2
+# Bump when the projection or figure code changes, to invalidate caches
+RENDER_VERSION = 1
+# Names of the CT projection arrays in `render_plan` results
+CT_ARRAYS = ("ct_coronal", "ct_sagittal", "ct_extents")
+# "matplotlib" draws a figure; "numpy" composites the thumbnail directly
+RENDER_BACKENDS = ("matplotlib", "numpy")
+# Size the image is placed at in the report (see PDF_Parser.report_image)
+REPORT_SCALE = 3.5
+
+
+def _jet_lut(n=256):
+    """RGB lookup table approximating matplotlib's "jet", as uint8 (n, 3)."""
+    x = np.linspace(0.0, 1.0, n)
+    channels = [np.clip(1.5 - np.abs(4 * x - c), 0.0, 1.0) for c in (3, 2, 1)]
+    return np.round(np.stack(channels, axis=1) * 255).astype(np.uint8)
+
+
+JET_LUT = _jet_lut()
+
+
+def ct_params(window_level=WINDOW_LEVEL, window_width=WINDOW_WIDTH) -> Dict:
+    """Parameters the CT projection depends on (part of cache keys)."""
+    return {"version": RENDER_VERSION, "window": [window_level, window_width]}
+
+
+def render_params(aspect_ratio=(16, 18), backend="matplotlib") -> Dict:
+    """Parameters the encoded image depends on (part of cache keys)."""
+    return {
+        **ct_params(),
+        "dpi": DPI,
+        "fig_width": FIG_WIDTH,
+        "aspect_ratio": list(aspect_ratio),
+        "backend": backend,
+    }
+
+
+def projection_extents(origin, spacing, size):
+    """
+    Physical imshow extents (mm) of the coronal and sagittal projections.
+
+    Voxel centres sit at ``origin + i * spacing``, so each extent runs half a
+    voxel past the first and last centres. Anisotropic spacing is then
+    handled by the axes' equal aspect instead of 3-D resampling.
+
+    Parameters
+    ----------
+    origin, spacing : sequence of float
+        (x, y, z) of the first voxel centre and the voxel size, in mm.
+    size : sequence of int
+        (nx, ny, nz).
+
+    Returns
+    -------
+    tuple of tuple
+        ``(coronal, sagittal)`` as (left, right, bottom, top) for
+        ``origin="lower"``.
+    """
+    (ox, oy, oz), (sx, sy, sz) = origin, spacing
+    nx, ny, nz = size
+
+    def span(o, s, n):
+        return o - s / 2, o + (n - 0.5) * s
+
+    z = span(oz, sz, nz)
+    return span(ox, sx, nx) + z, span(oy, sy, ny) + z
+
+
+def project_ct(ct_array, window_level=WINDOW_LEVEL, window_width=WINDOW_WIDTH):
+    """
+    Coronal and sagittal sums of a windowed (z, y, x) CT array.
+
+    The voxels are windowed once into a float32 buffer and summed with
+    float32 accumulation on the native grid.
+    """
+    min_val = window_level - (window_width / 2)
+    max_val = window_level + (window_width / 2)
+    windowed = np.empty(ct_array.shape, dtype=np.float32)
+    np.clip(ct_array, min_val, max_val, out=windowed)
+    return (
+        np.sum(windowed, axis=1, dtype=np.float32),
+        np.sum(windowed, axis=2, dtype=np.float32),
+    )
+
+
+def project_dose(dose_array, scaling=1.0):
+    """Coronal and sagittal sums of stored (z, y, x) dose values, in float32."""
+    scaling = np.float32(scaling or 1.0)
+    return (
+        np.sum(dose_array, axis=1, dtype=np.float32) * scaling,
+        np.sum(dose_array, axis=2, dtype=np.float32) * scaling,
+    )
+
+
+def figure_size(aspect_ratio=(16, 18)):
+    """(width, height) in inches of the two-panel figure."""
+    return FIG_WIDTH, FIG_WIDTH / (aspect_ratio[0] / aspect_ratio[1])
+
+
+def render_png(ct_projection, ct_extents, dose_projection=None, dose_extents=None, aspect_ratio=(16, 18)):
+    """
+    Draw the coronal (top) and sagittal (bottom) panels and encode a PNG.
+
+    Parameters
+    ----------
+    ct_projection, dose_projection : tuple of ndarray
+        (coronal, sagittal) sums; the dose is optional.
+    ct_extents, dose_extents : tuple of tuple
+        Matching `projection_extents`.
+    aspect_ratio : tuple of int
+        Width to height ratio of the figure.
+
+    Returns
+    -------
+    bytes
+        The PNG image.
+    """
+    fig_width, fig_height = figure_size(aspect_ratio)
+    fig, axes = plt.subplots(
+        2,
+        1,  # 2 rows, 1 column
+        figsize=(fig_width, fig_height),
+        gridspec_kw={"height_ratios": [1, 1]},
+    )
+    try:
+        fig.tight_layout()
+        for i, ax in enumerate(axes):  # coronal (X–Z), sagittal (Y–Z)
+            ax.imshow(ct_projection[i], "gray", origin="lower", extent=ct_extents[i])
+            ax.axis("off")
+            if dose_projection is not None:
+                dose = dose_projection[i]
+                ax.imshow(
+                    dose,
+                    "jet",
+                    alpha=0.25 * (dose > np.amax(dose) * 0.1),
+                    origin="lower",
+                    extent=dose_extents[i],
+                )
+                # Keep the CT's field of view when the dose grid extends past it
+                ax.set_xlim(ct_extents[i][:2])
+                ax.set_ylim(ct_extents[i][2:])
+        plt.subplots_adjust(hspace=0)
+        buf = io.BytesIO()
+        fig.savefig(buf, format="png", dpi=DPI, bbox_inches="tight", pad_inches=0)
+        return buf.getvalue()
+    finally:
+        plt.close(fig)
+
+
+def _lerp_axis(array, positions, axis):
+    """Linearly interpolate `array` at fractional indices along `axis`."""
+    n = array.shape[axis]
+    i0 = np.clip(np.floor(positions).astype(np.intp), 0, n - 1)
+    i1 = np.minimum(i0 + 1, n - 1)
+    weight = np.clip(positions - i0, 0.0, 1.0).astype(np.float32)
+    shape = [1, 1]
+    shape[axis] = -1
+    weight = weight.reshape(shape)
+    return np.take(array, i0, axis=axis) * (1 - weight) + np.take(array, i1, axis=axis) * weight
+
+
+def sample_projection(projection, extent, xs, zs, fill=0.0):
+    """
+    Bilinearly sample a projection at physical coordinates.
+
+    Parameters
+    ----------
+    projection : ndarray
+        (z, x) sums whose row 0 is the lowest z (``origin="lower"``).
+    extent : sequence of float
+        (left, right, bottom, top) in mm, as from `projection_extents`.
+    xs, zs : ndarray
+        Horizontal and vertical pixel-centre coordinates (mm) of the output
+        columns and rows.
+    fill : float, optional
+        Value outside the projection, by default 0.
+
+    Returns
+    -------
+    ndarray
+        float32 (len(zs), len(xs)).
+    """
+    left, right, bottom, top = extent
+    nz, nx = projection.shape
+    fx = (xs - left) / (right - left) * nx - 0.5
+    fz = (zs - bottom) / (top - bottom) * nz - 0.5
+    out = _lerp_axis(_lerp_axis(projection.astype(np.float32, copy=False), fz, 0), fx, 1)
+    outside = ((fz < -0.5) | (fz > nz - 0.5))[:, None] | ((fx < -0.5) | (fx > nx - 0.5))[None, :]
+    out[outside] = fill
+    return out
+
+
+def _normalize(array, vmin, vmax):
+    """Scale to 0..1 like matplotlib's default linear norm."""
+    if vmax <= vmin:
+        return np.zeros_like(array, dtype=np.float32)
+    return np.clip((array - vmin) / (vmax - vmin), 0.0, 1.0)
+
+
+def composite_panel(ct_projection, ct_extent, box, dose_projection=None, dose_extent=None):
+    """
+    Composite one panel (CT in gray, dose in jet at 25% above 10% of max).
+
+    The panel is fitted into `box` (width, height) pixels keeping the
+    physical aspect, and centred on a white background like the
+    matplotlib figure.
+
+    Returns
+    -------
+    ndarray
+        uint8 (height, width, 3).
+    """
+    box_w, box_h = box
+    left, right, bottom, top = ct_extent
+    scale = min(box_w / (right - left), box_h / (top - bottom))  # px per mm
+    width = min(box_w, max(1, int(round((right - left) * scale))))
+    height = min(box_h, max(1, int(round((top - bottom) * scale))))
+    xs = left + (np.arange(width) + 0.5) / scale
+    zs = top - (np.arange(height) + 0.5) / scale  # image rows run top down
+
+    gray = _normalize(
+        sample_projection(ct_projection, ct_extent, xs, zs),
+        float(ct_projection.min()),
+        float(ct_projection.max()),
+    )
+    rgb = np.repeat((gray * 255)[..., None], 3, axis=2)
+    if dose_projection is not None:
+        dose = sample_projection(dose_projection, dose_extent, xs, zs)
+        dose_max = float(dose_projection.max())
+        colors = JET_LUT[
+            np.round(_normalize(dose, float(dose_projection.min()), dose_max) * 255).astype(np.uint8)
+        ]
+        alpha = (0.25 * (dose > dose_max * 0.1)).astype(np.float32)[..., None]
+        rgb = rgb * (1 - alpha) + colors * alpha
+
+    panel = np.full((box_h, box_w, 3), 255, dtype=np.uint8)
+    top_px = (box_h - height) // 2
+    left_px = (box_w - width) // 2
+    panel[top_px:top_px + height, left_px:left_px + width] = np.round(rgb)
+    return panel
+
+
+def composite_png(ct_projection, ct_extents, dose_projection=None, dose_extents=None, aspect_ratio=(16, 18)):
+    """
+    Encode the report thumbnail straight from the projection arrays.
+
+    The canvas is sized for where the image is placed in the report (the
+    figure size divided by `REPORT_SCALE`, at `DPI`), with the coronal panel
+    over the sagittal one, so no figure is built or laid out.
+
+    Parameters
+    ----------
+    Same as `render_png`.
+
+    Returns
+    -------
+    bytes
+        The PNG image.
+    """
+    from PIL import Image as PILImage
+
+    fig_width, fig_height = figure_size(aspect_ratio)
+    width = int(round(fig_width / REPORT_SCALE * DPI))
+    height = int(round(fig_height / REPORT_SCALE * DPI))
+    half = height // 2
+    panels = [
+        composite_panel(
+            ct_projection[i],
+            ct_extents[i],
+            (width, half if i == 0 else height - half),
+            None if dose_projection is None else dose_projection[i],
+            None if dose_extents is None else dose_extents[i],
+        )
+        for i in range(2)  # coronal (X–Z), sagittal (Y–Z)
+    ]
+    buf = io.BytesIO()
+    PILImage.fromarray(np.vstack(panels)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+# Uncompressed little-endian syntaxes whose pixels can be memory-mapped
+_MEMMAP_SYNTAXES = ("1.2.840.10008.1.2", "1.2.840.10008.1.2.1")
+
+
+def _slice_info(path: str, use_memmap: bool) -> Dict:
+    """
+    Geometry, rescale and pixel location of one CT slice (pixels not read).
+
+    For a header-only stub (see `ct_projection.ct_stub`) ``projection``
+    holds the rows computed when the slice was received.
+    """
+    ds = dcmread(path, defer_size=1024)
+    info = {
+        "path": path,
+        "position": [float(v) for v in ds.ImagePositionPatient],
+        "spacing": [float(v) for v in ds.PixelSpacing],
+        "shape": (int(ds.Rows), int(ds.Columns)),
+        "slope": float(getattr(ds, "RescaleSlope", 1.0) or 1.0),
+        "intercept": float(getattr(ds, "RescaleIntercept", 0.0) or 0.0),
+        "offset": None,
+        "projection": None,
+    }
+    if "PixelData" not in ds:
+        info["projection"] = stub_projection(ds)
+        if info["projection"] is None:
+            raise ValueError(f"CT slice {path} has no pixel data")
+        return info
+    syntax = getattr(getattr(ds, "file_meta", None), "TransferSyntaxUID", None)
+    if (
+        use_memmap
+        and syntax in _MEMMAP_SYNTAXES
+        and ds.get("BitsAllocated") == 16
+        and ds.get("SamplesPerPixel", 1) == 1
+    ):
+        element = ds.get_item("PixelData", keep_deferred=True)
+        if getattr(element, "value_tell", None) is not None and element.length == 2 * ds.Rows * ds.Columns:
+            info["offset"] = element.value_tell
+            info["dtype"] = "<i2" if ds.get("PixelRepresentation", 0) else "<u2"
+    return info
+
+
+def _slice_pixels(info: Dict):
+    """Stored pixel values of one slice, memory-mapped where possible."""
+    if info["offset"] is not None:
+        return np.memmap(info["path"], dtype=info["dtype"], mode="r", offset=info["offset"], shape=info["shape"])
+    return dcmread(info["path"]).pixel_array
+
+
+def project_ct_files(
+    paths: Sequence[str],
+    window_level=WINDOW_LEVEL,
+    window_width=WINDOW_WIDTH,
+    slab_slices: int = 32,
+    use_memmap: bool = True,
+):
+    """
+    Stream a CT series from disk into its coronal and sagittal projections.
+
+    Slices are ordered along z from their headers, then read in slabs of
+    `slab_slices`; each slab is rescaled to HU, windowed into a float32
+    buffer and added to the running sums, so peak memory is set by the slab
+    size rather than the volume. Uncompressed 16-bit little-endian pixel
+    data is memory-mapped instead of decoded, and the rows of header-only
+    stubs are taken as stored.
+
+    Returns
+    -------
+    tuple
+        ((coronal, sagittal), origin, spacing, size) with the projections as
+        float32 (z, x) and (z, y) arrays and the geometry in (x, y, z) order.
+    """
+    slices = sorted((_slice_info(p, use_memmap) for p in paths), key=lambda i: i["position"][2])
+    for info in slices:
+        stored = info["projection"]
+        if stored is not None and not same_window(stored["window"], window_level, window_width):
+            raise ValueError(f"CT slice {info['path']} was projected with window {stored['window']}")
+    rows, cols = slices[0]["shape"]
+    nz = len(slices)
+    min_val = window_level - (window_width / 2)
+    max_val = window_level + (window_width / 2)
+    coronal = np.empty((nz, cols), dtype=np.float32)
+    sagittal = np.empty((nz, rows), dtype=np.float32)
+    slab = np.empty((min(slab_slices, nz), rows, cols), dtype=np.float32)
+    for start in range(0, nz, slab_slices):
+        chunk = slices[start:start + slab_slices]
+        stubs = [k for k, info in enumerate(chunk) if info["projection"] is not None]
+        if len(stubs) < len(chunk):
+            buf = slab[: len(chunk)]
+            for k, info in enumerate(chunk):
+                if info["projection"] is not None:
+                    buf[k] = 0
+                    continue
+                buf[k] = _slice_pixels(info)
+                if info["slope"] != 1.0:
+                    buf[k] *= info["slope"]
+                if info["intercept"]:
+                    buf[k] += info["intercept"]
+            np.clip(buf, min_val, max_val, out=buf)
+            np.sum(buf, axis=1, dtype=np.float32, out=coronal[start:start + len(chunk)])
+            np.sum(buf, axis=2, dtype=np.float32, out=sagittal[start:start + len(chunk)])
+        for k in stubs:
+            coronal[start + k] = chunk[k]["projection"]["coronal"]
+            sagittal[start + k] = chunk[k]["projection"]["sagittal"]
+
+    z = [info["position"][2] for info in slices]
+    dz = (z[-1] - z[0]) / (nz - 1) if nz > 1 else 1.0
+    row_spacing, col_spacing = slices[0]["spacing"]
+    ox, oy, _ = slices[0]["position"]
+    return (coronal, sagittal), (ox, oy, z[0]), (col_spacing, row_spacing, dz), (cols, rows, nz)
+
+
+def read_dose(path: str):
+    """
+    Read an RTDOSE grid with pydicom.
+
+    Returns
+    -------
+    tuple
+        (stored values as (z, y, x), DoseGridScaling, origin, spacing, size),
+        with z ascending.
+    """
+    ds = dcmread(path)
+    array = ds.pixel_array
+    if array.ndim == 2:
+        array = array[np.newaxis]
+    offsets = [float(v) for v in getattr(ds, "GridFrameOffsetVector", None) or [0.0]]
+    if len(offsets) > 1 and offsets[1] < offsets[0]:
+        array = array[::-1]
+    dz = abs(offsets[1] - offsets[0]) if len(offsets) > 1 else float(getattr(ds, "SliceThickness", 1.0) or 1.0)
+    ox, oy, oz = (float(v) for v in ds.ImagePositionPatient)
+    row_spacing, col_spacing = (float(v) for v in ds.PixelSpacing)
+    nz, ny, nx = array.shape
+    return (
+        array,
+        float(getattr(ds, "DoseGridScaling", 1.0) or 1.0),
+        (ox, oy, oz + min(offsets)),
+        (col_spacing, row_spacing, dz),
+        (nx, ny, nz),
+    )
+
+
+def project_doses(paths: Sequence[str]):
+    """
+    Projection of the sum of several RTDOSE grids, read one at a time.
+
+    Projections are sums, so the projection of the summed dose is the sum of
+    the per-file projections. Grids that do not match the first file's
+    geometry cannot be added without resampling and are left out.
+
+    Returns
+    -------
+    tuple
+        ((coronal, sagittal), `projection_extents` of the first grid).
+    """
+    coronal = sagittal = geometry = None
+    for path in paths:
+        array, scaling, origin, spacing, size = read_dose(path)
+        if geometry is None:
+            geometry = (origin, spacing, size)
+            coronal, sagittal = project_dose(array, scaling)
+        elif tuple(size) == tuple(geometry[2]) and np.allclose(origin + spacing, geometry[0] + geometry[1]):
+            beam_coronal, beam_sagittal = project_dose(array, scaling)
+            coronal += beam_coronal
+            sagittal += beam_sagittal
+        del array
+    return (coronal, sagittal), projection_extents(*geometry)
+
+
+def render_plan(job: Dict) -> Dict:
+    """
+    Worker entry point: render one plan from the files named in `job`.
+
+    Parameters
+    ----------
+    job : dict
+        ``ct_paths`` (list of str), ``dose_paths`` (list of str, summed
+        when there are several, e.g. the BEAM doses of a plan) and
+        optionally ``aspect_ratio``, ``slab_slices`` (CT slices read at a
+        time, by default 32) and ``backend`` (one of
+        `RENDER_BACKENDS`, by default "matplotlib"). If ``ct_arrays`` holds a cached CT
+        projection (``ct_coronal``, ``ct_sagittal``, ``ct_extents``), the CT
+        files are not read.
+
+    Returns
+    -------
+    dict
+        ``png`` (bytes) and the projections as arrays: ``ct_coronal``,
+        ``ct_sagittal``, ``ct_extents`` and, with a dose, ``dose_coronal``,
+        ``dose_sagittal``, ``dose_extents``. Extents are (2, 4) arrays of the
+        coronal and sagittal `projection_extents`.
+    """
+    if job.get("ct_arrays") is not None:
+        ct_arrays = job["ct_arrays"]
+    else:
+        (coronal, sagittal), origin, spacing, size = project_ct_files(
+            job["ct_paths"], slab_slices=job.get("slab_slices", 32)
+        )
+        ct_arrays = {
+            "ct_coronal": coronal,
+            "ct_sagittal": sagittal,
+            "ct_extents": np.array(projection_extents(origin, spacing, size)),
+        }
+    result = dict(ct_arrays)
+    dose_projection = dose_extents = None
+    if job.get("dose_paths"):
+        dose_projection, dose_extents = project_doses(job["dose_paths"])
+        result.update(
+            dose_coronal=dose_projection[0],
+            dose_sagittal=dose_projection[1],
+            dose_extents=np.array(dose_extents),
+        )
+    encode = composite_png if job.get("backend") == "numpy" else render_png
+    result["png"] = encode(
+        (ct_arrays["ct_coronal"], ct_arrays["ct_sagittal"]),
+        [tuple(e) for e in ct_arrays["ct_extents"]],
+        dose_projection,
+        dose_extents,
+        job.get("aspect_ratio", (16, 18)),
+    )
+    return result
+
+
+def available_memory() -> Optional[int]:
+    """
+    Physical memory currently available, in bytes (None if unknown).
+
+    Linux's MemAvailable counts the page cache that can be reclaimed; free
+    memory (``SC_AVPHYS_PAGES``) does not, and on a host that has been
+    reading DICOM files for a while it understates what the workers can use
+    many times over. It is read from /proc/meminfo, else from psutil if
+    installed; sysconf and the Windows API are the fallbacks.
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+
+        return int(psutil.virtual_memory().available)
+    except Exception:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        pass
+    if sys.platform == "win32":
+        import ctypes
+
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [
+                ("dwLength", ctypes.c_ulong),
+                ("dwMemoryLoad", ctypes.c_ulong),
+                ("ullTotalPhys", ctypes.c_ulonglong),
+                ("ullAvailPhys", ctypes.c_ulonglong),
+                ("ullTotalPageFile", ctypes.c_ulonglong),
+                ("ullAvailPageFile", ctypes.c_ulonglong),
+                ("ullTotalVirtual", ctypes.c_ulonglong),
+                ("ullAvailVirtual", ctypes.c_ulonglong),
+                ("ullAvailExtendedVirtual", ctypes.c_ulonglong),
+            ]
+
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return int(status.ullAvailPhys)
+    return None
+
+
+def job_memory(job: Dict) -> int:
+    """
+    Rough peak memory of one `render_plan` call, in bytes.
+
+    The CT is streamed, so it costs one float32 slab (about twice the 16-bit
+    size of `slab_slices` slices) plus its slice headers; doses are read one
+    at a time, so the largest is held once, plus the figure overhead.
+    """
+    ct_bytes = 0
+    if job.get("ct_arrays") is None:
+        sizes = [os.path.getsize(p) for p in job["ct_paths"] if os.path.exists(p)]
+        if sizes:
+            ct_bytes = 2 * job.get("slab_slices", 32) * max(sizes) + 4096 * len(sizes)
+    dose_bytes = max(
+        (os.path.getsize(p) for p in job.get("dose_paths") or () if os.path.exists(p)), default=0
+    )
+    return ct_bytes + 2 * dose_bytes + WORKER_OVERHEAD_BYTES
+
+
+class PlanRenderer:
+    """
+    Render plans in a process pool sized by cores and available memory.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        Upper bound on worker processes, by default the CPU count.
+    memory_fraction : float, optional
+        Share of the currently available memory the workers may use
+        together, by default 0.5.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, memory_fraction: float = 0.5):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.memory_fraction = memory_fraction
+
+    def worker_count(self, jobs: Sequence[Dict]) -> int:
+        """Workers to start for `jobs`, assuming each may run the largest job."""
+        workers = min(self.max_workers, len(jobs))
+        available = available_memory()
+        if available and jobs:
+            per_worker = max(job_memory(job) for job in jobs)
+            workers = min(workers, int(available * self.memory_fraction // per_worker))
+        return max(1, workers)
+
+    def render(self, jobs: Dict[Hashable, Dict]) -> Dict[Hashable, Tuple[Optional[Dict], Optional[BaseException]]]:
+        """
+        Render every job.
+
+        Parameters
+        ----------
+        jobs : dict
+            Caller's key (e.g. the report position) -> `render_plan` job.
+
+        Returns
+        -------
+        dict
+            key -> (`render_plan` result, None) or (None, exception) per job, so the
+            caller can reassemble the results in its own order.
+        """
+        if not jobs:
+            return {}
+        workers = self.worker_count(list(jobs.values()))
+        if workers == 1:
+            return {key: self._render_inline(job) for key, job in jobs.items()}
+        results = {}
+        try:
+            # Spawned workers do not inherit the parent's threads or sockets
+            with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+                futures = {key: pool.submit(render_plan, job) for key, job in jobs.items()}
+                for key, future in futures.items():
+                    try:
+                        results[key] = (future.result(), None)
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as e:
+                        results[key] = (None, e)
+        except BrokenProcessPool:
+            # A worker died (usually out of memory): finish the rest serially
+            for key, job in jobs.items():
+                if key not in results:
+                    results[key] = self._render_inline(job)
+        return results
+
+    @staticmethod
+    def _render_inline(job):
+        try:
+            return render_plan(job), None
+        except Exception as e:
+            return None, e
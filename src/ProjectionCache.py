@@ -0,0 +1,207 @@
+"""
+Cache of plan renderings, in memory and under ``CACHE/projections``.
+
+Plans of one patient often share the planning CT (and sometimes the dose),
+and a report is regenerated whenever new records arrive. Entries are keyed
+by (CT SeriesInstanceUID, RTDOSE SOPInstanceUID(s), render parameters) and hold
+the projected float32 arrays (``.npz``) and the encoded image (``.png``), so
+a repeat render is a file read, and a new dose on a known CT skips reading
+the CT volume. The directory is kept under a byte budget by evicting the
+least recently used entries, as the instance cache does.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+
+from ._globals import CACHE_DIRECTORY
+from .logger_setup import core_logger
+
+PROJECTIONS_DIRECTORY = CACHE_DIRECTORY / "projections"
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+
+class ProjectionCache:
+    """
+    Two-level (memory LRU, then disk) cache of projection arrays and PNGs.
+
+    Parameters
+    ----------
+    cache_dir : Path, optional
+        Directory of the on-disk entries, by default CACHE/projections.
+    max_memory_entries : int, optional
+        Entries kept in memory, least recently used evicted first,
+        by default 64.
+    max_bytes : int, optional
+        Byte budget of the on-disk entries; least-recently-used entries are
+        deleted beyond it, by default 2 GiB. None disables the budget.
+    """
+
+    def __init__(
+        self,
+        cache_dir=PROJECTIONS_DIRECTORY,
+        max_memory_entries: int = 64,
+        max_bytes: Optional[int] = DEFAULT_MAX_BYTES,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_memory_entries = max_memory_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, Dict]" = OrderedDict()
+        # key -> bytes on disk, least recently used first
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def _load(self):
+        """Index the entries on disk by last use (file mtime, see `_touch`)."""
+        found = {}
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                key, _, suffix = entry.name.partition(".")
+                # Temporary files of writes in progress (or of a crashed
+                # process) are not entries
+                if suffix not in ("npz", "png") or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                size, mtime = found.get(key, (0, 0.0))
+                found[key] = (size + stat.st_size, max(mtime, stat.st_mtime))
+        with self._lock:
+            for key, (size, _) in sorted(found.items(), key=lambda item: item[1][1]):
+                self._disk[key] = size
+                self._disk_bytes += size
+            self._evict_locked()
+        core_logger.debug(
+            f"Projection cache loaded: {len(self._disk)} entries, {self._disk_bytes / 1e6:.1f} MB."
+        )
+
+    def _evict_locked(self):
+        while self.max_bytes is not None and self._disk_bytes > self.max_bytes and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self._memory.pop(key, None)
+            for path in self._paths(key):
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    core_logger.warning(f"Could not evict projection cache file {path}: {e}")
+
+    def _touch(self, key: str):
+        """Mark an entry as used, in the index and (for later runs) on disk."""
+        with self._lock:
+            if key not in self._disk:
+                return
+            self._disk.move_to_end(key)
+        try:
+            os.utime(self._paths(key)[0])
+        except OSError:
+            pass
+
+    @staticmethod
+    def key(ct_series_uid: str, dose_sop_uid: Optional[str], params: Dict) -> str:
+        """Cache key of one rendering; `params` must be JSON serialisable."""
+        blob = json.dumps([str(ct_series_uid), dose_sop_uid or "", params], sort_keys=True)
+        return hashlib.sha1(blob.encode()).hexdigest()
+
+    def _paths(self, key: str):
+        return self.cache_dir / f"{key}.npz", self.cache_dir / f"{key}.png"
+
+    def _remember(self, key: str, entry: Dict):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, key: str, need_png: bool = False) -> Optional[Dict]:
+        """
+        Look up an entry.
+
+        Parameters
+        ----------
+        key : str
+            From `key`.
+        need_png : bool, optional
+            Treat entries without an encoded image as misses.
+
+        Returns
+        -------
+        dict or None
+            The stored arrays by name, plus ``"png"`` (bytes) when present.
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+        if entry is None:
+            entry = self._read(key)
+            if entry is not None:
+                self._remember(key, entry)
+        if entry is None or (need_png and "png" not in entry):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touch(key)
+        return entry
+
+    def _read(self, key: str) -> Optional[Dict]:
+        npz_path, png_path = self._paths(key)
+        try:
+            with np.load(npz_path, allow_pickle=False) as npz:
+                entry = {name: npz[name] for name in npz.files}
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            core_logger.warning(f"Discarding unreadable projection cache entry {key}: {e}")
+            self.discard(key)
+            return None
+        if png_path.exists():
+            entry["png"] = png_path.read_bytes()
+        return entry
+
+    def put(self, key: str, png: Optional[bytes] = None, **arrays):
+        """Store arrays (and optionally the encoded image) under `key`."""
+        entry = {name: np.asarray(value) for name, value in arrays.items()}
+        if png is not None:
+            entry["png"] = png
+        self._remember(key, entry)
+        npz_path, png_path = self._paths(key)
+        try:
+            # Write then rename so readers never see a partial entry
+            tmp = npz_path.with_name(f"{key}.{os.getpid()}.tmp.npz")
+            np.savez(tmp, **{name: value for name, value in entry.items() if name != "png"})
+            os.replace(tmp, npz_path)
+            if png is not None:
+                tmp = png_path.with_suffix(f".{os.getpid()}.tmp")
+                tmp.write_bytes(png)
+                os.replace(tmp, png_path)
+            size = sum(path.stat().st_size for path in (npz_path, png_path) if path.exists())
+        except OSError as e:
+            core_logger.warning(f"Could not persist projection cache entry {key}: {e}")
+            return
+        with self._lock:
+            self._disk_bytes += size - self._disk.pop(key, 0)
+            self._disk[key] = size
+            self._evict_locked()
+
+    def discard(self, key: str):
+        """Remove an entry from memory and disk."""
+        with self._lock:
+            self._memory.pop(key, None)
+            self._disk_bytes -= self._disk.pop(key, 0)
+        for path in self._paths(key):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
@@ -4,7 +4,9 @@ Class module for DICOM SCU
 
 import time
 import logging
-from typing import List
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional
 from pydicom.sequence import Sequence
 from datetime import datetime  # , timedelta
 from pydicom.dataset import Dataset
@@ -16,11 +18,106 @@ from ._globals import (
     MODALITY_BY_CLASS_UID,
 )
 from .logger_setup import SCU_task_logger
+from . import tracing
 
 class MySCU(QueryRetrieveSCU):
-    def __init__(self, *args, logger=None, **kwargs):
+    """
+    Query/Retrieve SCU for the clinical server.
+
+    Parameters
+    ----------
+    *args, **kwargs
+        Passed to `QueryRetrieveSCU`.
+    logger : logging.Logger, optional
+        By default the SQLAlchemy SCU logger.
+    config : dict, optional
+        Loaded config.json, by default loaded once here.
+    keep_alive : bool, optional
+        Keep one association per remote AE open between requests instead of
+        associating for every C-FIND/C-MOVE, by default False. A request
+        made while that association is busy (another thread) gets its own.
+    max_idle : float, optional
+        Seconds a kept association may sit unused before it is released
+        rather than reused, by default 60; peers often time idle ones out.
+    """
+
+    def __init__(self, *args, logger=None, config=None, keep_alive=False, max_idle=60.0, **kwargs):
         super().__init__(*args, **kwargs)
         self.logger = logger or SCU_task_logger
+        self.config = config if config is not None else load_config()
+        self.keep_alive = keep_alive
+        self.max_idle = max_idle
+        # remote AE name -> [association, lock, last used, requested contexts]
+        self._warm: Dict[str, list] = {}
+        self._warm_lock = threading.Lock()
+
+    def _requested_syntaxes(self):
+        return tuple(str(c.abstract_syntax) for c in self.ae.requested_contexts)
+
+    @contextmanager
+    def association_context(self, ae_name: str):
+        """
+        `QueryRetrieveSCU.association_context` that reuses a kept association.
+
+        Without `keep_alive` (or while the kept association is in use) this
+        is the per-request association of the base class.
+        """
+        if not self.keep_alive:
+            with super().association_context(ae_name) as assoc:
+                yield assoc
+            return
+        with self._warm_lock:
+            warm = self._warm.setdefault(ae_name, [None, threading.Lock(), 0.0, None])
+        if not warm[1].acquire(blocking=False):
+            with super().association_context(ae_name) as assoc:
+                yield assoc
+            return
+        try:
+            assoc = warm[0]
+            stale = (
+                assoc is None
+                or not assoc.is_established
+                or time.monotonic() - warm[2] > self.max_idle
+                or warm[3] != self._requested_syntaxes()
+            )
+            if stale:
+                self._release(assoc)
+                assoc = warm[0] = self._establish_association(ae_name)
+                warm[3] = self._requested_syntaxes()
+                if assoc is not None:
+                    self.logger.debug(
+                        f"Opened kept association with '{ae_name}'.",
+                        extra={"op": "ASSOC-KEEP", "called_ae": ae_name},
+                    )
+            try:
+                yield assoc if assoc is not None and assoc.is_established else None
+            except BaseException:
+                # The DIMSE exchange was interrupted; the peer's state is unknown
+                if assoc is not None and assoc.is_established:
+                    assoc.abort()
+                warm[0] = None
+                raise
+            warm[2] = time.monotonic()
+        finally:
+            warm[1].release()
+
+    @staticmethod
+    def _release(assoc):
+        if assoc is not None and assoc.is_established:
+            try:
+                assoc.release()
+            except Exception:
+                assoc.abort()
+
+    def release_associations(self):
+        """Release every kept association (they are reopened on the next request)."""
+        with self._warm_lock:
+            warm = list(self._warm.values())
+        for entry in warm:
+            with entry[1]:
+                self._release(entry[0])
+                entry[0] = None
+
     # SCU QUERY TO FIND ALL RTRECORDS FOR A DAY
     # THIS LETS US SEND RTPLANS TO QUEUE
     # """QUERY for RTRECORDS by DAY"""
@@ -65,9 +162,9 @@ class MySCU(QueryRetrieveSCU):
         study_ds.ReferencedSOPInstanceUID = ""
         result["patients"] = []
         # Perform a Study Root Query/Retrieve operation with specified query dataset
-        config = load_config()
 
-        responses = self.c_find(ae_name=config["CLINICAL_SERVER"]["AETITLE"], query=study_ds)
+        with tracing.span("C-FIND RTRECORD", "scu", mrn=mrn):
+            responses = self.c_find(ae_name=self.config["CLINICAL_SERVER"]["AETITLE"], query=study_ds)
         counter = 1
         for response in responses:
             if response is not None:
@@ -152,6 +249,10 @@ class MySCU(QueryRetrieveSCU):
             if modality in ["RTPLAN", "CT"]:
                 study_ds.SOPInstanceUID = inst_uid or ""
 
+            # Return the summation type so BEAM doses can be skipped before moving
+            if modality == "RTDOSE":
+                study_ds.DoseSummationType = ""
+
             # Reference sequences
             if modality in ["RTDOSE", "RTRECORD"]:
                 study_ds.SOPInstanceUID = ""
@@ -186,10 +287,12 @@ class MySCU(QueryRetrieveSCU):
         result = {}
 
         result["patients"] = []
-        config = load_config()
 
         # Perform a Study Root Query/Retrieve operation with specified query dataset
-        responses = self.c_find(ae_name=config["CLINICAL_SERVER"]["AETITLE"], query=study_ds)
+        with tracing.span(
+            f"C-FIND {MODALITY_BY_CLASS_UID[class_uid]}", "scu", study_uid=study_uid, inst_uid=inst_uid
+        ):
+            responses = self.c_find(ae_name=self.config["CLINICAL_SERVER"]["AETITLE"], query=study_ds)
         counter = 1
         for response in responses:
             if response is not None:
@@ -288,6 +391,11 @@ class MySCU(QueryRetrieveSCU):
                 temp_ds.SeriesInstanceUID = str(instance_uid)
             else:
                 temp_ds.SOPInstanceUID = str(instance_uid)
-            config = load_config()
 
-            return self.c_move(ae_name=config["CLINICAL_SERVER"]["AETITLE"], query=temp_ds, destination_ae=config["SCP_SERVER"]["AETITLE"])
\ No newline at end of file
+            with tracing.span(
+                f"C-MOVE {MODALITY_BY_CLASS_UID.get(str(class_uid), class_uid)}",
+                "scu",
+                level=level,
+                uid=instance_uid,
+            ):
+                return self.c_move(ae_name=self.config["CLINICAL_SERVER"]["AETITLE"], query=temp_ds, destination_ae=self.config["SCP_SERVER"]["AETITLE"])
\ No newline at end of file
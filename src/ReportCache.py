@@ -0,0 +1,327 @@
+"""
+State of each patient's last report, under ``CACHE/reports``.
+
+A report is regenerated whenever late records arrive, and most of its inputs
+are the same files as last time. The cache keeps, per MRN, the size and
+modification time of every input file, the summary of every treatment record,
+and each plan's table values and image source with a fingerprint of the files
+they came from, plus a copy of the finished PDF. The report header (patient
+name, birth date) is not stored; it is read back from an RTPLAN in the
+workspace. `PDF_Parser` then:
+
+- reuses the previous PDF when no input changed;
+- skips loading the DICOM index when only records were added or changed,
+  reading just the new records;
+- otherwise recomputes only the plans whose plan, CT or dose files changed.
+
+Instances materialized from the `InstanceCache` keep their modification time,
+so fingerprints carry over between runs; re-received files count as changed.
+The directory is kept under a byte budget and a retention period (see `prune`).
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from pydicom.filereader import read_file_meta_info
+
+from ._globals import CACHE_DIRECTORY
+from .logger_setup import pdf_logger
+from .record_summary import read_record_summary, summaries_from_rows
+
+REPORTS_DIRECTORY = CACHE_DIRECTORY / "reports"
+STATE_VERSION = 3
+DEFAULT_MAX_BYTES = 1024**3
+# RT Beams / Brachy / Treatment Summary / Ion Beams Treatment Record Storage
+RECORD_SOP_CLASSES = {
+    "1.2.840.10008.5.1.4.1.1.481.4",
+    "1.2.840.10008.5.1.4.1.1.481.6",
+    "1.2.840.10008.5.1.4.1.1.481.7",
+    "1.2.840.10008.5.1.4.1.1.481.9",
+}
+
+
+def _is_record(path: str) -> bool:
+    try:
+        return str(read_file_meta_info(path).MediaStorageSOPClassUID) in RECORD_SOP_CLASSES
+    except Exception:
+        return False
+
+
+def _remove_patient(cache_dir: Path, mrn: str) -> int:
+    """Delete the state and PDF of `mrn`; returns the bytes freed."""
+    freed = 0
+    for path in (cache_dir / f"{mrn}.json", cache_dir / f"{mrn}.pdf"):
+        try:
+            size = path.stat().st_size
+            path.unlink()
+            freed += size
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            pdf_logger.warning(f"Could not remove report cache file {path}: {e}")
+    return freed
+
+
+def prune(
+    cache_dir=REPORTS_DIRECTORY,
+    max_bytes: Optional[int] = DEFAULT_MAX_BYTES,
+    retention_days: Optional[float] = None,
+    keep: Optional[str] = None,
+) -> int:
+    """
+    Remove the cached reports of patients not reported recently.
+
+    Patients whose last report is older than `retention_days` are removed,
+    then the least recently reported ones until the directory fits in
+    `max_bytes`. None disables either limit.
+
+    Parameters
+    ----------
+    keep : str, optional
+        MRN that is never removed (the report just saved).
+
+    Returns
+    -------
+    int
+        Number of patients removed.
+    """
+    cache_dir = Path(cache_dir)
+    patients = {}
+    try:
+        entries = list(os.scandir(cache_dir))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        mrn, ext = os.path.splitext(entry.name)
+        if ext not in (".json", ".pdf") or not entry.is_file():
+            continue
+        stat = entry.stat()
+        size, mtime = patients.get(mrn, (0, 0.0))
+        patients[mrn] = (size + stat.st_size, max(mtime, stat.st_mtime))
+    total = sum(size for size, _ in patients.values())
+    cutoff = time.time() - retention_days * 86400 if retention_days else None
+    removed = 0
+    # Oldest report first
+    for mrn, (size, mtime) in sorted(patients.items(), key=lambda item: item[1][1]):
+        if mrn == keep:
+            continue
+        expired = cutoff is not None and mtime < cutoff
+        over_budget = max_bytes is not None and total > max_bytes
+        if not (expired or over_budget):
+            continue
+        total -= _remove_patient(cache_dir, mrn)
+        removed += 1
+    if removed:
+        pdf_logger.info(f"Removed the cached reports of {removed} patient(s).")
+    return removed
+
+
+class ReportCache:
+    """
+    Input fingerprints and computed results of one patient's last report.
+
+    Parameters
+    ----------
+    mrn : str
+        Patient ID.
+    cache_dir : Path, optional
+        Directory of the per-patient state, by default CACHE/reports.
+    max_bytes : int, optional
+        Byte budget of the directory, enforced by `prune` after each saved
+        report, by default 1 GiB. None disables it.
+    retention_days : float, optional
+        Cached reports older than this are removed by `prune`, by default
+        kept until the byte budget evicts them.
+    """
+
+    def __init__(
+        self,
+        mrn: str,
+        cache_dir=REPORTS_DIRECTORY,
+        max_bytes: Optional[int] = DEFAULT_MAX_BYTES,
+        retention_days: Optional[float] = None,
+    ):
+        self.mrn = str(mrn)
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.retention_days = retention_days
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.state_path = self.cache_dir / f"{self.mrn}.json"
+        self.pdf_path = self.cache_dir / f"{self.mrn}.pdf"
+        self.state = self._load()
+        self.directory = None
+        self.files: Dict[str, List[int]] = {}
+        self.records: Dict[str, Dict] = {}
+        self._new_records: List[str] = []
+
+    def _load(self) -> Dict:
+        try:
+            state = json.loads(self.state_path.read_text())
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            pdf_logger.warning(f"Ignoring unreadable report cache {self.state_path}: {e}")
+            return {}
+        return state if state.get("version") == STATE_VERSION else {}
+
+    def relpath(self, path) -> str:
+        return Path(os.path.relpath(path, self.directory)).as_posix()
+
+    def abspath(self, rel: str) -> str:
+        return os.path.join(self.directory, rel)
+
+    def scan(self, directory):
+        """Record the size and mtime of every input file under `directory`."""
+        self.directory = str(directory)
+        self.files = {}
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                if file.lower().endswith(".pdf"):
+                    continue
+                full_path = os.path.join(root, file)
+                st = os.stat(full_path)
+                self.files[self.relpath(full_path)] = [st.st_size, st.st_mtime_ns]
+
+    def instance_path(self, sop_uid: str) -> Optional[str]:
+        """Workspace path of a scanned instance (``.../<SOPInstanceUID>.dcm``), or None."""
+        suffix = f"/{sop_uid}.dcm"
+        for rel in self.files:
+            if rel.endswith(suffix) or rel == suffix[1:]:
+                return self.abspath(rel)
+        return None
+
+    def fingerprint(self, paths: Iterable[str]) -> str:
+        """Digest of the names, sizes and mtimes of `paths`."""
+        items = sorted((rel, self.files.get(rel)) for rel in map(self.relpath, paths))
+        return hashlib.sha1(json.dumps(items).encode()).hexdigest()
+
+    def _diff(self):
+        old = self.state.get("files", {})
+        changed = [rel for rel, stat in self.files.items() if old.get(rel) != stat]
+        removed = [rel for rel in old if rel not in self.files]
+        return changed, removed
+
+    def unchanged(self, params: Dict) -> bool:
+        """True if the previous PDF was built from exactly these inputs."""
+        return (
+            self.state.get("params") == params
+            and self.state.get("files") == self.files
+            and self.pdf_path.exists()
+        )
+
+    def records_only(self, params: Dict) -> bool:
+        """True if the only changes since the last report are added or updated records."""
+        if self.state.get("params") != params or not self.state.get("plans"):
+            return False
+        changed, removed = self._diff()
+        if removed:
+            return False
+        known = self.state.get("records", {})
+        for rel in changed:
+            if rel not in known and not _is_record(self.abspath(rel)):
+                return False
+        self._new_records = [rel for rel in changed if rel not in known]
+        return True
+
+    def record_paths(self) -> List[str]:
+        """Records of the current scan; valid after `records_only` returned True."""
+        known = [rel for rel in self.state.get("records", {}) if rel in self.files]
+        return [self.abspath(rel) for rel in known + self._new_records]
+
+    def record_summaries(self, paths: Iterable[str], max_workers: Optional[int] = None) -> Dict[str, np.ndarray]:
+        """
+        `scan_record_summaries` that only reads records not seen with this size and mtime.
+
+        Returns
+        -------
+        dict of ndarray
+            As `record_summary.scan_record_summaries`.
+        """
+        known = self.state.get("records", {})
+        rows, pending = {}, []
+        for path in paths:
+            rel = self.relpath(path)
+            cached = known.get(rel)
+            if cached is not None and cached["stat"] == self.files.get(rel):
+                rows[rel] = tuple(cached["summary"])
+            else:
+                pending.append(rel)
+        if pending:
+            workers = max_workers or min(16, 2 * (os.cpu_count() or 1))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for rel, row in zip(pending, pool.map(read_record_summary, map(self.abspath, pending))):
+                    rows[rel] = row
+        self.records = {
+            rel: {"stat": self.files.get(rel), "summary": list(row)}
+            for rel, row in rows.items()
+            if row is not None
+        }
+        pdf_logger.info(f"Read {len(pending)} of {len(rows)} treatment records; the rest were cached.")
+        return summaries_from_rows(rows.values())
+
+    def plan_entry(self, plan_uid: str, fingerprint: Optional[str] = None) -> Optional[Dict]:
+        """
+        The cached entry of `plan_uid`, or None.
+
+        With `fingerprint`, entries computed from other inputs are misses.
+        """
+        entry = self.state.get("plans", {}).get(plan_uid)
+        if entry is None or (fingerprint is not None and entry["fingerprint"] != fingerprint):
+            return None
+        row = entry["row"]
+        # JSON has no tuples; (value, marker) pairs mark OAR doses
+        row["PrescriptionDose"] = [tuple(d) if isinstance(d, list) else d for d in row["PrescriptionDose"]]
+        return entry
+
+    def save(self, params: Dict, plans: Dict[str, Dict], rtplans: List[str], pdf_file):
+        """
+        Persist the inputs and results of a finished report and a copy of its PDF.
+
+        Other patients' cached reports are then pruned to the budget.
+        """
+        state = {
+            "version": STATE_VERSION,
+            "params": params,
+            "files": self.files,
+            "records": self.records,
+            "rtplans": list(rtplans),
+            "plans": plans,
+        }
+        try:
+            tmp = self.state_path.with_suffix(f".{os.getpid()}.tmp")
+            tmp.write_text(json.dumps(state))
+            shutil.copyfile(pdf_file, self.pdf_path)
+            os.replace(tmp, self.state_path)
+        except OSError as e:
+            pdf_logger.warning(f"Could not save the report cache for MRN={self.mrn}: {e}")
+        self.state = state
+        prune(self.cache_dir, self.max_bytes, self.retention_days, keep=self.mrn)
+
+    def update(self, plans: Dict[str, Dict]):
+        """
+        Persist precomputed plan entries and the records read so far.
+
+        The file fingerprints and PDF of the last report are left alone, so
+        the next report still sees which inputs changed.
+        """
+        state = dict(self.state, version=STATE_VERSION)
+        state["plans"] = dict(state.get("plans", {}), **plans)
+        state["records"] = dict(state.get("records", {}), **self.records)
+        try:
+            tmp = self.state_path.with_suffix(f".{os.getpid()}.tmp")
+            tmp.write_text(json.dumps(state))
+            os.replace(tmp, self.state_path)
+        except OSError as e:
+            pdf_logger.warning(f"Could not save the report cache for MRN={self.mrn}: {e}")
+        self.state = state
+
+    def restore_pdf(self, pdf_file):
+        """Copy the cached PDF to `pdf_file`."""
+        shutil.copyfile(self.pdf_path, pdf_file)
@@ -0,0 +1,83 @@
+"""
+Background precomputation of report entries during retrieval.
+
+`TaskManager` moves one plan (with its structure set, doses, records and
+images) at a time and reports each finished plan through `on_plan_complete`.
+A `ReportWorker` picks those events up on its own thread and computes the
+plan's table values and image into the report and projection caches while the
+next plans are still being moved, so the final `PDF_Parser.generate_pdf` only
+reloads the index and builds the document. Events that arrive while a batch is
+being computed are merged into the next batch. A batch reads only the headers
+of its plans' files (`PlanIndex`), not the whole workspace.
+"""
+
+import threading
+from queue import Empty, Queue
+from typing import Optional
+
+from . import tracing
+from .logger_setup import pdf_logger
+
+
+class ReportWorker:
+    """
+    Thread that precomputes each retrieved plan's report entry.
+
+    Parameters
+    ----------
+    mrn : str
+        Patient being retrieved.
+    render_backend : str, optional
+        Passed to `PDF_Parser`, by default "matplotlib". Must match the final
+        report for the cached images to be reused.
+    projection_cache_max_bytes : int, optional
+        Passed to `PDF_Parser`; None keeps its default budget.
+    """
+
+    def __init__(
+        self, mrn: str, render_backend: str = "matplotlib", projection_cache_max_bytes: Optional[int] = None
+    ):
+        self.mrn = str(mrn)
+        self.render_backend = render_backend
+        self.parser_options = {"render_backend": render_backend}
+        if projection_cache_max_bytes is not None:
+            self.parser_options["projection_cache_max_bytes"] = projection_cache_max_bytes
+        self.precomputed = 0
+        self._queue: "Queue[Optional[str]]" = Queue()
+        self._thread = threading.Thread(target=self._run, name=f"ReportWorker-{self.mrn}", daemon=True)
+        self._thread.start()
+
+    def plan_complete(self, plan_uid: str):
+        """`TaskManager.on_plan_complete` callback: queue `plan_uid` for precomputation."""
+        self._queue.put(str(plan_uid))
+
+    def close(self, timeout: Optional[float] = None):
+        """Finish the queued plans and stop the thread."""
+        if not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        with tracing.span("precompute wait", "pdf"):
+            self._thread.join(timeout)
+
+    def _run(self):
+        # Imported here so the report stack loads on this thread, overlapping
+        # the first C-FIND/C-MOVEs instead of delaying startup
+        from .PdfParser_Rosamllib import PDF_Parser
+
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            plan_uids = list(dict.fromkeys(uid for uid in batch if uid is not None))
+            if plan_uids:
+                try:
+                    with tracing.span("precompute", "pdf", plans=len(plan_uids)):
+                        PDF_Parser(self.mrn, **self.parser_options).precompute(plan_uids)
+                    self.precomputed += len(plan_uids)
+                except Exception as e:
+                    pdf_logger.error(f"Precomputing {len(plan_uids)} plan(s) failed: {e}", exc_info=True)
+            if None in batch:
+                return
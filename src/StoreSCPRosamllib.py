@@ -1,18 +1,22 @@
-from pathlib import Path
-from ._globals import TEMP_DIRECTORY
+from ._globals import TEMP_DIRECTORY, SCP_HEADER_PROJECTION
+from pydicom import dcmread
 from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+from io import BytesIO
 
 """
 Class module for DICOM SCP
 """
 
 import logging
-import os
+import math
+import shutil
+import threading
 import time
+from collections import deque
 import pynetdicom.sop_class as sop_class
 from logging import StreamHandler, FileHandler, Formatter, Handler
-from typing import Optional, Callable, List, Dict
-from pydicom.dataset import Dataset
+from typing import Optional, Callable, Iterable, List, Dict
 from pynetdicom import AE, StoragePresentationContexts, evt, register_uid
 from pynetdicom.sop_class import Verification
 from pynetdicom.service_class import StorageServiceClass
@@ -24,7 +28,11 @@ from rosamllib.utils import (
     make_rotating_file_handler,
     _dedupe_handlers,
 )
-from .logger_setup import SCP_task_logger
+from .logger_setup import SCP_task_logger, phi_token
+from .ArchiveManager import ArchiveManager
+from .ct_projection import ct_stub
+from .FileManager import FileManager
+from . import tracing
 
 # Status constants (common DICOM codes)
 STATUS_SUCCESS = 0x0000
@@ -32,12 +40,8 @@ STATUS_OUT_OF_RESOURCES = 0xA700
 STATUS_DATASET_MISMATCH = 0xA900
 STATUS_CANNOT_UNDERSTAND = 0xC000  # general processing failure
 
-
-def _mask(s: str | None, keep: int = 6) -> str | None:
-    """Mask potentially identifying strings in logs (keep first `keep` chars)."""
-    if not s or len(s) <= keep:
-        return s
-    return s[:keep] + "..."
+# Header views kept in `MyStoreSCP.received_dicom` until a consumer resets it
+RECEIVED_DICOM_LIMIT = 1024
 
 
 def _ctx_from_event(event, op: str, mask_phi: bool = True):
@@ -55,13 +59,14 @@ def _ctx_from_event(event, op: str, mask_phi: bool = True):
     def get(attr: str):
         return getattr(dset, attr, None) if dset is not None else None
 
-    val = (lambda x: _mask(x)) if mask_phi else (lambda x: x)
+    val = phi_token if mask_phi else (lambda x: x)
 
     return {
         "op": op,
         "calling_ae": calling_ae,
         "called_ae": called_ae,
         "remote_addr": hostport,
+        "mrn": val(get("PatientID")),
         "modality": get("Modality"),
         "sop_class": str(get("SOPClassUID")),
         "sop_uid": val(get("SOPInstanceUID")),
@@ -70,6 +75,119 @@ def _ctx_from_event(event, op: str, mask_phi: bool = True):
     }
 
 
+def _projection_tree(paths: Iterable[str]) -> Dict:
+    """
+    Turn dotted keyword paths into a nested projection tree.
+
+    ``["PatientID", "ROIContourSequence.ContourSequence"]`` becomes
+    ``{"PatientID": None, "ROIContourSequence": {"ContourSequence": None}}``,
+    where None means "copy the whole element".
+    """
+    tree: Dict = {}
+    for path in paths:
+        node = tree
+        *parents, leaf = path.split(".")
+        for part in parents:
+            if part in node and node[part] is None:
+                break  # whole element already requested
+            node = node.setdefault(part, {})
+        else:
+            node[leaf] = None
+    return tree
+
+
+def _project_dataset(ds: Dataset, tree: Dict) -> Dataset:
+    """Copy only the elements named in `tree`; other elements stay undecoded."""
+    view = Dataset()
+    for keyword, children in tree.items():
+        if keyword not in ds:
+            continue
+        if children is None:
+            view.add(ds[keyword])
+        else:
+            items = [_project_dataset(item, children) for item in ds[keyword].value]
+            setattr(view, keyword, Sequence(items))
+    return view
+
+
+def _dataset_nbytes(event) -> int:
+    """Size of the encoded dataset carried by a C-STORE request, if known."""
+    buf = getattr(getattr(event, "request", None), "DataSet", None)
+    try:
+        return buf.getbuffer().nbytes
+    except AttributeError:
+        return 0
+
+
+def _percentile(samples, pct: float) -> Optional[float]:
+    """Nearest-rank percentile of `samples`, or None when there are none."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(math.ceil(pct / 100 * len(ordered)) - 1, 0)
+    return ordered[rank]
+
+
+class _TransferStats:
+    """Running C-STORE counters for one association or for the SCP lifetime."""
+
+    def __init__(self, label: str = "cumulative", max_samples: int = 4096):
+        self.label = label
+        self.started = time.time()
+        self.opened = time.perf_counter()
+        self.instances = 0
+        self.bytes = 0
+        self.failures = 0
+        self.store_ms_total = 0.0
+        self.write_ms_total = 0.0
+        # Bounded latency windows for the p95; totals above keep the averages exact
+        self.store_ms = deque(maxlen=max_samples)
+        self.write_ms = deque(maxlen=max_samples)
+        # (modality, SeriesInstanceUID) -> [instances, bytes]
+        self.series: Dict[tuple, List[int]] = {}
+
+    def record(
+        self,
+        nbytes: int,
+        store_ms: float,
+        write_ms: Optional[float],
+        ok: bool,
+        series: Optional[tuple] = None,
+    ):
+        if ok:
+            self.instances += 1
+            self.bytes += nbytes
+            if series is not None:
+                counts = self.series.setdefault(series, [0, 0])
+                counts[0] += 1
+                counts[1] += nbytes
+        else:
+            self.failures += 1
+        self.store_ms_total += store_ms
+        self.store_ms.append(store_ms)
+        if write_ms is not None:
+            self.write_ms_total += write_ms
+            self.write_ms.append(write_ms)
+
+    def summary(self) -> Dict:
+        elapsed = max(time.time() - self.started, 1e-9)
+        stores = self.instances + self.failures
+        writes = len(self.write_ms)
+        return {
+            "label": self.label,
+            "instances": self.instances,
+            "bytes": self.bytes,
+            "failures": self.failures,
+            "elapsed_s": round(elapsed, 3),
+            "instances_per_s": round(self.instances / elapsed, 2),
+            "mb_per_s": round(self.bytes / elapsed / 1e6, 2),
+            "avg_store_ms": round(self.store_ms_total / stores, 2) if stores else None,
+            "p95_store_ms": _percentile(self.store_ms, 95),
+            "avg_write_ms": round(self.write_ms_total / writes, 2) if writes else None,
+            "p95_write_ms": _percentile(self.write_ms, 95),
+        }
+
+
 class MyStoreSCP:
     """
     A DICOM Storage SCP (Service Class Provider) for handling C-STORE requests.
@@ -141,7 +259,18 @@ class MyStoreSCP:
         dimse_timeout: int = 121,
         network_timeout: int = 122,
         logger: Optional[logging.Logger] = None,
-        mask_phi_logs: bool = False,
+        mask_phi_logs: bool = True,
+        max_pending_writes: int = 32,
+        max_pending_bytes: Optional[int] = None,
+        min_free_bytes: int = 2 * 1024**3,
+        resume_free_bytes: Optional[int] = None,
+        disk_check_interval: float = 1.0,
+        archive_manager: Optional[ArchiveManager] = None,
+        header_projection: Optional[List[str]] = SCP_HEADER_PROJECTION,
+        file_manager: Optional[FileManager] = None,
+        hot_path_level: int = logging.DEBUG,
+        hot_path_sample_every: int = 100,
+        slow_store_ms: float = 2000.0,
     ):
         """Initialize the SCP to handle store requests.
 
@@ -161,6 +290,51 @@ class MyStoreSCP:
             The network timeout value, by default 122
         logger : logging.Logger, optional
             The logger instance to use, by default None
+        mask_phi_logs : bool, optional
+            Replace the PatientID and UIDs in association and C-STORE log
+            context with their `logger_setup.phi_token`, by default True, so
+            no sink sees them in plain text. logs.db pseudonymizes them
+            either way, so lookups by PatientID or UID keep working.
+        max_pending_writes : int, optional
+            High watermark for in-flight C-STORE handlers. At or above it new
+            stores are answered with Out of Resources (0xA700), by default 32.
+            pynetdicom handles the stores of one association one at a time,
+            so this only trips with many concurrent associations; for the
+            usual single C-MOVE association the byte and disk watermarks
+            are the effective ones
+        max_pending_bytes : int, optional
+            High watermark for received bytes the `archive_manager` has not
+            written yet, by default the most it buffers before `add` would
+            block the association. Ignored without an `archive_manager`,
+            whose stores are written before the handler returns
+        min_free_bytes : int, optional
+            Low watermark for free space on the TEMP volume, by default 2 GiB
+        resume_free_bytes : int, optional
+            Free space required before admission resumes after the disk
+            watermark was crossed, by default twice `min_free_bytes`
+        disk_check_interval : float, optional
+            Seconds between free-space checks, by default 1.0
+        archive_manager : ArchiveManager, optional
+            Stream received instances the report does not read into the
+            output archive instead of TEMP, by default None
+        header_projection : List[str], optional
+            Keywords (dotted for nested sequence items) extracted at store
+            time and published to `received_dicom` and header subscribers in
+            place of the full dataset. None publishes the full dataset, by
+            default SCP_HEADER_PROJECTION
+        file_manager : FileManager, optional
+            Workspace writer whose index is kept current by the store path,
+            by default a new FileManager over TEMP_DIRECTORY
+        hot_path_level : int, optional
+            Level of per-instance C-STORE messages; they are skipped entirely
+            when the logger is not enabled for it, by default logging.DEBUG
+        hot_path_sample_every : int, optional
+            Log per-instance messages for one in every N stores of an
+            association (1 logs all), by default 100. Errors, refusals and
+            slow stores are always logged, and every association closes with
+            one summary line plus one per series
+        slow_store_ms : float, optional
+            Stores at least this slow are logged as warnings, by default 2000
         """
         if not (
             validate_entry(aet, "AET")
@@ -168,11 +342,20 @@ class MyStoreSCP:
             and validate_entry(port, "Port")
         ):
             raise ValueError("Invalid input for AE Title, Host, or Port.")
+        # Header views of received instances, oldest first. Consumers read
+        # the first view of a move and reset the list; nothing resets it in
+        # serve mode, so only the first RECEIVED_DICOM_LIMIT views are kept
         self.received_dicom = []
 
         self.scpAET = aet
         self.scpIP = ip
         self.scpPort = port
+        self.archive_manager = archive_manager
+        self.file_manager = file_manager or FileManager()
+        self.header_projection = header_projection
+        self._projection_tree = (
+            _projection_tree(header_projection) if header_projection is not None else None
+        )
 
         self.ae = AE(self.scpAET)
         # Add the supported presentation context (All Storage Contexts)
@@ -187,6 +370,35 @@ class MyStoreSCP:
         self._server = None
         self._server_running = None
 
+        # Admission control: watermarks for in-flight writes and free disk.
+        # Pressure is entered at the high watermarks and only cleared once
+        # both fall back past the low ones, so moves are not flapped.
+        self.max_pending_writes = max_pending_writes
+        self.resume_pending_writes = max_pending_writes // 2
+        if max_pending_bytes is None and archive_manager is not None:
+            max_pending_bytes = archive_manager.capacity_bytes()
+        self.max_pending_bytes = max_pending_bytes
+        self.resume_pending_bytes = max_pending_bytes // 2 if max_pending_bytes else None
+        self.min_free_bytes = min_free_bytes
+        self.resume_free_bytes = (
+            resume_free_bytes if resume_free_bytes is not None else 2 * min_free_bytes
+        )
+        self.disk_check_interval = disk_check_interval
+        self._pressure_lock = threading.Lock()
+        self._pending_writes = 0
+        self._free_bytes: Optional[int] = None
+        self._free_checked_at = 0.0
+        self._under_pressure = False
+        self._rejected_stores = 0
+        self._capacity = threading.Event()
+        self._capacity.set()
+
+        # Throughput accounting, keyed by id() of the live association
+        self._stats_lock = threading.Lock()
+        self._cumulative_stats = _TransferStats()
+        self._assoc_stats: Dict[int, _TransferStats] = {}
+        self._closed_associations = 0
+
         self.logger = logger or SCP_task_logger
         # Set the event handlers
         self.set_handlers()
@@ -197,6 +409,8 @@ class MyStoreSCP:
         self.custom_functions_store: List[Callable[[evt.Event], None]] = []
         # Custom functions to be run during handle_close
         self.custom_functions_close: List[Callable[[evt.Event], None]] = []
+        # Subscribers receiving the header view of every stored instance
+        self.custom_functions_header: List[Callable[[Dataset], None]] = []
 
         self.logger.info(
             f"StoreSCP initialized with AE Title: "
@@ -204,10 +418,185 @@ class MyStoreSCP:
         )
 
         self._mask_phi_logs = mask_phi_logs
+        self.hot_path_level = hot_path_level
+        self.hot_path_sample_every = hot_path_sample_every
+        self.slow_store_ms = slow_store_ms
 
     def is_running(self) -> bool:
         return self._server_running
 
+    def _refresh_free_bytes_locked(self) -> Optional[int]:
+        """Refresh the cached free space of the TEMP volume if it is stale."""
+        now = time.monotonic()
+        if self._free_bytes is None or now - self._free_checked_at >= self.disk_check_interval:
+            try:
+                self._free_bytes = shutil.disk_usage(TEMP_DIRECTORY).free
+            except OSError as e:
+                self.logger.error(f"Could not read free space for {TEMP_DIRECTORY}: {e}")
+                self._free_bytes = None
+            self._free_checked_at = now
+        return self._free_bytes
+
+    def _pending_bytes(self) -> int:
+        """Received bytes not yet on disk (buffered or queued for the archive writer)."""
+        if self.archive_manager is None or not self.max_pending_bytes:
+            return 0
+        return self.archive_manager.pending_bytes()
+
+    def _update_pressure_locked(self):
+        """Re-evaluate the pressure state against the watermarks."""
+        free = self._refresh_free_bytes_locked()
+        pending_bytes = self._pending_bytes()
+        if self._under_pressure:
+            writes_ok = self._pending_writes <= self.resume_pending_writes
+            bytes_ok = not self.max_pending_bytes or pending_bytes <= self.resume_pending_bytes
+            disk_ok = free is None or free >= self.resume_free_bytes
+            if writes_ok and bytes_ok and disk_ok:
+                self._under_pressure = False
+                self._capacity.set()
+                self.logger.info(
+                    "Storage pressure cleared; admitting C-STORE requests.",
+                    extra={"op": "SCP-ADMISSION", **self._metrics_locked()},
+                )
+        else:
+            writes_high = self._pending_writes >= self.max_pending_writes
+            bytes_high = bool(self.max_pending_bytes) and pending_bytes >= self.max_pending_bytes
+            disk_low = free is not None and free < self.min_free_bytes
+            if writes_high or bytes_high or disk_low:
+                self._under_pressure = True
+                self._capacity.clear()
+                self.logger.warning(
+                    "Storage pressure; answering C-STORE with Out of Resources.",
+                    extra={"op": "SCP-ADMISSION", **self._metrics_locked()},
+                )
+
+    def _admit(self) -> bool:
+        """Reserve a write slot for a C-STORE, or refuse it under pressure."""
+        with self._pressure_lock:
+            self._update_pressure_locked()
+            if self._under_pressure:
+                self._rejected_stores += 1
+                return False
+            self._pending_writes += 1
+            return True
+
+    def _release(self):
+        """Return a write slot reserved by `_admit`."""
+        with self._pressure_lock:
+            self._pending_writes -= 1
+            if self._under_pressure:
+                self._update_pressure_locked()
+
+    def _metrics_locked(self) -> Dict:
+        return {
+            "pending_writes": self._pending_writes,
+            "max_pending_writes": self.max_pending_writes,
+            "resume_pending_writes": self.resume_pending_writes,
+            "pending_bytes": self._pending_bytes(),
+            "max_pending_bytes": self.max_pending_bytes,
+            "free_bytes": self._free_bytes,
+            "min_free_bytes": self.min_free_bytes,
+            "resume_free_bytes": self.resume_free_bytes,
+            "under_pressure": self._under_pressure,
+            "rejected_stores": self._rejected_stores,
+        }
+
+    def metrics(self) -> Dict:
+        """
+        Return the admission-control watermarks and their current values.
+
+        Returns
+        -------
+        Dict
+            Pending writes, unwritten archive bytes and free bytes alongside
+            their high/low watermarks, whether the SCP is currently under
+            pressure, and how many stores have been refused with Out of
+            Resources.
+        """
+        with self._pressure_lock:
+            self._refresh_free_bytes_locked()
+            return self._metrics_locked()
+
+    def under_pressure(self) -> bool:
+        """Return True while C-STORE requests are being refused."""
+        with self._pressure_lock:
+            self._update_pressure_locked()
+            return self._under_pressure
+
+    def wait_for_capacity(self, timeout: Optional[float] = None) -> bool:
+        """
+        Block until storage pressure clears.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Maximum number of seconds to wait, by default wait indefinitely.
+
+        Returns
+        -------
+        bool
+            True if the SCP is admitting stores, False if `timeout` expired.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if not self.under_pressure():
+                return True
+            wait = self.disk_check_interval
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            # Woken early when a finishing write clears the pressure
+            self._capacity.wait(wait)
+
+    def _association_stats(self, event) -> _TransferStats:
+        """Return (creating if needed) the counters for the event's association."""
+        assoc = getattr(event, "assoc", None)
+        key = id(assoc)
+        stats = self._assoc_stats.get(key)
+        if stats is None:
+            remote = getattr(event, "address", None)
+            label = f"{remote[0]}:{remote[1]}" if remote else getattr(assoc, "name", str(key))
+            stats = self._assoc_stats[key] = _TransferStats(label)
+        return stats
+
+    def _record_store(self, event, nbytes: int, store_ms: float, write_ms, ok: bool, series=None):
+        with self._stats_lock:
+            self._association_stats(event).record(nbytes, store_ms, write_ms, ok, series)
+            self._cumulative_stats.record(nbytes, store_ms, write_ms, ok)
+
+    def _sample_instance_log(self, event) -> bool:
+        """Decide whether this store's per-instance messages are logged."""
+        if not self.logger.isEnabledFor(self.hot_path_level):
+            return False
+        if self.hot_path_sample_every <= 1:
+            return True
+        with self._stats_lock:
+            stats = self._association_stats(event)
+            seq = stats.instances + stats.failures
+        return seq % self.hot_path_sample_every == 0
+
+    def stats(self) -> Dict:
+        """
+        Return C-STORE throughput counters (thread-safe snapshot).
+
+        Returns
+        -------
+        Dict
+            ``cumulative`` totals since the SCP was created, a list of
+            ``associations`` that are still open (labelled by remote
+            address), and the number of ``closed_associations``. Each summary carries
+            instance, byte and failure counts, throughput, and average/p95
+            store and write latencies in milliseconds.
+        """
+        with self._stats_lock:
+            return {
+                "cumulative": self._cumulative_stats.summary(),
+                "associations": [s.summary() for s in self._assoc_stats.values()],
+                "closed_associations": self._closed_associations,
+            }
+
     def handle_open(self, event):
         """Log association establishments.
 
@@ -218,6 +607,8 @@ class MyStoreSCP:
         """
         extra = _ctx_from_event(event, "ASSOC-OPEN", mask_phi=self._mask_phi_logs)
         self.logger.info("Association opened.", extra=extra)
+        with self._stats_lock:
+            self._association_stats(event)
 
         # Run custom functions
         for func in self.custom_functions_open:
@@ -241,7 +632,37 @@ class MyStoreSCP:
         """
 
         extra = _ctx_from_event(event, "ASSOC-CLOSE", mask_phi=self._mask_phi_logs)
-        self.logger.info("Association closed.", extra=extra)
+        with self._stats_lock:
+            stats = self._assoc_stats.pop(id(getattr(event, "assoc", None)), None)
+            self._closed_associations += 1
+        if stats is not None:
+            tracing.complete(
+                "association", stats.opened, "scp",
+                calling_ae=extra["calling_ae"], instances=stats.instances,
+            )
+        if stats is not None and (stats.instances or stats.failures):
+            summary = stats.summary()
+            self.logger.info(
+                f"Association closed: {summary['instances']} instances, "
+                f"{summary['bytes'] / 1e6:.1f} MB in {summary['elapsed_s']:.1f} s "
+                f"({summary['mb_per_s']} MB/s), {summary['failures']} failures, "
+                f"store avg/p95 {summary['avg_store_ms']}/{summary['p95_store_ms']} ms, "
+                f"write avg/p95 {summary['avg_write_ms']}/{summary['p95_write_ms']} ms.",
+                extra={**extra, **summary},
+            )
+            for (modality, series_uid), (instances, nbytes) in stats.series.items():
+                self.logger.info(
+                    f"Series summary: {instances} {modality} instances, {nbytes / 1e6:.1f} MB.",
+                    extra={
+                        **extra,
+                        "modality": modality,
+                        "series_uid": series_uid,
+                        "instances": instances,
+                        "bytes": nbytes,
+                    },
+                )
+        else:
+            self.logger.info("Association closed.", extra=extra)
 
         # Run custom functions
         for func in self.custom_functions_close:
@@ -267,53 +688,169 @@ class MyStoreSCP:
         Dataset
             The status message to respond with
         """
-        self.logger.info("event is happening")
-
         t0 = time.perf_counter()
-        extra = _ctx_from_event(event, "C-STORE", mask_phi=True)
-        self.logger.info(f"{event=}")
+        extra = _ctx_from_event(event, "C-STORE", mask_phi=self._mask_phi_logs)
+        nbytes = _dataset_nbytes(event)
+        # Per-instance messages are only built for sampled stores
+        log_instance = self._sample_instance_log(event)
+        if not self._admit():
+            self.logger.warning("C-STORE refused: out of resources.", extra=extra)
+            self._record_store(event, nbytes, (time.perf_counter() - t0) * 1000, None, False)
+            status_ds = Dataset()
+            status_ds.Status = STATUS_OUT_OF_RESOURCES
+            return status_ds
+        write_ms = None
+        ok = False
         try:
             # Run custom functions
             for func in list(self.custom_functions_store):
                 try:
-                    self.logger.debug(
-                        f"Running custom store function {func.__name__}", extra=extra
-                    )
+                    if log_instance:
+                        self.logger.log(
+                            self.hot_path_level,
+                            f"Running custom store function {func.__name__}",
+                            extra=extra,
+                        )
                     func(event)
                 except Exception as e:
                     self.logger.error(
                         f"Custom store function {func.__name__} failed: {e}", extra=extra
                     )
 
-            dur = int((time.perf_counter() - t0) * 1000)
-            self.logger.info(f"C-STORE OK in {dur} ms.", extra={**extra, "duration_ms": dur})
-
             ds = event.dataset
             ds.file_meta = event.file_meta
-            self.logger.info(f"Successfully moved {ds.SOPInstanceUID}")
-            # Append to class-level list
-            self.received_dicom.append(ds)
-            pid = getattr(ds, "PatientID", "UNKNOWN_PID")
-            study_uid = getattr(ds, "StudyInstanceUID", "UNKNOWN_STUDY")
-            series_uid = getattr(ds, "SeriesInstanceUID", "UNKNOWN_SERIES")
-            modality = getattr(ds, "Modality", "UNKNOWN_MODALITY")
-            series_folder = Path(TEMP_DIRECTORY) / pid / study_uid / modality / series_uid
-
-            series_folder.mkdir(parents=True, exist_ok=True)
-            file_path = series_folder / f"{ds.SOPInstanceUID}.dcm"
-            self.logger.info(f'Trying to save to {file_path}')
-            ds.save_as(str(file_path), write_like_original=False)
-            self.logger.info(f"Saved DICOM to {file_path}")
-
+            # Publish the header view (or the full dataset) to consumers
+            self.publish_header(self.header_view(ds))
+            tw = time.perf_counter()
+            if self.archive_manager is None or self.archive_manager.keep_in_workspace(ds):
+                # The report's working set is written to TEMP only; it is
+                # added to a streamed archive at finalize
+                self.file_manager.save_dicom(ds, write_like_original=False)
+            else:
+                buf = BytesIO()
+                ds.save_as(buf, write_like_original=False)
+                data = buf.getvalue()
+                self.archive_manager.add(ds, data)
+                if self.archive_manager.keep_stub(ds):
+                    # The report reads CT through the projection rows only
+                    self.file_manager.save_dicom(ct_stub(ds), write_like_original=False, cache=False)
+                self.file_manager.record_dicom(ds, data=data)
+            write_ms = (time.perf_counter() - tw) * 1000
+            tracing.complete("write", tw, "scp")
+            if log_instance:
+                dur = int((time.perf_counter() - t0) * 1000)
+                self.logger.log(
+                    self.hot_path_level,
+                    f"C-STORE OK in {dur} ms (write {write_ms:.0f} ms): "
+                    f"{self.file_manager.dicom_path(ds)}",
+                    extra={**extra, "duration_ms": dur},
+                )
 
+            ok = True
             status_ds = Dataset()
             status_ds.Status = 0x0000
             return status_ds
+        except OSError as e:
+            # Disk full or unwritable TEMP: ask the mover to back off
+            self.logger.error(f"Error writing C-STORE request: {e}", extra=extra)
+            with self._pressure_lock:
+                self._free_bytes = None  # force a fresh disk check
+            status_ds = Dataset()
+            status_ds.Status = STATUS_OUT_OF_RESOURCES
+            return status_ds
         except Exception as e:
-            self.logger.error(f"Error handling C-STORE request: {e}")
+            self.logger.error(f"Error handling C-STORE request: {e}", extra=extra)
             status_ds = Dataset()
             status_ds.Status = 0xC000
             return status_ds
+        finally:
+            self._release()
+            store_ms = (time.perf_counter() - t0) * 1000
+            tracing.complete("C-STORE", t0, "scp", modality=extra["modality"], ok=ok)
+            self._record_store(
+                event, nbytes, store_ms, write_ms, ok,
+                series=(extra["modality"], extra["series_uid"]) if ok else None,
+            )
+            if ok and store_ms >= self.slow_store_ms:
+                # Outliers are always logged in full
+                self.logger.warning(
+                    f"Slow C-STORE: {store_ms:.0f} ms (write {write_ms:.0f} ms).",
+                    extra={**extra, "duration_ms": int(store_ms)},
+                )
+
+    def header_view(self, ds: Dataset) -> Dataset:
+        """
+        Return the configured header projection of `ds`.
+
+        Only the projected elements are converted; PixelData and sequences
+        outside the projection are left as undecoded raw elements and are not
+        referenced by the returned view.
+
+        Parameters
+        ----------
+        ds : Dataset
+            A received dataset.
+
+        Returns
+        -------
+        Dataset
+            The projected view, or `ds` itself if no projection is configured.
+        """
+        if self._projection_tree is None:
+            return ds
+        return _project_dataset(ds, self._projection_tree)
+
+    def publish_header(self, view: Dataset):
+        """Append `view` to `received_dicom` (up to its limit) and pass it to header subscribers."""
+        if len(self.received_dicom) < RECEIVED_DICOM_LIMIT:
+            self.received_dicom.append(view)
+        for func in self.custom_functions_header:
+            try:
+                func(view)
+            except Exception as e:
+                self.logger.error(f"Header subscriber {func.__name__} failed: {e}")
+
+    def ingest_cached(self, sop_uid: str) -> bool:
+        """
+        Store an instance from the persistent cache as if it had been received.
+
+        The cached file is linked into the workspace, or appended to the
+        output archive when streaming (leaving a CT stub in the workspace,
+        as `handle_store` does), and its header view is published to
+        `received_dicom` and header subscribers, so callers can skip the
+        C-MOVE entirely.
+
+        Parameters
+        ----------
+        sop_uid : str
+            SOPInstanceUID to look up in `file_manager.instance_cache`.
+
+        Returns
+        -------
+        bool
+            False on a cache miss.
+        """
+        cache = self.file_manager.instance_cache
+        if cache is None or sop_uid not in cache:
+            return False
+        try:
+            ds = dcmread(cache.path(sop_uid), stop_before_pixels=True)
+            if self.archive_manager is None or self.archive_manager.keep_in_workspace(ds):
+                if self.file_manager.link_cached(sop_uid) is None:
+                    return False
+            else:
+                data = cache.path(sop_uid).read_bytes()
+                self.archive_manager.add(ds, data)
+                if self.archive_manager.keep_stub(ds):
+                    stub = ct_stub(dcmread(BytesIO(data)))
+                    self.file_manager.save_dicom(stub, write_like_original=False, cache=False)
+                self.file_manager.record_dicom(ds)
+        except OSError as e:
+            self.logger.error(f"Could not restore {sop_uid} from cache: {e}")
+            cache.discard(sop_uid)
+            return False
+        self.publish_header(self.header_view(ds))
+        return True
 
     def set_handlers(self):
         """Set event handlers for this SCP."""
@@ -502,6 +1039,25 @@ class MyStoreSCP:
         self.custom_functions_close.append(func)
         self.logger.info(f"Custom close function '{func.__name__}' added.")
 
+    def add_custom_function_header(self, func: Callable[[Dataset], None]):
+        """
+        Subscribe a function to the header view of every stored instance.
+
+        Parameters
+        ----------
+        func : Callable[[Dataset], None]
+            A function that takes the projected header Dataset and returns None.
+
+        Examples
+        --------
+        >>> def on_header(view):
+        ...     print(f"Stored {view.Modality} {view.SOPInstanceUID}")
+        >>> scp = StoreSCP(aet='MY_SCP', ip='127.0.0.1', port=11112)
+        >>> scp.add_custom_function_header(on_header)
+        """
+        self.custom_functions_header.append(func)
+        self.logger.info(f"Header subscriber '{func.__name__}' added.")
+
     def remove_custom_function_store(self, func: Callable[[evt.Event], None]):
         """
         Remove a custom function from the `handle_store` custom functions list.
@@ -562,6 +1118,21 @@ class MyStoreSCP:
         except ValueError:
             self.logger.error(f"Custom close function '{func.__name__}' not found.")
 
+    def remove_custom_function_header(self, func: Callable[[Dataset], None]):
+        """
+        Remove a header subscriber.
+
+        Parameters
+        ----------
+        func : Callable[[Dataset], None]
+            The function to be removed.
+        """
+        try:
+            self.custom_functions_header.remove(func)
+            self.logger.info(f"Header subscriber '{func.__name__}' removed.")
+        except ValueError:
+            self.logger.error(f"Header subscriber '{func.__name__}' not found.")
+
     def clear_custom_functions_store(self):
         """Clear all custom functions for the `handle_store` event."""
         self.custom_functions_store.clear()
@@ -577,6 +1148,11 @@ class MyStoreSCP:
         self.custom_functions_close.clear()
         self.logger.info("All custom close functions cleared.")
 
+    def clear_custom_functions_header(self):
+        """Clear all header subscribers."""
+        self.custom_functions_header.clear()
+        self.logger.info("All header subscribers cleared.")
+
     def register_sop_class(self, sop_class_uid: str, keyword: str):
         """
         Register a custom SOP Class UID if not already registered.
@@ -1,16 +1,15 @@
 # task_manager_sqlalchemy.py
 import sys
-import os
-import json
+import time
 from pathlib import Path
 from queue import Queue
 from collections import namedtuple
-from datetime import datetime
+from typing import Callable, Optional
 
-import pydicom
-from .FileManager import FileManager
+from rosamllib.networking.qr_scu import MoveResult
 from .QueryRetrieveSCU_rosamllib import MySCU
 from .StoreSCPRosamllib import MyStoreSCP
+from . import tracing
 from ._globals import (
     TEMP_DIRECTORY,
     MODALITY_BY_CLASS_UID,
@@ -18,6 +17,11 @@ from ._globals import (
 
 from .logger_setup import TaskManager_task_logger  # SQLAlchemy logger
 
+# Series that never gain instances once acquired, so a series moved completely
+# before can be restored from the instance cache without asking the PACS.
+# Treatment record series grow with every delivered fraction and are always moved.
+CACHED_SERIES_MODALITIES = ("CT", "MR", "PT")
+
 class TaskManager:
     # Assign the SQLAlchemy logger at class level
     task_logger = TaskManager_task_logger
@@ -29,13 +33,23 @@ class TaskManager:
         continue_: str = None,
         mrn: str = None,
         log_level_cli: str = None,
+        throttle_timeout: float = 600.0,
+        dose_selection: str = "PLAN",
+        on_plan_complete: Optional[Callable[[str], None]] = None,
     ) -> None:
         self.scu = scu
         self.scp = scp
         self.continue_ = continue_
         self.mrn = mrn
-        self.File_Manager = FileManager()
+        # Share the SCP's workspace index so stores are visible immediately
+        self.File_Manager = scp.file_manager
         self.log_level_cli = log_level_cli
+        # Longest we hold back a C-MOVE while the SCP reports storage pressure
+        self.throttle_timeout = throttle_timeout
+        # Which RTDOSE C-FIND results are moved: "PLAN" or "ALL"
+        self.dose_selection = dose_selection.upper()
+        # Called with the RTPLAN SOPInstanceUID once everything it needs was moved
+        self.on_plan_complete = on_plan_complete
         self.task_queue = Queue()
         self.Item = namedtuple(
             "Item",
@@ -80,7 +94,9 @@ class TaskManager:
 
     def run_from_mrn(self):
         """_summary_"""
-        self.scp.start()
+        # Already listening when run by the ingestion service
+        if not self.scp.is_running():
+            self.scp.start()
         results = self.scu.find_treatment_records(mrn=self.mrn)
         for result in results:
             self.task_queue.put(
@@ -94,11 +110,181 @@ class TaskManager:
                     0,
                 )
             )
-        while not self.task_queue.empty():
-            item = self.task_queue.get()
-            self.run_task(item)
+            # Finish this plan's structure set, doses, records and images
+            # before the next plan, so its report entry can be computed
+            # while the remaining plans are still being moved
+            t0 = time.perf_counter()
+            while not self.task_queue.empty():
+                item = self.task_queue.get()
+                self.run_task(item)
+            tracing.complete("plan", t0, "task", uid=result["ReferencedSOPInstanceUID"])
+            self.plan_complete(result["ReferencedSOPInstanceUID"])
         # print("Puts all the results to task_queue")
 
+    def plan_complete(self, plan_uid):
+        """Notify `on_plan_complete` that every task of `plan_uid` has finished."""
+        TaskManager.task_logger.info(
+            f"All tasks finished for RTPLAN SOPInstanceUID={plan_uid}.",
+            extra={"op": "PLAN-COMPLETE", "mrn": self.mrn, "sop_uid": plan_uid},
+        )
+        if self.on_plan_complete is None:
+            return
+        try:
+            self.on_plan_complete(plan_uid)
+        except Exception as e:
+            TaskManager.task_logger.error(f"Plan-complete callback failed for {plan_uid}: {e}")
+
+    def wait_for_scp_capacity(self) -> None:
+        """
+        Hold back the next C-MOVE while the SCP is refusing stores.
+
+        Moves issued under pressure would only be answered with Out of
+        Resources and burn retry attempts, so wait for the SCP watermarks to
+        clear (up to `throttle_timeout`) before issuing the next one.
+        """
+        if not self.scp.under_pressure():
+            return
+        TaskManager.task_logger.warning(
+            "SCP under storage pressure; throttling C-MOVE requests.",
+            extra={"op": "THROTTLE", **self.scp.metrics()},
+        )
+        t0 = time.perf_counter()
+        cleared = self.scp.wait_for_capacity(timeout=self.throttle_timeout)
+        tracing.complete("throttle", t0, "task", cleared=cleared)
+        waited = int((time.perf_counter() - t0) * 1000)
+        if cleared:
+            TaskManager.task_logger.info(
+                f"SCP storage pressure cleared after {waited} ms.",
+                extra={"op": "THROTTLE", "duration_ms": waited},
+            )
+        else:
+            TaskManager.task_logger.error(
+                f"SCP still under storage pressure after {waited} ms; moving anyway.",
+                extra={"op": "THROTTLE", "duration_ms": waited, **self.scp.metrics()},
+            )
+
+    def restore_from_cache(self, instance_uid, level="IMAGE", modality=None):
+        """
+        Satisfy a move from the persistent instance cache.
+
+        Parameters
+        ----------
+        instance_uid : str
+            SOPInstanceUID (IMAGE level) or SeriesInstanceUID (SERIES level).
+        level : str
+            Query/Retrieve level of the move being replaced.
+        modality : str, optional
+            Modality of the series; only `CACHED_SERIES_MODALITIES` are
+            restored at SERIES level.
+
+        Returns
+        -------
+        int
+            Number of instances restored; 0 on a miss. A series is only
+            restored if it cannot have changed since it was moved completely
+            and every member is still cached.
+        """
+        cache = self.File_Manager.instance_cache
+        if cache is None:
+            return 0
+        if level == "SERIES":
+            if modality not in CACHED_SERIES_MODALITIES:
+                return 0
+            members = cache.series_members(instance_uid)
+            if not members:
+                return 0
+        else:
+            members = [instance_uid]
+        restored = 0
+        for sop_uid in members:
+            if not self.scp.ingest_cached(sop_uid):
+                break
+            restored += 1
+        if restored < len(members):
+            # Partial hit: let the C-MOVE fetch the whole set again
+            return 0
+        return restored
+
+    def move_dicom_to_scp(self, mrn, study_uid, class_uid, instance_uid, level="IMAGE"):
+        """
+        Issue a C-MOVE through the SCU once the SCP can accept it.
+
+        Instances found in the persistent cache are linked into the workspace
+        instead, and a successful MoveResult is returned without contacting
+        the PACS. Series that can still grow (treatment records) are always
+        moved.
+        """
+        modality = MODALITY_BY_CLASS_UID.get(class_uid)
+        with tracing.span("cache lookup", "task", level=level, uid=instance_uid):
+            restored = self.restore_from_cache(instance_uid, level, modality)
+        if restored:
+            TaskManager.task_logger.info(
+                f"Restored {restored} instance(s) for {level} {instance_uid} from cache.",
+                extra={"op": "CACHE-HIT", "PatientID": mrn, "StudyUID": study_uid},
+            )
+            return MoveResult(status=0x0000, completed=restored)
+        self.wait_for_scp_capacity()
+        status = self.scu.move_dicom_to_scp(mrn, study_uid, class_uid, instance_uid, level)
+        cache = self.File_Manager.instance_cache
+        if (
+            cache is not None
+            and level == "SERIES"
+            and modality in CACHED_SERIES_MODALITIES
+            and status is not None
+            and not status.status
+        ):
+            members = self.File_Manager.series_sops(mrn, study_uid, modality, instance_uid)
+            if members:
+                cache.mark_series_complete(instance_uid, members)
+        return status
+
+    def select_doses(self, results):
+        """
+        Apply the dose-selection policy to RTDOSE C-FIND results.
+
+        With the "PLAN" policy, beam-level doses are dropped whenever any
+        other dose (PLAN, or one whose DoseSummationType the PACS did not
+        return) references the plan, and are only moved as a fallback when
+        they are all there is; the report then renders their sum. "ALL"
+        moves every result, so BEAM doses are archived next to the
+        plan-level ones (before the policy existed they were moved and then
+        deleted by the report).
+
+        Parameters
+        ----------
+        results : list of dict
+            Results of `query_dicom_rt` for RTDOSE.
+
+        Returns
+        -------
+        list of dict
+            The results to enqueue.
+        """
+        if self.dose_selection == "ALL":
+            return results
+        selected = [r for r in results if str(r.get("DoseSummationType", "")).upper() != "BEAM"]
+        if not selected:
+            return results
+        skipped = len(results) - len(selected)
+        if skipped:
+            TaskManager.task_logger.info(
+                f"Skipping {skipped} BEAM RTDOSE in favour of {len(selected)} plan-level dose(s)."
+            )
+        return selected
+
+    @staticmethod
+    def _item_ctx(item):
+        """Structured logging context for a task item."""
+        return {
+            "op": f"TASK-{item.Modality}",
+            "mrn": item.PatientID,
+            "study_uid": item.StudyInstanceUID,
+            "series_uid": item.SeriesInstanceUID or None,
+            "sop_uid": item.SOPInstanceUID or None,
+            "modality": item.Modality,
+            "attempt": item.Attempt_No,
+        }
+
     def run_task(self, item):
         """_summary_
 
@@ -108,20 +294,26 @@ class TaskManager:
             _description_
         """
         if item.Attempt_No < 10:
-            if item.Modality == "RTPLAN":
-                self.run_plan(item)
-            elif item.Modality == "RTDOSE":
-                self.run_dose(item)
-            elif item.Modality == "RTRECORD":
-                self.run_record(item)
-            elif item.Modality == "RTSTRUCT":
-                self.run_struct(item)
-            elif item.Modality in ["CT", "MR", "PT"]:
-                self.run_image(item)
-            else:
-                TaskManager.task_logger.error(
-                    f"No functionality for {item.Modality} yet."
-                )
+            with tracing.span(
+                f"task {item.Modality}",
+                "task",
+                uid=item.SOPInstanceUID or item.SeriesInstanceUID,
+                attempt=item.Attempt_No,
+            ):
+                if item.Modality == "RTPLAN":
+                    self.run_plan(item)
+                elif item.Modality == "RTDOSE":
+                    self.run_dose(item)
+                elif item.Modality == "RTRECORD":
+                    self.run_record(item)
+                elif item.Modality == "RTSTRUCT":
+                    self.run_struct(item)
+                elif item.Modality in ["CT", "MR", "PT"]:
+                    self.run_image(item)
+                else:
+                    TaskManager.task_logger.error(
+                        f"No functionality for {item.Modality} yet."
+                    )
         else:
             TaskManager.task_logger.error(
                 f"Too many attempts for {item.Modality} -- "
@@ -129,7 +321,8 @@ class TaskManager:
                 + f"StudyInstanceUID={item.StudyInstanceUID}, "
                 + f"SeriesInstanceUID{item.SeriesInstanceUID}, "
                 + f"SOPInstanceUID={item.SOPInstanceUID}, "
-                + f"Attempt_No={item.Attempt_No}"
+                + f"Attempt_No={item.Attempt_No}",
+                extra=self._item_ctx(item),
             )
 
     def run_plan(self, item):
@@ -146,7 +339,8 @@ class TaskManager:
             + f"StudyInstanceUID={item.StudyInstanceUID}, "
             + f"SeriesInstanceUID{item.SeriesInstanceUID}, "
             + f"SOPInstanceUID={item.SOPInstanceUID}, "
-            + f"Attempt_No={item.Attempt_No}"
+            + f"Attempt_No={item.Attempt_No}",
+            extra=self._item_ctx(item),
         )
         # Check if it is in temp folder
         status_temp = self.File_Manager.query_uid(
@@ -158,7 +352,7 @@ class TaskManager:
         if not status_temp:
             # TaskManager.task_logger.info(f"")
             # Move RTPLAN to SCP
-            status = self.scu.move_dicom_to_scp(
+            status = self.move_dicom_to_scp(
                 item.PatientID,
                 item.StudyInstanceUID,
                 item.SOPClassUID,
@@ -225,8 +419,8 @@ class TaskManager:
                         "1.2.840.10008.5.1.4.1.1.481.2",
                         "",
                     )
-                    # For all C-FIND RTDOSE result, enqueue to Queue
-                    for result in results:
+                    # Enqueue the C-FIND RTDOSE results the dose policy selects
+                    for result in self.select_doses(results):
                         TaskManager.task_logger.info(
                             "Successfully found RTDOSE with "
                             + f"SOPInstanceUID={result['SOPInstanceUID']}"
@@ -314,7 +508,8 @@ class TaskManager:
             + f"StudyInstanceUID={item.StudyInstanceUID}, "
             + f"SeriesInstanceUID={item.SeriesInstanceUID}, "
             + f"SOPInstanceUID={item.SOPInstanceUID}, "
-            + f"Attempt_No={item.Attempt_No}"
+            + f"Attempt_No={item.Attempt_No}",
+            extra=self._item_ctx(item),
         )
         # Check if it is in temp folder
         status_temp = self.File_Manager.query_uid(
@@ -324,7 +519,7 @@ class TaskManager:
             item.SOPInstanceUID,
         )
         if not status_temp:
-            status = self.scu.move_dicom_to_scp(
+            status = self.move_dicom_to_scp(
                 item.PatientID,
                 item.StudyInstanceUID,
                 item.SOPClassUID,
@@ -461,7 +656,8 @@ class TaskManager:
             + f"StudyInstanceUID={item.StudyInstanceUID}, "
             + f"SeriesInstanceUID={item.SeriesInstanceUID}, "
             + f"SOPInstanceUID={item.SOPInstanceUID}, "
-            + f"Attempt_No={item.Attempt_No}"
+            + f"Attempt_No={item.Attempt_No}",
+            extra=self._item_ctx(item),
         )
         # Check if it is in temp folder
         status_temp = self.File_Manager.query_uid(
@@ -472,7 +668,7 @@ class TaskManager:
             series_uid=item.SeriesInstanceUID
         )
         if not status_temp:
-            status = self.scu.move_dicom_to_scp(
+            status = self.move_dicom_to_scp(
                 item.PatientID,
                 item.StudyInstanceUID,
                 item.SOPClassUID,
@@ -526,7 +722,8 @@ class TaskManager:
             + f"StudyInstanceUID={item.StudyInstanceUID}, "
             + f"SeriesInstanceUID={item.SeriesInstanceUID}, "
             + f"SOPInstanceUID={item.SOPInstanceUID}, "
-            + f"Attempt_No={item.Attempt_No}"
+            + f"Attempt_No={item.Attempt_No}",
+            extra=self._item_ctx(item),
         )
         # The RT_Plan Collects the SOPInstanceUID for the RT_Dose,
         # Need to query instance rather than series
@@ -538,7 +735,7 @@ class TaskManager:
             item.SOPInstanceUID,
         )
         if not status_temp:
-            status = self.scu.move_dicom_to_scp(
+            status = self.move_dicom_to_scp(
                 item.PatientID,
                 item.StudyInstanceUID,
                 item.SOPClassUID,
@@ -688,7 +885,7 @@ class TaskManager:
                         )
                     )
             else:
-                status = self.scu.move_dicom_to_scp(
+                status = self.move_dicom_to_scp(
                     item.PatientID,
                     item.StudyInstanceUID,
                     item.SOPClassUID,
@@ -1,5 +1,28 @@
+import multiprocessing
+import sys
+
 # Import your actual modules
-from .main import start
+from .main import start, serve, submit
+from .config import load_config
+from .DataIngestion_cli import argument_parser
+
+
+def main():
+    # Without arguments, prompt for one MRN as before
+    if len(sys.argv) < 2:
+        return start()
+    args = argument_parser()
+    if args.command == "mrn":
+        start(args.MRN)
+    elif args.command == "serve":
+        serve()
+    elif args.command == "submit":
+        submit(args.MRN)
+    elif args.command == "config":
+        load_config()
+
 
 if __name__ == "__main__":
-    start()
+    # Report rendering spawns worker processes; needed for frozen builds
+    multiprocessing.freeze_support()
+    main()
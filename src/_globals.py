@@ -16,9 +16,13 @@ else:
 TEMP_DIRECTORY = PARENT_DIRECTORY / "TEMP"
 OUTPUT_DIRECTORY = PARENT_DIRECTORY / "OUTPUT"
 LOGS_DIRECTORY = PARENT_DIRECTORY / "logs"
+# Persistent cross-run instance cache (separate from the per-run TEMP workspace)
+CACHE_DIRECTORY = PARENT_DIRECTORY / "CACHE"
+# Job queue of the ingestion service (created when the service starts)
+JOBS_DIRECTORY = PARENT_DIRECTORY / "JOBS"
 
 # Ensure necessary directories exist
-for directory in [TEMP_DIRECTORY, OUTPUT_DIRECTORY, LOGS_DIRECTORY]:
+for directory in [TEMP_DIRECTORY, OUTPUT_DIRECTORY, LOGS_DIRECTORY, CACHE_DIRECTORY]:
     directory.mkdir(parents=True, exist_ok=True)
 
 # Log formatter (consistent across scripts)
@@ -84,3 +88,21 @@ PATIENT_OBJECT_KEYS = [
     "CurrentFractionNumber",
     "ReferencedRTStructureSetSequence",
 ]
+
+# -------------------------------------------------------------------------
+# Header projection published by the SCP to its consumers
+# -------------------------------------------------------------------------
+# Dotted paths keep only the named child of every sequence item, so large
+# sequences (e.g. ContourData) are never converted.
+SCP_HEADER_PROJECTION = [
+    "PatientID",
+    "StudyInstanceUID",
+    "SeriesInstanceUID",
+    "SOPInstanceUID",
+    "SOPClassUID",
+    "Modality",
+    "DoseSummationType",
+    "ReferencedRTPlanSequence",
+    "ReferencedStructureSetSequence",
+    "ROIContourSequence.ContourSequence.ContourImageSequence",
+]
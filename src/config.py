@@ -57,3 +57,14 @@ def load_config():
     with open(config_path, "r") as f:
         config = json.load(f)
     return config
+
+
+def get_setting(config: dict, section: str, key: str, default=None):
+    """
+    Returns an optional tuning value from config.json.
+
+    Optional sections (e.g. "STORAGE") are not written by
+    `create_default_config`, so a missing section or key falls back to
+    `default`.
+    """
+    return config.get(section, {}).get(key, default)
@@ -0,0 +1,106 @@
+"""
+Per-slice CT projections and the header-only stubs that carry them.
+
+The report only shows a CT series as its windowed coronal and sagittal sums
+(see `PlanRenderer.project_ct_files`). Each slice contributes one row to
+each sum, independently of the other slices, so the rows can be computed
+while the slice is still in memory at C-STORE time. When CT is streamed into
+the output archive, the SCP writes a header-only copy of the slice to TEMP
+instead of the full instance. The copy carries the two rows in a private
+block, so the report can still resolve the plan -> CT references from the
+headers and the renderer never reads CT pixel data.
+"""
+
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian
+
+WINDOW_LEVEL = 50
+WINDOW_WIDTH = 400
+# Private block holding the projection rows of a stub
+STUB_GROUP = 0x0011
+STUB_CREATOR = "RTHISTORY CT PROJECTION"
+# Element offsets within the block
+_WINDOW, _CORONAL, _SAGITTAL = 0x00, 0x01, 0x02
+_PIXEL_GROUP = 0x7FE0
+
+
+def slice_projection(
+    ds: Dataset, window_level=WINDOW_LEVEL, window_width=WINDOW_WIDTH
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Coronal and sagittal rows of one CT slice.
+
+    The stored values are rescaled to HU and windowed in float32 exactly as
+    `PlanRenderer.project_ct_files` does for a slab, so the rows match what
+    it would compute from the full file.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        float32 sums over the rows (length Columns) and over the columns
+        (length Rows).
+    """
+    slope = float(getattr(ds, "RescaleSlope", 1.0) or 1.0)
+    intercept = float(getattr(ds, "RescaleIntercept", 0.0) or 0.0)
+    hu = ds.pixel_array.astype(np.float32)
+    if slope != 1.0:
+        hu *= slope
+    if intercept:
+        hu += intercept
+    np.clip(hu, window_level - (window_width / 2), window_level + (window_width / 2), out=hu)
+    return np.sum(hu, axis=0, dtype=np.float32), np.sum(hu, axis=1, dtype=np.float32)
+
+
+def ct_stub(ds: Dataset, window_level=WINDOW_LEVEL, window_width=WINDOW_WIDTH) -> Dataset:
+    """
+    Header-only copy of a CT slice carrying its projection rows.
+
+    Parameters
+    ----------
+    ds : pydicom.Dataset
+        A received CT slice, with its pixel data and file meta.
+
+    Returns
+    -------
+    pydicom.Dataset
+        Every element except pixel data, plus the `STUB_CREATOR` private
+        block, encoded as Explicit VR Little Endian.
+    """
+    coronal, sagittal = slice_projection(ds, window_level, window_width)
+    stub = Dataset({tag: elem for tag, elem in ds.items() if tag.group != _PIXEL_GROUP})
+    stub.file_meta = FileMetaDataset(getattr(ds, "file_meta", None) or FileMetaDataset())
+    stub.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    block = stub.private_block(STUB_GROUP, STUB_CREATOR, create=True)
+    block.add_new(_WINDOW, "DS", [window_level, window_width])
+    block.add_new(_CORONAL, "OF", coronal.astype("<f4").tobytes())
+    block.add_new(_SAGITTAL, "OF", sagittal.astype("<f4").tobytes())
+    return stub
+
+
+def stub_projection(ds: Dataset) -> Optional[Dict]:
+    """
+    Projection rows stored in a stub written by `ct_stub`.
+
+    Returns
+    -------
+    dict or None
+        ``{"window": [level, width], "coronal": ..., "sagittal": ...}``, or
+        None if `ds` is not a stub.
+    """
+    try:
+        block = ds.private_block(STUB_GROUP, STUB_CREATOR)
+    except KeyError:
+        return None
+    return {
+        "window": [float(v) for v in block[_WINDOW].value],
+        "coronal": np.frombuffer(block[_CORONAL].value, dtype="<f4"),
+        "sagittal": np.frombuffer(block[_SAGITTAL].value, dtype="<f4"),
+    }
+
+
+def same_window(window: Sequence[float], window_level=WINDOW_LEVEL, window_width=WINDOW_WIDTH) -> bool:
+    """True if a stub's `window` is (`window_level`, `window_width`)."""
+    return [float(v) for v in window] == [float(window_level), float(window_width)]
@@ -0,0 +1,123 @@
+"""
+Query and maintain the structured log database (logs/logs.db).
+
+Examples
+--------
+Trace one patient or one UID (SOP, series or study) through the logs::
+
+    python -m src.log_query --mrn 1234567 --since 2026-01-01
+    python -m src.log_query --uid 1.2.840.113619.2.55.3 --level ERROR
+
+Drop rows older than 90 days and compact the file::
+
+    python -m src.log_query --purge-days 90 --vacuum
+
+PatientIDs and UIDs are stored as keyed pseudonyms (`logger_setup.phi_token`);
+``--mrn`` and ``--uid`` take the plain values and pseudonymize them with the
+same key, so lookups need the ``logs/phi.key`` of the installation that wrote
+the rows.
+"""
+
+import argparse
+from datetime import datetime
+
+from sqlalchemy import or_
+from tabulate import tabulate
+
+from .logger_setup import LogRecord, get_session, phi_token, purge_logs
+
+
+def query_logs(mrn=None, uid=None, since=None, until=None, level=None, op=None, limit=200):
+    """
+    Return log rows matching the given filters, oldest first.
+
+    Parameters
+    ----------
+    mrn : str, optional
+        PatientID (plain or as its `phi_token`) of the `mrn` column.
+    uid : str, optional
+        Matches the SOP, series or study UID columns (plain or pseudonymized).
+    since, until : datetime, optional
+        Timestamp bounds (UTC).
+    level : str, optional
+        Exact level name, e.g. "ERROR".
+    op : str, optional
+        Operation, e.g. "C-STORE" or "TASK-RTPLAN".
+    limit : int, optional
+        Maximum number of rows, by default 200.
+
+    Returns
+    -------
+    list of LogRecord
+    """
+    with get_session() as session:
+        q = session.query(LogRecord)
+        if mrn:
+            q = q.filter(LogRecord.mrn == phi_token(mrn))
+        if uid:
+            uid = phi_token(uid)
+            q = q.filter(
+                or_(
+                    LogRecord.sop_uid == uid,
+                    LogRecord.series_uid == uid,
+                    LogRecord.study_uid == uid,
+                )
+            )
+        if since:
+            q = q.filter(LogRecord.timestamp >= since)
+        if until:
+            q = q.filter(LogRecord.timestamp < until)
+        if level:
+            q = q.filter(LogRecord.level == level.upper())
+        if op:
+            q = q.filter(LogRecord.op == op)
+        return q.order_by(LogRecord.timestamp, LogRecord.id).limit(limit).all()
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(
+        prog="RTHistory-logs",
+        description="Look up RTHistory log records by patient or UID, or purge old records.",
+    )
+    parser.add_argument("--mrn", help="PatientID to trace")
+    parser.add_argument("--uid", help="SOP, series or study instance UID to trace")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="Start (ISO date/time, UTC)")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="End (ISO date/time, UTC)")
+    parser.add_argument("--level", help="Only this level (e.g. ERROR)")
+    parser.add_argument("--op", help="Only this operation (e.g. C-STORE)")
+    parser.add_argument("--limit", type=int, default=200, help="Maximum rows (default 200)")
+    parser.add_argument("--purge-days", type=int, help="Delete rows older than this many days")
+    parser.add_argument("--vacuum", action="store_true", help="Compact logs.db after purging")
+    return parser
+
+
+def main(argv=None):
+    args = argument_parser().parse_args(argv)
+    if args.purge_days is not None:
+        deleted = purge_logs(args.purge_days, vacuum=args.vacuum)
+        print(f"Deleted {deleted} log records older than {args.purge_days} days.")
+        return
+    rows = query_logs(
+        mrn=args.mrn,
+        uid=args.uid,
+        since=args.since,
+        until=args.until,
+        level=args.level,
+        op=args.op,
+        limit=args.limit,
+    )
+    table = [
+        [r.timestamp, r.level, r.logger_name, r.op, r.sop_uid or r.series_uid, r.duration_ms, r.message]
+        for r in rows
+    ]
+    print(
+        tabulate(
+            table,
+            headers=["Timestamp", "Level", "Logger", "Op", "UID", "ms", "Message"],
+            maxcolwidths=[None, None, None, None, 28, None, 80],
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,19 @@
 # logger_setup.py
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime
+from sqlalchemy import (
+    create_engine, event, inspect, text, Column, Index, Integer, String, Text, DateTime
+)
 from sqlalchemy.orm import declarative_base, sessionmaker
-from datetime import datetime
+from datetime import datetime, timedelta
+import atexit
+import hashlib
+import hmac
+import json
 import logging
+import os
+import queue
+import re
+import threading
+import time
 from pathlib import Path
 import sys
 if getattr(sys, 'frozen', False):
@@ -14,38 +25,370 @@ else:
 LOGS_DIRECTORY = PARENT_DIRECTORY / "logs" 
 LOGS_DIRECTORY.mkdir(exist_ok=True)
 LOGS_PATH = LOGS_DIRECTORY / "logs.db"
+# Key of the PatientID/UID pseudonyms in logs.db (see `phi_token`)
+PHI_KEY_PATH = LOGS_DIRECTORY / "phi.key"
 Base = declarative_base()
-engine = create_engine(f"sqlite:///{LOGS_PATH}", echo=False)
-Session = sessionmaker(bind=engine)
+# The engine and table are created on first use (normally by the background
+# writer), not at import, so entry points that never log to the database
+# start without touching SQLite.
+_engine = None
+_Session = None
+_engine_lock = threading.Lock()
+
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers (and the query tools) run while the writer commits
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+def get_engine():
+    """The logs.db engine, created (and the table migrated) on first call."""
+    global _engine, _Session
+    with _engine_lock:
+        if _engine is None:
+            engine = create_engine(f"sqlite:///{LOGS_PATH}", echo=False)
+            event.listen(engine, "connect", _sqlite_pragmas)
+            _migrate_logs_table(engine)
+            _Session = sessionmaker(bind=engine)
+            _engine = engine
+        return _engine
+
+
+def get_session():
+    """A new ORM session on logs.db."""
+    get_engine()
+    return _Session()
+
+
+def __getattr__(name):
+    # `engine` and `Session` used to be created at import
+    if name == "engine":
+        return get_engine()
+    if name == "Session":
+        get_engine()
+        return _Session
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 class LogRecord(Base):
     __tablename__ = "logs"
     id = Column(Integer, primary_key=True)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    timestamp = Column(DateTime, default=datetime.utcnow, index=True)
     logger_name = Column(String(50))
     level = Column(String(10))
     message = Column(Text)
+    # Structured context lifted out of `extra=` so it can be indexed
+    mrn = Column(String(64))
+    study_uid = Column(String(64), index=True)
+    series_uid = Column(String(64), index=True)
+    sop_uid = Column(String(64), index=True)
+    op = Column(String(32))
+    duration_ms = Column(Integer)
+    # Remaining `extra=` fields as JSON
     extra = Column(Text)
 
-Base.metadata.create_all(engine)
+    __table_args__ = (Index("ix_logs_mrn_timestamp", "mrn", "timestamp"),)
+
+
+def _migrate_logs_table(engine):
+    """Create the logs table, adding columns and indexes missing from older databases."""
+    Base.metadata.create_all(engine)
+    table = LogRecord.__table__
+    existing = {col["name"] for col in inspect(engine).get_columns(table.name)}
+    with engine.begin() as conn:
+        for column in table.columns:
+            if column.name not in existing:
+                col_type = column.type.compile(engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}"))
+    for index in table.indexes:
+        index.create(engine, checkfirst=True)
+
+
+# Patient identifiers never reach logs.db in plain text. The context columns
+# hold a keyed pseudonym instead, the same for every occurrence, so rows can
+# still be looked up by PatientID or UID (`log_query` pseudonymizes its
+# arguments the same way), and identifiers in message text are replaced too.
+_PHI_COLUMNS = ("mrn", "study_uid", "series_uid", "sop_uid")
+PHI_TOKEN_PREFIX = "phi-"
+# DICOM UIDs (also inside paths such as TEMP/<mrn>/<study>/...)
+_UID_RE = re.compile(r"(?<![\d.])[0-2](?:\.\d+){3,}(?!\d)")
+# "PatientID=...", "MRN: ..." and the MRN folder of workspace and output paths
+_MRN_RE = re.compile(r"(?i)(\b(?:PatientID|MRN)\s*[=:]\s*|\b(?:TEMP|OUTPUT|reports)[\\/])([^\s,;:)\]\\/.]+)")
+_phi_key = None
+_phi_key_lock = threading.Lock()
+
+
+def _get_phi_key() -> bytes:
+    """The installation's pseudonym key, created (readable by the owner only) on first use."""
+    global _phi_key
+    with _phi_key_lock:
+        if _phi_key is None:
+            try:
+                fd = os.open(PHI_KEY_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            except FileExistsError:
+                pass
+            else:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(os.urandom(32))
+            _phi_key = PHI_KEY_PATH.read_bytes()
+        return _phi_key
+
+
+def phi_token(value):
+    """
+    Keyed pseudonym of a PatientID or UID, as stored in logs.db.
+
+    The same value always gives the same token on this installation, and
+    tokens cannot be reversed without ``logs/phi.key``. Tokens and empty
+    values are returned unchanged.
+    """
+    if value is None or value == "":
+        return value
+    value = str(value)
+    if value.startswith(PHI_TOKEN_PREFIX):
+        return value
+    digest = hmac.new(_get_phi_key(), value.encode(), hashlib.sha256).hexdigest()
+    return PHI_TOKEN_PREFIX + digest[:20]
+
+
+def scrub_phi(text: str, identifiers=()) -> str:
+    """
+    Replace patient identifiers in free text with their `phi_token`.
+
+    `identifiers` (the record's own PatientID and UIDs) are replaced
+    wherever they appear; UIDs, ``PatientID=``/``MRN:`` values and the MRN
+    folder of TEMP/OUTPUT paths are found by pattern.
+    """
+    for value in sorted({str(v) for v in identifiers if v}, key=len, reverse=True):
+        if not value.startswith(PHI_TOKEN_PREFIX):
+            text = text.replace(value, phi_token(value))
+    text = _UID_RE.sub(lambda m: phi_token(m.group(0)), text)
+    return _MRN_RE.sub(lambda m: m.group(1) + phi_token(m.group(2)), text)
+
+
+# Attributes every LogRecord has; anything else on a record came from `extra=`
+_RECORD_ATTRS = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime"}
+# Context column -> `extra=` keys used for it across the code base
+_CONTEXT_KEYS = {
+    "mrn": ("mrn", "PatientID"),
+    "study_uid": ("study_uid", "StudyUID", "StudyInstanceUID"),
+    "series_uid": ("series_uid", "SeriesUID", "SeriesInstanceUID"),
+    "sop_uid": ("sop_uid", "SOPInstanceUID"),
+    "op": ("op",),
+    "duration_ms": ("duration_ms",),
+}
+
+
+def _record_context(record):
+    """
+    Split a record's `extra=` fields into context columns and a JSON remainder.
+
+    Returns
+    -------
+    tuple
+        (column values, with identifiers as `phi_token`; the plain
+        identifiers, for `scrub_phi` of the message).
+    """
+    fields = {k: v for k, v in record.__dict__.items() if k not in _RECORD_ATTRS}
+    row = {}
+    identifiers = []
+    for column, keys in _CONTEXT_KEYS.items():
+        values = [fields.pop(key) for key in keys if key in fields]
+        if column in _PHI_COLUMNS:
+            identifiers.extend(str(v) for v in values if v is not None and v != "")
+            row[column] = next((phi_token(v) for v in values if v is not None and v != ""), None)
+            continue
+        value = next((v for v in values if v is not None and v != ""), None)
+        if value is not None:
+            try:
+                value = int(value) if column == "duration_ms" else str(value)
+            except (TypeError, ValueError):
+                fields[column] = value
+                value = None
+        row[column] = value
+    row["extra"] = scrub_phi(json.dumps(fields, default=str), identifiers) if fields else None
+    return row, identifiers
+
+
+def purge_logs(older_than_days, vacuum=False):
+    """
+    Delete log rows older than `older_than_days`, one day partition at a time.
+
+    Deleting per day keeps each transaction small so running loggers are
+    never blocked for long. `vacuum` compacts the file afterwards.
+
+    Returns
+    -------
+    int
+        Number of rows deleted.
+    """
+    flush_logs()
+    engine = get_engine()
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    table = LogRecord.__table__
+    with engine.connect() as conn:
+        oldest = conn.execute(text(f"SELECT MIN(timestamp) FROM {table.name}")).scalar()
+    if oldest is None:
+        return 0
+    if isinstance(oldest, str):
+        oldest = datetime.fromisoformat(oldest)
+    deleted = 0
+    day_end = datetime(oldest.year, oldest.month, oldest.day) + timedelta(days=1)
+    while True:
+        bound = min(day_end, cutoff)
+        with engine.begin() as conn:
+            deleted += conn.execute(table.delete().where(table.c.timestamp < bound)).rowcount
+        if bound >= cutoff:
+            break
+        day_end += timedelta(days=1)
+    if vacuum:
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text("VACUUM"))
+    return deleted
+
+class _BatchedLogWriter(threading.Thread):
+    """
+    Background thread that drains queued log rows into the database.
+
+    Rows are inserted in one transaction per batch, flushed when `batch_size`
+    rows are pending or `flush_interval` seconds have passed, and drained on
+    shutdown.
+    """
+
+    _STOP = object()
+
+    def __init__(self, batch_size=500, flush_interval=1.0, max_queue=100_000):
+        super().__init__(name="LogWriter", daemon=True)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+
+    def enqueue(self, row):
+        """Queue a row without blocking; rows are dropped (and counted) if full."""
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.monotonic(), 0.0))
+            except queue.Empty:
+                item = None
+            if item is self._STOP:
+                self._write(batch)
+                return
+            if isinstance(item, threading.Event):
+                # flush() request: write everything queued before it
+                self._write(batch)
+                batch = []
+                item.set()
+            elif item is not None:
+                batch.append(item)
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                self._write(batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+    def _write(self, batch):
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            batch.append(
+                {
+                    "timestamp": datetime.utcnow(),
+                    "logger_name": "LogWriter",
+                    "level": "WARNING",
+                    "message": f"Dropped {dropped} log records; queue was full.",
+                    **{column: None for column in _CONTEXT_KEYS},
+                    "extra": None,
+                }
+            )
+        if not batch:
+            return
+        try:
+            with get_engine().begin() as conn:
+                conn.execute(LogRecord.__table__.insert(), batch)
+        except Exception as e:
+            sys.stderr.write(f"Could not write {len(batch)} log records: {e}\n")
+
+    def flush(self, timeout=10.0):
+        """Block until every row queued so far has been committed."""
+        if not self.is_alive():
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait(timeout)
+
+    def stop(self, timeout=10.0):
+        """Drain the queue and stop the writer."""
+        if not self.is_alive():
+            return
+        self.queue.put(self._STOP)
+        self.join(timeout)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def _get_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = _BatchedLogWriter()
+            _writer.start()
+            atexit.register(shutdown_logging)
+        return _writer
+
+
+def flush_logs(timeout=10.0):
+    """Block until queued log records are committed to logs.db."""
+    if _writer is not None:
+        _writer.flush(timeout)
+
+
+def shutdown_logging(timeout=10.0):
+    """Drain queued log records and stop the background writer."""
+    if _writer is not None:
+        _writer.stop(timeout)
+
 
 class SQLAlchemyHandler(logging.Handler):
-    """Custom logging handler that writes logs to SQLAlchemy DB."""
+    """
+    Custom logging handler that writes logs to SQLAlchemy DB.
+
+    `emit` only formats the record (pseudonymizing patient identifiers, see
+    `scrub_phi`) and queues it; a single background writer commits rows in
+    batches, so logging never waits on SQLite.
+    """
+    def __init__(self, level=logging.NOTSET):
+        super().__init__(level)
+        self.writer = _get_writer()
+
     def emit(self, record):
-        session = Session()
         try:
-            extra = getattr(record, "extra", None)
-            log = LogRecord(
-                timestamp=datetime.utcfromtimestamp(record.created),
-                logger_name=record.name,
-                level=record.levelname,
-                message=self.format(record),
-                extra=str(extra) if extra else None,
+            context, identifiers = _record_context(record)
+            self.writer.enqueue(
+                {
+                    "timestamp": datetime.utcfromtimestamp(record.created),
+                    "logger_name": record.name,
+                    "level": record.levelname,
+                    "message": scrub_phi(self.format(record), identifiers),
+                    **context,
+                }
             )
-            session.add(log)
-            session.commit()
-        finally:
-            session.close()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.writer.flush()
 
 def get_sqlalchemy_logger(name: str, level=logging.INFO) -> logging.Logger:
     logger = logging.getLogger(name)
@@ -64,3 +407,4 @@ TaskManager_task_logger = get_sqlalchemy_logger("TaskManager", level=logging.DEB
 SCP_task_logger = get_sqlalchemy_logger("StoreSCP", level=logging.DEBUG)
 SCU_task_logger = get_sqlalchemy_logger("QueryRetrieveSCU", level=logging.DEBUG)
 pdf_logger = get_sqlalchemy_logger("PDF_Generator", level=logging.DEBUG)
+archive_logger = get_sqlalchemy_logger("Archive", level=logging.DEBUG)
@@ -1,57 +1,53 @@
 # src/main_sqlalchemy_logging.py
 
-import sys
-import argparse
 import time
-from pathlib import Path
 from .config import load_config
-from .QueryRetrieveSCU_rosamllib import MySCU
-from .StoreSCPRosamllib import MyStoreSCP
-from .TaskManagerRosamllib import TaskManager
-from .PdfParser_Rosamllib import run
-from .logger_setup import core_logger, TaskManager_task_logger  # SQLAlchemy loggers
+from .logger_setup import core_logger  # SQLAlchemy logger
 
-def start():
+# The DICOM networking stack (rosamllib, pynetdicom) and the report stack
+# (matplotlib, SimpleITK, pandas, reportlab) take seconds to import, so they
+# are imported by `IngestionService` once a patient is actually processed; the
+# report stack only when the report is built (or by the ReportWorker thread,
+# while retrieval runs). `python -m src.startup_benchmark` checks the budget.
+
+
+def start(mrn=None):
     start_time = time.time()
     config = load_config()
-    mrn = input("Please input the PatientID: ")
+    if mrn is None:
+        mrn = input("Please input the PatientID: ")
 
-    core_logger.info(f"Starting DataIngestion for MRN: {mrn}")
+    from .IngestionService import IngestionService
 
-    # --- Extract SCP / Clinical info ---
-    scp_cfg = config["SCP_SERVER"]
-    clinical_cfg = config["CLINICAL_SERVER"]
+    service = IngestionService(config)
+    try:
+        service.open()
+        service.process(mrn)
+    except Exception as e:
+        core_logger.error(f"Unhandled exception: {e}", exc_info=True)
+    finally:
+        service.close()
+        service.purge_logs(force=True)
+        core_logger.info(f"Finished in {time.time() - start_time:.2f} seconds")
 
-    SCP_AETITLE = scp_cfg["AETITLE"]
-    SCP_HOST = scp_cfg["HOST"]
-    SCP_PORT = scp_cfg["PORT"]
 
-    CLINICAL_AETITLE = clinical_cfg["AETITLE"]
-    CLINICAL_HOST = clinical_cfg["HOST"]
-    CLINICAL_PORT = clinical_cfg["PORT"]
+def serve():
+    """Run the ingestion service: keep the SCP and SCU up and process queued MRNs."""
+    from .IngestionService import IngestionService
 
+    service = IngestionService(load_config())
     try:
-        # --- Initialize DICOM SCU ---
-        scu = MySCU(SCP_AETITLE)
-        scu.add_remote_ae(CLINICAL_AETITLE, CLINICAL_AETITLE, CLINICAL_HOST, CLINICAL_PORT)
-        scu.add_remote_ae(SCP_AETITLE, SCP_AETITLE, SCP_HOST, SCP_PORT)
-        scp = MyStoreSCP(SCP_AETITLE, SCP_HOST, SCP_PORT)
+        service.open()
+        service.serve()
+    finally:
+        service.close()
 
-        # --- Run TaskManager ---
-        tm = TaskManager(scu, scp, mrn=mrn, log_level_cli="INFO")
-        TaskManager.task_logger = TaskManager_task_logger  # assign SQLAlchemy logger
-        tm.run()
 
-        # --- Run PDF parser ---
-        run(mrn)
+def submit(mrn):
+    """Queue `mrn` for a running ingestion service."""
+    from .IngestionService import submit_job
 
-        core_logger.info("DataIngestion complete.")
-    except Exception as e:
-        core_logger.error(f"Unhandled exception: {e}", exc_info=True)
-        scp.stop()
-    finally:
-        scp.stop()
-        core_logger.info(f"Finished in {time.time() - start_time:.2f} seconds")
+    print(f"Queued {mrn}: {submit_job(mrn)}")
 
 if __name__ == "__main__":
     start()
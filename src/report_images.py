@@ -0,0 +1,141 @@
+"""
+Encoding of plan images for embedding in the report PDF.
+
+Plans are rendered at `PlanRenderer.DPI` on a figure `PlanRenderer.REPORT_SCALE`
+times larger than its place on the page, i.e. over 1000 dpi as printed, and
+ReportLab embeds the PNG losslessly. With many plans that dominates both the
+PDF size and `doc.build` time. Here the rendered images are resampled to a
+target print resolution and re-encoded as JPEG or palette PNG, and the
+resolution is lowered until all images fit a byte budget.
+"""
+
+import io
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence, Tuple
+
+from PIL import Image
+
+from . import PlanRenderer
+
+# "png": lossless RGB, "png8": 256-colour palette PNG, "jpeg": 4:4:4 JPEG
+IMAGE_FORMATS = ("png", "png8", "jpeg")
+# Lowest print resolution the budget may push images to
+MIN_DPI = 72
+# Full encoding passes spent searching for the resolution that fits a budget
+MAX_PASSES = 5
+# Estimated PDF bytes besides the images: fixed, and per plan (tables, text)
+PDF_BASE_BYTES = 60_000
+PDF_BYTES_PER_PLAN = 6_000
+
+
+def display_size(aspect_ratio=(16, 18)) -> Tuple[float, float]:
+    """(width, height) in inches of a plan image on the page."""
+    fig_width, fig_height = PlanRenderer.figure_size(aspect_ratio)
+    return fig_width / PlanRenderer.REPORT_SCALE, fig_height / PlanRenderer.REPORT_SCALE
+
+
+def native_dpi() -> float:
+    """Print resolution of an image as rendered."""
+    return PlanRenderer.DPI * PlanRenderer.REPORT_SCALE
+
+
+def encode_image(png: bytes, dpi: float, fmt: str = "png", quality: int = 85) -> bytes:
+    """
+    Resample a rendered plan PNG to `dpi` (as printed) and encode it as `fmt`.
+
+    The image is never enlarged; at the native resolution a "png" is
+    returned unchanged.
+    """
+    with Image.open(io.BytesIO(png)) as img:
+        scale = min(1.0, dpi / native_dpi())
+        if scale >= 1.0 and fmt == "png":
+            return png
+        img = img.convert("RGB")
+        if scale < 1.0:
+            size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            img = img.resize(size, Image.LANCZOS, reducing_gap=2.0)
+        out = io.BytesIO()
+        if fmt == "jpeg":
+            img.save(out, "JPEG", quality=quality, subsampling=0, optimize=True)
+        elif fmt == "png8":
+            img.quantize(256, method=Image.Quantize.FASTOCTREE).save(out, "PNG")
+        else:
+            img.save(out, "PNG")
+        return out.getvalue()
+
+
+def fit_images(
+    pngs: Sequence[bytes],
+    fmt: str = "png",
+    dpi: Optional[float] = None,
+    budget_bytes: Optional[int] = None,
+    quality: int = 85,
+    max_workers: Optional[int] = None,
+) -> Tuple[List[bytes], float]:
+    """
+    Encode plan images at the highest resolution up to `dpi` that fits `budget_bytes`.
+
+    Parameters
+    ----------
+    pngs : sequence of bytes
+        Rendered plan images.
+    fmt : str, optional
+        One of `IMAGE_FORMATS`, by default "png".
+    dpi : float, optional
+        Target print resolution, by default the native one.
+    budget_bytes : int, optional
+        Total bytes allowed for the encoded images, by default unlimited.
+        Resolution is reduced (not below `MIN_DPI`) until they fit.
+    quality : int, optional
+        JPEG quality, by default 85.
+    max_workers : int, optional
+        Encoder threads, by default the CPU count.
+
+    Returns
+    -------
+    tuple
+        (encoded images in input order, resolution used).
+    """
+    if fmt not in IMAGE_FORMATS:
+        raise ValueError(f"Unknown image format {fmt!r}; expected one of {IMAGE_FORMATS}.")
+    dpi = min(dpi or native_dpi(), native_dpi())
+    if not pngs:
+        return [], dpi
+    workers = max_workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+
+        def encode_all(at_dpi):
+            encoded = list(pool.map(lambda png: encode_image(png, at_dpi, fmt, quality), pngs))
+            return encoded, sum(map(len, encoded))
+
+        if budget_bytes is None:
+            return encode_all(dpi)[0], dpi
+        if fmt == "png" and dpi >= native_dpi() and sum(map(len, pngs)) <= budget_bytes:
+            return list(pngs), dpi
+        # Search the resolution between MIN_DPI and `dpi`. Guesses assume the
+        # size scales with pixel count (dpi squared), but resampling noise
+        # makes PNG sizes irregular, so they are kept inside the bracket.
+        lo, hi = MIN_DPI, dpi
+        reference = min(dpi, 150)
+        sample = len(encode_image(pngs[0], reference, fmt, quality)) * len(pngs)
+        guess = reference * math.sqrt(0.97 * budget_bytes / sample)
+        best = None
+        for _ in range(MAX_PASSES):
+            guess = max(lo, min(hi, guess))
+            encoded, total = encode_all(guess)
+            if total <= budget_bytes:
+                best = (encoded, guess)
+                if guess >= hi or total >= 0.85 * budget_bytes:
+                    break
+                lo = guess
+            else:
+                hi = guess
+                if guess <= MIN_DPI:
+                    break
+            model = guess * math.sqrt(0.97 * budget_bytes / total)
+            guess = model if lo < model < hi else math.sqrt(lo * hi)
+        if best is None:
+            best = (encode_all(MIN_DPI)[0], MIN_DPI)
+        return best
@@ -0,0 +1,162 @@
+"""
+Measure the import time of each entry point against a budget.
+
+Every entry point is imported in a fresh interpreter, several times, and the
+median wall time is compared with its budget. The heavy stacks each entry
+point must not load at import (see `main`) are checked too, so a stray
+top-level import fails the check even on a fast machine.
+
+Examples
+--------
+Check every entry point against the default budgets::
+
+    python -m src.startup_benchmark
+
+Loosen one budget and show the slowest imports of the failures::
+
+    python -m src.startup_benchmark --budget main=0.8 --importtime
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, Optional
+
+from tabulate import tabulate
+
+PACKAGE = __package__ or "src"
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent
+
+# Top-level packages of the DICOM networking and report stacks
+NETWORK_STACK = ("rosamllib", "pynetdicom")
+REPORT_STACK = ("matplotlib", "SimpleITK", "reportlab", "pandas")
+
+# Entry point -> (import budget in seconds, packages it must not import)
+ENTRY_POINTS = {
+    "main": (0.6, NETWORK_STACK + REPORT_STACK),
+    "__main__": (0.6, NETWORK_STACK + REPORT_STACK),
+    "DataIngestion_cli": (0.1, NETWORK_STACK + REPORT_STACK + ("sqlalchemy",)),
+    "config": (0.1, NETWORK_STACK + REPORT_STACK + ("sqlalchemy",)),
+    "log_query": (0.8, NETWORK_STACK + REPORT_STACK),
+}
+
+_PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - t0
+print(json.dumps({{"seconds": elapsed, "modules": sorted({{m.split(".")[0] for m in sys.modules}})}}))
+"""
+
+
+def measure(entry_point: str, repeat: int = 3) -> Dict:
+    """
+    Import ``<package>.<entry_point>`` in `repeat` fresh interpreters.
+
+    Returns
+    -------
+    dict
+        ``seconds`` (median import time) and ``modules`` (top-level packages
+        loaded by the import).
+    """
+    module = f"{PACKAGE}.{entry_point}"
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", _PROBE.format(module=module)],
+            cwd=PACKAGE_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return {
+        "seconds": statistics.median(run["seconds"] for run in runs),
+        "modules": runs[-1]["modules"],
+    }
+
+
+def slowest_imports(entry_point: str, count: int = 15):
+    """The `count` imports with the largest cumulative time (``-X importtime``)."""
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {PACKAGE}.{entry_point}"],
+        cwd=PACKAGE_ROOT,
+        capture_output=True,
+        text=True,
+    )
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        rows.append((int(cumulative) / 1e6, name))
+    return sorted(rows, reverse=True)[:count]
+
+
+def run_benchmark(budgets: Optional[Dict[str, float]] = None, repeat: int = 3, importtime: bool = False) -> bool:
+    """
+    Measure every entry point and print a report.
+
+    Parameters
+    ----------
+    budgets : dict, optional
+        Entry point -> budget in seconds, overriding `ENTRY_POINTS`.
+    repeat : int, optional
+        Fresh interpreters per entry point, by default 3.
+    importtime : bool, optional
+        Also print the slowest imports of entry points over budget.
+
+    Returns
+    -------
+    bool
+        True if every entry point is within budget and loads no forbidden stack.
+    """
+    budgets = budgets or {}
+    rows = []
+    failed = []
+    for entry_point, (budget, forbidden) in ENTRY_POINTS.items():
+        budget = budgets.get(entry_point, budget)
+        result = measure(entry_point, repeat)
+        loaded = [name for name in forbidden if name in result["modules"]]
+        ok = result["seconds"] <= budget and not loaded
+        rows.append(
+            [entry_point, f"{result['seconds']:.3f}", f"{budget:.3f}", ", ".join(loaded) or "-", "ok" if ok else "FAIL"]
+        )
+        if not ok:
+            failed.append(entry_point)
+    print(tabulate(rows, headers=["Entry point", "Import (s)", "Budget (s)", "Heavy stacks loaded", ""]))
+    if importtime:
+        for entry_point in failed:
+            print(f"\nSlowest imports of {entry_point}:")
+            print(tabulate(slowest_imports(entry_point), headers=["Cumulative (s)", "Module"]))
+    return not failed
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description="Check entry point import times against a budget.")
+    parser.add_argument(
+        "--budget",
+        action="append",
+        default=[],
+        metavar="ENTRY=SECONDS",
+        help="Override one entry point's budget (repeatable)",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Fresh interpreters per entry point")
+    parser.add_argument("--importtime", action="store_true", help="Show the slowest imports of failures")
+    return parser
+
+
+def main(argv=None):
+    args = argument_parser().parse_args(argv)
+    budgets = {}
+    for item in args.budget:
+        entry_point, _, seconds = item.partition("=")
+        budgets[entry_point] = float(seconds)
+    sys.exit(0 if run_benchmark(budgets, args.repeat, args.importtime) else 1)
+
+
+if __name__ == "__main__":
+    main()
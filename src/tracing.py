@@ -0,0 +1,169 @@
+"""
+Lightweight span tracing exported as Chrome trace / Perfetto JSON.
+
+One `Tracer` is active per MRN run. Code on the retrieval path wraps its
+stages in `span(...)` (or reports an already-timed interval with
+`complete(...)`); both are no-ops costing one global lookup when no tracer
+is active. `stop_trace` writes ``LOGS_DIRECTORY/traces/<mrn>_<time>.json``,
+which opens directly in chrome://tracing or https://ui.perfetto.dev.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from ._globals import LOGS_DIRECTORY
+from .logger_setup import core_logger
+
+TRACES_DIRECTORY = LOGS_DIRECTORY / "traces"
+
+
+class Tracer:
+    """
+    Collects complete ("X") events for one run.
+
+    Parameters
+    ----------
+    name : str
+        Label of the run, used as the process name in the trace (the MRN).
+    max_events : int, optional
+        Events beyond this are counted but dropped, by default 1,000,000.
+    """
+
+    def __init__(self, name: str, max_events: int = 1_000_000):
+        self.name = str(name)
+        self.max_events = max_events
+        self.dropped = 0
+        self._t0 = time.perf_counter()
+        self._pid = os.getpid()
+        self._events: List[Dict] = []
+        self._threads: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def _us(self, t: float) -> float:
+        return round((t - self._t0) * 1e6, 3)
+
+    def complete(self, name: str, start: float, cat: str = "app", end: Optional[float] = None, **args):
+        """
+        Record an interval that has already been timed.
+
+        Parameters
+        ----------
+        name : str
+            Span name.
+        start : float
+            `time.perf_counter()` value at the start of the interval.
+        cat : str, optional
+            Trace category, by default "app".
+        end : float, optional
+            `time.perf_counter()` value at the end, by default now.
+        **args
+            Shown in the span's details pane.
+        """
+        end = time.perf_counter() if end is None else end
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": self._us(start),
+            "dur": round((end - start) * 1e6, 3),
+            "pid": self._pid,
+            "tid": thread.ident,
+        }
+        if args:
+            event["args"] = {k: v if isinstance(v, (int, float, bool)) or v is None else str(v)
+                             for k, v in args.items()}
+        with self._lock:
+            if len(self._events) >= self.max_events:
+                self.dropped += 1
+                return
+            self._events.append(event)
+            self._threads.setdefault(thread.ident, thread.name)
+
+    @contextmanager
+    def span(self, name: str, cat: str = "app", **args):
+        """Context manager recording the enclosed block as one span."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.complete(name, start, cat, **args)
+
+    def to_json(self) -> Dict:
+        """The trace in Chrome's JSON object format."""
+        with self._lock:
+            events = list(self._events)
+            threads = dict(self._threads)
+        meta = [{"name": "process_name", "ph": "M", "pid": self._pid, "args": {"name": self.name}}]
+        meta += [
+            {"name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid, "args": {"name": tname}}
+            for tid, tname in threads.items()
+        ]
+        return {
+            "traceEvents": meta + events,
+            "displayTimeUnit": "ms",
+            "otherData": {"run": self.name, "dropped_events": self.dropped},
+        }
+
+    def export(self, path) -> Path:
+        """Write the trace to `path` and return it."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.to_json(), f)
+        return path
+
+
+_active: Optional[Tracer] = None
+
+
+def start_trace(mrn: str, **kwargs) -> Tracer:
+    """Make a new tracer for `mrn` the active one."""
+    global _active
+    _active = Tracer(mrn, **kwargs)
+    return _active
+
+
+def get_tracer() -> Optional[Tracer]:
+    """The active tracer, or None when tracing is off."""
+    return _active
+
+
+def stop_trace(directory=TRACES_DIRECTORY) -> Optional[Path]:
+    """
+    Deactivate the current tracer and export it.
+
+    Returns
+    -------
+    Path or None
+        The written trace file, or None when no tracer was active.
+    """
+    global _active
+    tracer, _active = _active, None
+    if tracer is None:
+        return None
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    path = tracer.export(Path(directory) / f"{tracer.name}_{stamp}.json")
+    core_logger.info(f"Trace written to {path} ({tracer.dropped} events dropped)")
+    return path
+
+
+def span(name: str, cat: str = "app", **args):
+    """Span on the active tracer, or a no-op context when tracing is off."""
+    tracer = _active
+    if tracer is None:
+        return nullcontext()
+    return tracer.span(name, cat, **args)
+
+
+def complete(name: str, start: float, cat: str = "app", **args) -> None:
+    """Record an already-timed interval on the active tracer, if any."""
+    tracer = _active
+    if tracer is not None:
+        tracer.complete(name, start, cat, **args)